@@ -1,4 +1,4 @@
-__all__ = [ "pdrutils", "measurement", "modelset"]
+__all__ = [ "pdrutils", "measurement", "modelset", "modelpack", "modelcache", "modelsurrogate", "modelindex", "packbuilder"]
 
 VERSION = "2.3.2b"
 AUTHORS =  'Marc W. Pound, Mark G. Wolfire'
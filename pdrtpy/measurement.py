@@ -3,7 +3,7 @@
 #@Todo it would be nice to be able to get Measurment[index] as a Measurement instead of
 # a float. This is the behavior for CCDData, somehow lost in Measurement  See NDUncertainty __getitem__
 # this will have ripple effects if implemented.
-from copy import deepcopy
+import mmap
 from os import remove
 from os.path import exists
 
@@ -11,10 +11,9 @@ from astropy import log
 import astropy.units as u
 from astropy.io import fits,registry
 from astropy.table import Table
-from astropy.nddata import CCDData, StdDevUncertainty 
+from astropy.nddata import CCDData, StdDevUncertainty, VarianceUncertainty, InverseVariance
 import numpy as np
-import numpy.ma as ma
-from scipy.interpolate import interp2d
+from scipy.interpolate import RegularGridInterpolator
 from . import pdrutils as utils
 import warnings
 
@@ -76,7 +75,9 @@ class Measurement(CCDData):
                                         bmin=14.1*u.arcsec,
                                         bpa=23.2*u.degrees)
 
-    By default image axes with only a single dimension are removed on read.  If you do not want this behavior, used `read(squeeze=False)`. See also: :class:`astropy.nddata.CCDData`.
+    By default image axes with only a single dimension are removed on read.  If you do not want this behavior, used `read(squeeze=False)`.
+
+    Large maps can be memory-mapped with `read(memmap=True)`, so that the data, uncertainty, and mask are read from the file only when they are used (see :func:`fits_measurement_reader`).  See also: :class:`astropy.nddata.CCDData`.
     """
     def __init__(self,*args, **kwargs):
         warnings.simplefilter("ignore",DeprecationWarning)
@@ -94,6 +95,10 @@ class Measurement(CCDData):
         self._restfreq = kwargs.pop('restfreq',None)
         self._filename = None
         self._data = None # shut up Codacy
+        # world axes and interpolators are computed when first needed
+        self._world_axes = dict()
+        self._interp = None
+        self._interp_kind = 'linear'
 
         #This won't work: On arithmetic operations, this raises the exception.
         #if self._identifier is None:
@@ -143,8 +148,6 @@ class Measurement(CCDData):
             self.header["BMIN"] = _beam["BMIN"]
         if "BPA" not in self.header:
             self.header["BPA"] = _beam["BPA"]
-        if self.wcs is not None:
-            self._set_up_for_interp()
 
     def _beam_convert(self,bpar):
         if bpar is None:
@@ -158,19 +161,21 @@ class Measurement(CCDData):
     def make_measurement(datafile,error,outfile,rms=None,masknan=True,overwrite=False,unit="adu"):
         """Create a FITS files with 2 HDUS, the first being the datavalue and the 2nd being
         the data uncertainty. This format makes allows the resulting file to be read into the underlying :class:'~astropy.nddata.CCDData` class.
+        The input files are memory-mapped and the output is written one section of the image at a time, so large images and cubes are never held in memory in full.  Several data files can be processed in one call by giving lists.
 
-        :param datafile: The FITS file containing the data as a function of spatial coordinates
-        :type datafile: str
+        :param datafile: The FITS file containing the data as a function of spatial coordinates, or a list of them
+        :type datafile: str or list of str
         :param error: The errors on the data Possible values for error are:
 
              - a filename with the same shape as datafile containing the error values per pixel
              - a percentage value 'XX%' must have the "%" symbol in it
              - 'rms' meaning use the rms parameter if given, otherwise look for the RMS keyword in the FITS header of the datafile
 
-        :type error: str
-        :param outfile: The output file to write the result in (FITS format)
-        :type outfile: str
-        :param rms:  If error == 'rms', this value may give the rms in same units as data (e.g 'erg s-1 cm-2 sr-1').
+          If `datafile` is a list, this may be a list with an entry for each data file.
+        :type error: str or list of str
+        :param outfile: The output file to write the result in (FITS format), or a list with one for each data file
+        :type outfile: str or list of str
+        :param rms:  If error == 'rms', this value may give the rms in same units as data (e.g 'erg s-1 cm-2 sr-1').  If `datafile` is a list, this may be a list with an entry for each data file.
         :type rms: float or :class:`astropy.units.Unit`
         :param masknan: Whether to mask any pixel where the data or the error is NaN. Default:true
         :type masknan: bool
@@ -181,6 +186,7 @@ class Measurement(CCDData):
 
         :raises Exception: on various FITS header issues
         :raises OSError: if `overwrite` is `False` and the output file exists.
+        :raises ValueError: if the lists of data files, errors, output files, and rms values have different lengths
 
         Example usage:
 
@@ -192,54 +198,21 @@ class Measurement(CCDData):
             # example with measurement in units of K km/s and error
             # indicated by RMS keyword in input file.
             Measurement.make_measurement("my_infile.fits",error='rms',outfile="my_outfile.fits",unit="K km/s",overwrite=True)
-        """
-        _data = fits.open(datafile)
-        needsclose = False
-        if error == 'rms':
-            _error = deepcopy(_data)
-            if rms is None:
-                rms = _data[0].header.get("RMS",None)
-                if rms is None:
-                    raise Exception("rms not given as parameter and RMS keyword not present in data header")
-                else:
-                    print("Found RMS in header: %.2E %s"%(rms,_error[0].data.shape))
-            #tmp = np.full(_error[0].data.shape,rms)
-            _error[0].data[:] = rms
-        elif "%" in error:
-            percent = float(error.strip('%')) / 100.0
-            _error = deepcopy(_data)
-            _error[0].data = _data[0].data*percent
-        else:
-            _error = fits.open(error)
-            needsclose = True
 
-        fb = _data[0].header.get('bunit',str(unit)) #use str in case Unit was given
-        eb = _error[0].header.get('bunit',str(unit))
-        if fb != eb:
-            raise Exception("BUNIT must be the same in both data (%s) and error (%s) maps"%(fb,eb))
-        # Sigh, this is necessary since there is no mode available in
-        # fits.open that will truncate an existing file for writing
-        if overwrite and exists(outfile):
-            remove(outfile)
-        _out = fits.open(name=outfile,mode="ostream")
-        _out.append(_data[0])
-        _out[0].header['bunit'] = fb
-        _out.append(_error[0])
-        _out[1].header['extname']='UNCERT'
-        _out[1].header['bunit'] = eb
-        _out[1].header['utype'] = 'StdDevUncertainty'
-        if masknan:
-            fmasked = ma.masked_invalid(_data[0].data)
-            emasked = ma.masked_invalid(_error[0].data)
-            final_mask = utils.mask_union([fmasked,emasked])
-            # Convert boolean mask to uint since io.fits cannot handle bool.
-            hduMask = fits.ImageHDU(final_mask.astype(np.uint8), name='MASK')
-            _out.append(hduMask)
-        _out.writeto(outfile,overwrite=overwrite)
-        _data.close()
-        _out.close()
-        if needsclose: 
-            _error.close()
+            # example with several files
+            Measurement.make_measurement(["cii.fits","oi.fits"],error=["cii_error.fits","oi_error.fits"],
+                                         outfile=["cii_meas.fits","oi_meas.fits"])
+        """
+        if not isinstance(datafile,(list,tuple)):
+            _make_measurement(datafile,error,outfile,rms,masknan,overwrite,unit)
+            return
+        n = len(datafile)
+        errors = error if isinstance(error,(list,tuple)) else [error]*n
+        rmss = rms if isinstance(rms,(list,tuple)) else [rms]*n
+        if not isinstance(outfile,(list,tuple)) or len(outfile) != n or len(errors) != n or len(rmss) != n:
+            raise ValueError(f"Give an output file, and an error and rms or one of each for all, for each of the {n} data files")
+        for d,e,o,r in zip(datafile,errors,outfile,rmss):
+            _make_measurement(d,e,o,r,masknan,overwrite,unit)
 
     @property
     def value(self):
@@ -327,18 +300,67 @@ class Measurement(CCDData):
         hdu = self.to_hdu()
         hdu.writeto(filename,**kwd)
 
-    def _set_up_for_interp(self,kind='linear'):
+    def _set_up_for_interp(self,kind='linear',world_axis=None,world_axis_lin=None):
         #@TODO this will always return nan if there are nan in the data.
         # See eg. https://stackoverflow.com/questions/35807321/scipy-interpolation-with-masked-data
         """
         We don't want to have to do a call to get a pixel value at a particular WCS every time it's needed.
-        So make one call that converts the entire NAXIS1 and NAXIS2 to an array of world coordinates and stash that away
-        so we can pass it to scipy.interp2d when needed
+        So the entire NAXIS1 and NAXIS2 are converted to arrays of world coordinates once, the first time they are needed,
+        and the interpolators are built from them the first time :meth:`get` is called.  Precomputed world coordinates,
+        e.g. shared by all models of a ModelSet, can be passed in with `world_axis` and `world_axis_lin`.
+
+        :param kind: the interpolation method of :class:`scipy.interpolate.RegularGridInterpolator`, e.g. 'linear' or 'cubic'
+        :type kind: str
         """
-        self._world_axis = utils.get_xy_from_wcs(self,quantity=False,linear=False)
-        self._world_axis_lin = utils.get_xy_from_wcs(self,quantity=False,linear=True)
-        self._interp_log = interp2d(self._world_axis[0],self._world_axis[1],z=self.data,kind=kind,bounds_error=True)
-        self._interp_lin = interp2d(self._world_axis_lin[0],self._world_axis_lin[1],z=self.data,kind=kind,bounds_error=True)
+        self._interp_kind = kind
+        self._interp = None
+        for linear,axes in [(False,world_axis),(True,world_axis_lin)]:
+            if axes is not None:
+                self._world_axes[linear] = (self.wcs,axes)
+
+    def _get_world_axis(self,linear):
+        """The world coordinates of NAXIS1 and NAXIS2, computed from the WCS the first time they are needed"""
+        cached = self._world_axes.get(linear,None)
+        if cached is None or cached[0] is not self.wcs:
+            if self.wcs is None:
+                return None
+            cached = (self.wcs,utils.get_xy_from_wcs(self,quantity=False,linear=linear))
+            self._world_axes[linear] = cached
+        return cached[1]
+
+    @property
+    def _world_axis(self):
+        return self._get_world_axis(False)
+
+    @property
+    def _world_axis_lin(self):
+        return self._get_world_axis(True)
+
+    def _interpolator(self,log):
+        """The interpolator of the data in log or linear world coordinates.  It is built the first time it is needed and rebuilt if the data or WCS are replaced."""
+        cached = self._interp
+        if cached is None or cached[0] is not self.data or cached[1] is not self.wcs:
+            if self.wcs is None:
+                raise Exception(f"No wcs in this Measurement {self.id}")
+            cached = (self.data,self.wcs,dict())
+            self._interp = cached
+        interp = cached[2].get(log,None)
+        if interp is None:
+            x,y = self._world_axis if log else self._world_axis_lin
+            x = np.asarray(x,dtype=float)
+            y = np.asarray(y,dtype=float)
+            # models may have leading axes of length 1
+            z = np.asarray(self.data).reshape(len(y),len(x))
+            # the interpolator needs increasing axes, but a WCS may have a negative CDELT.
+            if len(x) > 1 and x[0] > x[-1]:
+                x = x[::-1]
+                z = z[:,::-1]
+            if len(y) > 1 and y[0] > y[-1]:
+                y = y[::-1]
+                z = z[::-1]
+            interp = RegularGridInterpolator((y,x),z,method=self._interp_kind,bounds_error=True)
+            cached[2][log] = interp
+        return interp
 
     def get_pixel(self,world_x,world_y):
         '''Return the nearest pixel coordinates to the input world coordinates
@@ -352,7 +374,7 @@ class Measurement(CCDData):
             raise Exception(f"No wcs in this Measurement {self.id}")
         return tuple(np.round(self.wcs.world_to_pixel_values(world_x,world_y)).astype(int))
 
-    def get(self,world_x,world_y,log=False):
+    def get(self,world_x,world_y,log=False,grid=True):
         """Get the value(s) at the give world coordinates
 
         :param world_x: the x value in world units of naxis1
@@ -361,13 +383,22 @@ class Measurement(CCDData):
         :type world_y: float or array-lke
         :param log: True if the input coords are logarithmic Default:False
         :type log: bool
+        :param grid: If True, return the values on the grid of all combinations of `world_x` and `world_y`, with shape (len(world_y),len(world_x)), or (len(world_x),) if there is one `world_y`.  If False, return the values at the points (`world_x`, `world_y`), which are broadcast against each other, all in one call. Default: True
+        :type grid: bool
         :returns: The value(s) of the Measurement at input coordinates
-        :rtype: float
+        :rtype: :class:`numpy.ndarray`
+        :raises ValueError: if a coordinate is outside the world axes
         """
-        if log:
-            return self._interp_log(world_x,world_y)
-        else:
-            return self._interp_lin(world_x,world_y)
+        interp = self._interpolator(log)
+        x = np.atleast_1d(np.asarray(world_x,dtype=float))
+        y = np.atleast_1d(np.asarray(world_y,dtype=float))
+        if not grid:
+            x,y = np.broadcast_arrays(x,y)
+            return interp((y,x))
+        z = interp(tuple(np.meshgrid(y,x,indexing="ij")))
+        if len(z) == 1:
+            z = z[0]
+        return z
 
     @property
     def levels(self):
@@ -387,6 +418,140 @@ class Measurement(CCDData):
         else:
             return self.id
 
+    @staticmethod
+    def _operand(other):
+        """The data, uncertainty, unit, and mask of an operand of an arithmetic operation as NumPy arrays, or None if the operand can only be handled by :class:`~astropy.nddata.CCDData` arithmetic"""
+        if isinstance(other,CCDData):
+            if other.uncertainty is None:
+                error = None
+            elif isinstance(other.uncertainty,StdDevUncertainty):
+                error = other.uncertainty.array
+                eunit = other.uncertainty.unit
+                if eunit is not None and eunit != other.unit:
+                    error = error*eunit.to(other.unit)
+            else:
+                return None
+            return np.asarray(other.data),error,other.unit,other.mask
+        if isinstance(other,u.Quantity):
+            return other.value,None,other.unit,None
+        if np.isscalar(other) or isinstance(other,np.ndarray):
+            other = np.asarray(other)
+            if other.dtype.kind in "biuf":
+                return other,None,u.dimensionless_unscaled,None
+        return None
+
+    def _propagate(self,other,op,inplace=False):
+        """Apply an arithmetic operation to the data and uncertainty arrays of this Measurement and another operand with NumPy, propagating uncorrelated standard deviations and units like :class:`~astropy.nddata.CCDData` arithmetic does.
+
+        :param other: the other operand
+        :type other: :class:`Measurement`, :class:`~astropy.nddata.CCDData`, :class:`~astropy.units.Quantity`, number, or :class:`numpy.ndarray`
+        :param op: the operation, one of :func:`numpy.add`, :func:`numpy.subtract`, :func:`numpy.multiply`, :func:`numpy.true_divide`
+        :type op: :class:`numpy.ufunc`
+        :param inplace: If True, put the resulting data in the data array of this Measurement if it can hold them
+        :type inplace: bool
+        :returns: the data, uncertainty, unit, and mask of the result, or None if the operand can only be handled by :class:`~astropy.nddata.CCDData` arithmetic
+        :rtype: tuple
+        """
+        operand = self._operand(other)
+        if operand is None or (self.uncertainty is not None and not isinstance(self.uncertainty,StdDevUncertainty)):
+            return None
+        d2,e2,u2,m2 = operand
+        d1 = np.asarray(self.data)
+        e1 = None if self.uncertainty is None else self.uncertainty.array
+        if e1 is not None and self.uncertainty.unit is not None and self.uncertainty.unit != self.unit:
+            e1 = e1*self.uncertainty.unit.to(self.unit)
+        # the uncertainty needs the data before they are overwritten
+        if op in (np.add,np.subtract):
+            unit = self.unit
+            scale = u2.to(unit)
+            if scale != 1:
+                d2 = d2*scale
+                if e2 is not None:
+                    e2 = e2*scale
+            if e1 is None or e2 is None:
+                error = e1 if e2 is None else e2
+                error = None if error is None else np.broadcast_to(error,np.broadcast(d1,d2).shape).copy()
+            else:
+                error = self._hypot(e1,e2)
+        elif op is np.multiply:
+            unit = self.unit*u2
+            error = self._hypot(None if e1 is None else e1*d2,None if e2 is None else d1*e2)
+        elif op is np.true_divide:
+            unit = self.unit/u2
+            # computed from the ratio below
+            error = None
+        else:
+            raise ValueError(f"Unsupported operation {op}")
+        out = None
+        if inplace and d1 is self.data and d1.dtype.kind == 'f' and d1.flags.writeable \
+           and np.broadcast(d1,d2).shape == d1.shape:
+            out = d1
+        with np.errstate(divide='ignore',invalid='ignore'):
+            data = op(d1,d2,out=out)
+            if op is np.true_divide and e2 is None:
+                error = None if e1 is None else np.abs(e1/d2)
+            elif op is np.true_divide:
+                # sigma = hypot(e1, ratio*e2)/|d2|, from the ratio so that the data may be overwritten
+                error = np.multiply(data,e2)
+                np.square(error,out=error)
+                if e1 is not None:
+                    error += np.square(e1)
+                np.sqrt(error,out=error)
+                np.divide(error,d2,out=error)
+                np.abs(error,out=error)
+        if self.mask is None or m2 is None:
+            mask = self.mask if m2 is None else m2
+            mask = None if mask is None else np.broadcast_to(mask,data.shape).copy()
+        else:
+            mask = np.logical_or(self.mask,m2)
+        return data,error,unit,mask
+
+    @staticmethod
+    def _hypot(a,b):
+        """Add uncertainties in quadrature, either of which may be None"""
+        if a is None or b is None:
+            c = a if b is None else b
+            return None if c is None else np.abs(c)
+        # much faster than np.hypot, which guards against overflow
+        c = np.square(a,dtype=float) + np.square(b,dtype=float)
+        return np.sqrt(c,out=c)
+
+    def _arithmetic(self,other,op,symbol):
+        """Return a new Measurement that is the result of an arithmetic operation.  Unless the operand is not supported by :meth:`_propagate`, the result is computed directly on the NumPy arrays, and shares the WCS of this Measurement.  Its header is a copy of this Measurement's header."""
+        result = self._propagate(other,op)
+        if result is None:
+            return None
+        data,error,unit,mask = result
+        wcs = self.wcs if self.wcs is not None else getattr(other,"wcs",None)
+        uncertainty = None if error is None else StdDevUncertainty(error,unit=unit,copy=False)
+        z = Measurement(data,uncertainty=uncertainty,unit=unit,mask=mask,wcs=wcs,
+                        header=self.header.copy(),identifier=self._modify_id(other,symbol))
+        return z
+
+    def _inplace(self,other,op,symbol):
+        """Apply an arithmetic operation to this Measurement in place.  The data array is overwritten if it can hold the result."""
+        # modelcache imports this module.
+        from .modelcache import forget
+        result = self._propagate(other,op,inplace=True)
+        if result is None:
+            # not supported in place, e.g., other types of uncertainty.
+            return getattr(self,self._ops[op])(other)
+        data,error,unit,mask = result
+        if data is self.data:
+            # values derived from the data, e.g., checksums and gradients, are stale.
+            forget(data)
+        self.data = data
+        self._unit = unit
+        self.header["BUNIT"] = str(unit)
+        self.uncertainty = None if error is None else StdDevUncertainty(error,unit=unit,copy=False)
+        self.mask = mask
+        self._identifier = self._modify_id(other,symbol)
+        # the data may have changed in place
+        self._interp = None
+        return self
+
+    _ops = {np.add:"add",np.subtract:"subtract",np.multiply:"multiply",np.true_divide:"divide"}
+
     def add(self,other):
         """Add this Measurement to another, propagating errors, units,  and updating identifiers.  Masks are logically or'd.
 
@@ -398,6 +563,9 @@ class Measurement(CCDData):
         # with the default unit "adu" and then units for the operation are
         # not conformable.  I blame astropy CCDData authors for making that
         # class so hard to subclass.
+        z = self._arithmetic(other,np.add,'+')
+        if z is not None:
+            return z
         z=CCDData.add(self,other,handle_mask=np.logical_or)
         z=Measurement(z,unit=z._unit)
         z._identifier = self._modify_id(other,'+')
@@ -410,6 +578,9 @@ class Measurement(CCDData):
         :param other: a Measurement or number to subtract
         :type other: :class:`Measurement` or number
         '''
+        z = self._arithmetic(other,np.subtract,'-')
+        if z is not None:
+            return z
         z=CCDData.subtract(self,other,handle_mask=np.logical_or)
         z=Measurement(z,unit=z._unit)
         z._identifier = self._modify_id(other,'-')
@@ -421,6 +592,9 @@ class Measurement(CCDData):
         :param other: a Measurement or number to multiply
         :type other: :class:`Measurement` or number
         '''
+        z = self._arithmetic(other,np.multiply,'*')
+        if z is not None:
+            return z
         z=CCDData.multiply(self,other,handle_mask=np.logical_or)
         z=Measurement(z,unit=z._unit)
         z._identifier = self._modify_id(other,'*')
@@ -432,11 +606,22 @@ class Measurement(CCDData):
         :param other: a Measurement or number to divide by
         :type other: :class:`Measurement` or number
         '''
+        z = self._arithmetic(other,np.true_divide,'/')
+        if z is not None:
+            return z
         z=CCDData.divide(self,other,handle_mask=np.logical_or)
         z=Measurement(z,unit=z._unit)
         z._identifier = self._modify_id(other,'/')
         return z
 
+    def is_memmap(self):
+        ''' Are the data of this Measurement memory-mapped from a file, e.g., by `Measurement.read(memmap=True)`?
+
+        :returns: True if the data are memory-mapped
+        :rtype: bool
+        '''
+        return _is_memmap(self.data)
+
     def is_single_pixel(self):
         ''' Is this Measurement a single value?
         :returns: True if a single value (pixel)
@@ -463,6 +648,22 @@ class Measurement(CCDData):
         z=self.divide(other)
         return z
 
+    def __iadd__(self,other):
+        '''Add another Measurement to this one in place using += operator, propagating errors, units,  and updating identifiers'''
+        return self._inplace(other,np.add,'+')
+
+    def __isub__(self,other):
+        '''Subtract another Measurement from this one in place using -= operator, propagating errors, units,  and updating identifiers'''
+        return self._inplace(other,np.subtract,'-')
+
+    def __imul__(self,other):
+        '''Multiply this Measurement by another in place using *= operator, propagating errors, units,  and updating identifiers'''
+        return self._inplace(other,np.multiply,'*')
+
+    def __itruediv__(self,other):
+        '''Divide this Measurement by another in place using /= operator, propagating errors, units,  and updating identifiers'''
+        return self._inplace(other,np.true_divide,'/')
+
     def __repr__(self):
         m = "%s +/- %s %s" % (np.squeeze(self.data),np.squeeze(self.error),self.unit)
         return m
@@ -586,8 +787,230 @@ class Measurement(CCDData):
             return m
 
 
+class MeasurementBatch(object):
+    r'''A columnar set of measurements of many sources, e.g. a catalog of line intensities.  The data and uncertainties of all rows are held as one array with a row for each identifier and a column for each source, rather than as a :class:`Measurement` per row.  :class:`~pdrtpy.tool.lineratiofit.LineRatioFit` takes a MeasurementBatch as its measurements and fits all sources as a vector.
+
+    Each input row is one measurement of one source.  If `sources` is given, rows with the same source are measurements of the same source, and measurements missing from a source are NaN and masked.  Otherwise the *i*-th row of each identifier is the *i*-th source, as for tables read with :meth:`Measurement.from_table`, and every identifier must have the same number of rows.
+
+    :param identifiers: the identifier of each row, e.g. "CII_158"
+    :type identifiers: array-like of str
+    :param data: the data value of each row
+    :type data: array-like or :class:`~astropy.units.Quantity`
+    :param uncertainty: the error on the data value of each row, in the units of `data` unless it is a Quantity
+    :type uncertainty: array-like or :class:`~astropy.units.Quantity`
+    :param unit: the unit of `data` if it is not a Quantity, or a dict of units keyed by identifier, e.g., {"CII_158":"erg s-1 cm-2 sr-1","CO_32":"K km/s"}. Default: "adu", as for :class:`Measurement`
+    :type unit: str, :class:`~astropy.units.Unit`, or dict
+    :param sources: the source of each row. Default: None
+    :type sources: array-like
+    :param bmaj: beam major axis diameter of each row. Default: None
+    :type bmaj: :class:`~astropy.units.Quantity`
+    :param bmin: beam minor axis diameter of each row. Default: None
+    :type bmin: :class:`~astropy.units.Quantity`
+    :param bpa: beam position angle of each row. Default: None
+    :type bpa: :class:`~astropy.units.Quantity`
+    :raises ValueError: if the columns have different lengths, a source has two measurements with the same identifier, or without `sources`, identifiers have different numbers of rows
+    '''
+    def __init__(self,identifiers,data,uncertainty,unit="adu",sources=None,bmaj=None,bmin=None,bpa=None):
+        identifiers = np.asarray(identifiers).astype(str)
+        if isinstance(data,u.Quantity):
+            unit = data.unit
+            data = data.value
+        if isinstance(uncertainty,u.Quantity):
+            if isinstance(unit,dict):
+                raise ValueError("uncertainty can not be a Quantity if unit is a dict")
+            uncertainty = uncertainty.to_value(unit)
+        data = np.asarray(data,dtype=float)
+        uncertainty = np.asarray(uncertainty,dtype=float)
+        nrows = len(identifiers)
+        for name,column in [("data",data),("uncertainty",uncertainty),("sources",sources),
+                            ("bmaj",bmaj),("bmin",bmin),("bpa",bpa)]:
+            if column is not None and len(column) != nrows:
+                raise ValueError(f"There are {len(column)} {name} for {nrows} identifiers")
+        self._identifiers,row = _first_seen(identifiers)
+        self._index = {k:i for i,k in enumerate(self._identifiers)}
+        if isinstance(unit,dict):
+            self._units = {k:u.Unit(unit[k]) for k in self._identifiers}
+        else:
+            self._units = {k:u.Unit(unit) for k in self._identifiers}
+        if sources is None:
+            counts = np.bincount(row,minlength=len(self._identifiers))
+            if np.any(counts != counts[0]):
+                raise ValueError(f"Without sources, all identifiers must have the same number of rows, but they have {dict(zip(self._identifiers,counts))}")
+            # the position of each row among the rows of its identifier
+            order = np.argsort(row,kind="stable")
+            col = np.empty(nrows,dtype=int)
+            col[order] = np.arange(nrows) - np.repeat(np.cumsum(counts)-counts,counts)
+            self._sources = None
+            nsources = int(counts[0]) if nrows > 0 else 0
+        else:
+            self._sources,col = _first_seen(np.asarray(sources))
+            nsources = len(self._sources)
+        cell = row*nsources + col
+        if len(np.unique(cell)) != nrows:
+            raise ValueError("Some sources have more than one measurement with the same identifier")
+        shape = (len(self._identifiers),nsources)
+        self._data = np.full(shape,np.nan)
+        self._data[row,col] = data
+        self._error = np.full(shape,np.nan)
+        self._error[row,col] = uncertainty
+        self._missing = np.ones(shape,dtype=bool)
+        self._missing[row,col] = False
+        # beams of the first row of each identifier
+        first = np.unique(row,return_index=True)[1]
+        self._beams = dict()
+        for key,beam in [("BMAJ",bmaj),("BMIN",bmin),("BPA",bpa)]:
+            self._beams[key] = None if beam is None else u.Quantity(beam)[first]
+
+    @staticmethod
+    def from_table(table,format='ipac',source="source"):
+        r'''Create a MeasurementBatch from one or more tables in one pass over their columns.  The tables have the columns described in :meth:`Measurement.from_table`: *data*, *uncertainty*, and *identifier*, and optionally *bmaj*, *bmin*, and *bpa*.  They may also have a column giving the source of each row.  A data column without a unit is in "adu", the default of :class:`MeasurementBatch`, and an uncertainty column without a unit is in the unit of the data.  Several tables, e.g., one for each line, are stacked.  The tables may have different units, but all rows of an identifier are converted to the unit of its first table.
+
+        :param table: the table, a file name, or a list of them
+        :type table: :class:`~astropy.table.Table`, str, or list
+        :param format: `Astropy Table format <https://docs.astropy.org/en/stable/io/unified.html#built-in-readers-writers>`_ of table files. Default: 'ipac'
+        :type format: str
+        :param source: the name of the optional column giving the source of each row. Default: "source"
+        :type source: str
+        :rtype: :class:`MeasurementBatch`
+        :raises Exception: if a required column is missing
+        '''
+        if not isinstance(table,(list,tuple)):
+            table = [table]
+        required = ["data","uncertainty","identifier"]
+        options = ["bmaj","bmin","bpa"]
+        units = dict()
+        columns = {k:list() for k in ["identifier","data","uncertainty","source"]+options}
+        for t in table:
+            if not isinstance(t,Table):
+                t = Table.read(t,format=format)
+            missing = [r for r in required if r not in t.colnames]
+            if missing:
+                raise Exception(f"Insufficient information in table to create MeasurementBatch. {missing} are required columns.")
+            ids = np.asarray(t["identifier"]).astype(str)
+            dunit = u.Unit(t["data"].unit if t["data"].unit is not None else "adu")
+            data = np.ma.filled(np.ma.asarray(t["data"],dtype=float),np.nan)
+            error = np.ma.filled(np.ma.asarray(t["uncertainty"],dtype=float),np.nan)
+            eunit = t["uncertainty"].unit
+            if eunit == "%":
+                error = error*data/100.0
+            elif eunit is not None:
+                error = error*u.Unit(eunit).to(dunit)
+            # convert to the unit of the first table with the identifier
+            scale = np.ones(len(t))
+            for k in np.unique(ids):
+                units.setdefault(k,dunit)
+                scale[ids == k] = dunit.to(units[k])
+            columns["identifier"].append(ids)
+            columns["data"].append(data*scale)
+            columns["uncertainty"].append(error*scale)
+            columns["source"].append(np.asarray(t[source]) if source in t.colnames else None)
+            hasbeams = all(b in t.colnames for b in options)
+            for b in options:
+                columns[b].append(u.Quantity(t[b]) if hasbeams else None)
+        def stack(c):
+            if any(x is None for x in columns[c]):
+                return None
+            if c in options:
+                return u.Quantity(np.concatenate([x.to_value(columns[c][0].unit) for x in columns[c]]),columns[c][0].unit)
+            return np.concatenate(columns[c])
+        beams = {b:stack(b) for b in options}
+        return MeasurementBatch(stack("identifier"),stack("data"),stack("uncertainty"),unit=units,
+                                sources=stack("source"),**beams)
+
+    @property
+    def identifiers(self):
+        '''The identifiers of the measurements, in the order they first appear in the input
+
+        :rtype: list of str
+        '''
+        return list(self._identifiers)
+
+    @property
+    def sources(self):
+        '''The sources, in the order they first appear in the input, or None if sources were not given
+
+        :rtype: :class:`numpy.ndarray` or None
+        '''
+        return self._sources
+
+    @property
+    def units(self):
+        '''The units of the data and uncertainties of each identifier
+
+        :rtype: dict of :class:`astropy.units.Unit`
+        '''
+        return dict(self._units)
+
+    @property
+    def size(self):
+        '''The number of sources
+
+        :rtype: int
+        '''
+        return self._data.shape[1]
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self,identifier):
+        return identifier in self._index
+
+    def _row(self,identifier):
+        try:
+            return self._index[identifier]
+        except KeyError:
+            raise KeyError(f"{identifier} is not in this MeasurementBatch")
+
+    def data(self,identifier):
+        '''The data values of all sources for one identifier.  Missing measurements are NaN.
+
+        :param identifier: the identifier, e.g., "CII_158"
+        :type identifier: str
+        :rtype: :class:`numpy.ndarray`
+        '''
+        return self._data[self._row(identifier)]
+
+    def error(self,identifier):
+        '''The uncertainties of all sources for one identifier.  Missing measurements are NaN.
+
+        :param identifier: the identifier, e.g., "CII_158"
+        :type identifier: str
+        :rtype: :class:`numpy.ndarray`
+        '''
+        return self._error[self._row(identifier)]
+
+    def measurement(self,identifier):
+        '''A vector :class:`Measurement` of all sources for one identifier.  It shares the data and uncertainty arrays of this MeasurementBatch.  Its beam parameters are those of the first row of the identifier.
+
+        :param identifier: the identifier, e.g., "CII_158"
+        :type identifier: str
+        :rtype: :class:`Measurement`
+        '''
+        i = self._row(identifier)
+        missing = self._missing[i]
+        beams = {k.lower():(None if b is None else b[i]) for k,b in self._beams.items()}
+        return Measurement(data=self._data[i],uncertainty=StdDevUncertainty(self._error[i],copy=False),
+                           unit=self._units[identifier],identifier=identifier,
+                           mask=missing.copy() if np.any(missing) else None,**beams)
+
+    def to_measurements(self):
+        '''A vector :class:`Measurement` for each identifier, see :meth:`measurement`.
+
+        :rtype: dict of :class:`Measurement`, keyed by identifier
+        '''
+        return {k:self.measurement(k) for k in self._identifiers}
+
+def _first_seen(values):
+    """The unique values in the order they first appear and the index of each value among them"""
+    unique,first,inverse = np.unique(values,return_index=True,return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order),dtype=int)
+    rank[order] = np.arange(len(order))
+    return unique[order],rank[inverse]
+
+
 def fits_measurement_reader(filename, hdu=0, unit=None,
-                        hdu_mask='MASK', hdu_flags=None,
+                        hdu_uncertainty='UNCERT', hdu_mask='MASK', hdu_flags=None,
                         key_uncertainty_type='UTYPE', **kwd):
     '''FITS file reader for Measurement class, which will be called by :meth:`Measurement.read`.
 
@@ -629,6 +1052,9 @@ def fits_measurement_reader(filename, hdu=0, unit=None,
      :param key_uncertainty_type: The header key name where the class name of the uncertainty  is stored in the hdu of the uncertainty (if any).  Default is ``UTYPE``.
 
 
+    :type memmap: bool, optional
+    :param memmap: If ``True``, memory-map the data, uncertainty, and mask planes instead of reading them, so that they stay on disk until they are sliced or computed on.  The other parameters apply as when the planes are read.  Data with BSCALE or BZERO scaling other than 1 and 0 can not be memory-mapped and are read.  A mask is memory-mapped if it is stored as unsigned bytes, which are then taken to be 0 or 1.  If ``False``, read all planes into memory.  Default is ``None``, which reads the uncertainty and mask planes and lets :mod:`astropy.io.fits` memory-map the data if it can.
+
     :param kwd: Any additional keyword parameters are passed through to the FITS reader in :mod:`astropy.io.fits`
 
     :raises TypeError: If the conversion from CCDData to Measurement fails
@@ -637,10 +1063,20 @@ def fits_measurement_reader(filename, hdu=0, unit=None,
     _id = kwd.pop('identifier', 'unknown')
     _title = kwd.pop('title', None)
     _squeeze = kwd.pop('squeeze', True)
+    _memmap = kwd.pop('memmap', None)
     # suppress INFO messages about units in FITS file. e.g. useless ones like:
     # "INFO: using the unit erg / (cm2 s sr) passed to the FITS reader instead of the unit erg s-1 cm-2 sr-1 in the FITS file."
     log.setLevel('WARNING')
-    z = CCDData.read(filename,unit=unit)#,hdu,uu,hdu_uncertainty,hdu_mask,hdu_flags,key_uncertainty_type, **kwd)
+    kwd.update(hdu=hdu,unit=unit,hdu_flags=hdu_flags,key_uncertainty_type=key_uncertainty_type)
+    if _memmap:
+        # CCDData.read would copy the uncertainty and mask into memory, so map them separately.
+        z = CCDData.read(filename,memmap=True,hdu_uncertainty=None,hdu_mask=None,**kwd)
+        z.uncertainty,z.mask = _memmap_planes(getattr(filename,"name",filename),z.unit,hdu_uncertainty=hdu_uncertainty,
+                                              hdu_mask=hdu_mask,key_uncertainty_type=key_uncertainty_type)
+    else:
+        if _memmap is False:
+            kwd["memmap"] = False
+        z = CCDData.read(filename,hdu_uncertainty=hdu_uncertainty,hdu_mask=hdu_mask,**kwd)
     if _squeeze:
         z = utils.squeeze(z)
 
@@ -659,5 +1095,174 @@ def fits_measurement_reader(filename, hdu=0, unit=None,
 
 
 
+def _memmap_planes(filename,unit,hdu_uncertainty='UNCERT',hdu_mask='MASK',key_uncertainty_type='UTYPE'):
+    """The uncertainty and mask planes of a FITS file, memory-mapped.  Either is None if it is not in the file.  As when CCDData reads them, the uncertainty is in the unit of the data."""
+    uncertainty = None
+    mask = None
+    with fits.open(filename,memmap=True) as hdus:
+        if hdu_uncertainty is not None and hdu_uncertainty in hdus:
+            uhdu = hdus[hdu_uncertainty]
+            utype = _uncertainty_types.get(uhdu.header.get(key_uncertainty_type,None),StdDevUncertainty)
+            uunit = None if unit is None else u.Unit(unit)**_uncertainty_powers[utype]
+            uncertainty = utype(uhdu.data,unit=uunit,copy=False)
+        if hdu_mask is not None and hdu_mask in hdus:
+            mask = hdus[hdu_mask].data
+            # Masks are saved as uint8 since io.fits cannot handle bool.
+            if mask.dtype == np.uint8:
+                mask = mask.view(np.bool_)
+            else:
+                mask = mask.astype(np.bool_)
+    # the arrays keep the memory map open after the file is closed.
+    return uncertainty,mask
+
+_uncertainty_types = {c.__name__:c for c in [StdDevUncertainty,VarianceUncertainty,InverseVariance]}
+# the power of the data unit that is the unit of each type of uncertainty
+_uncertainty_powers = {StdDevUncertainty:1,VarianceUncertainty:2,InverseVariance:-2}
+
+def _make_measurement(datafile,error,outfile,rms,masknan,overwrite,unit):
+    """Write the data, uncertainty, and mask HDUs of one data file for :meth:`Measurement.make_measurement`, one section at a time"""
+    # Scaled data are unscaled one section at a time in _image_section.
+    _data = fits.open(datafile,memmap=True,do_not_scale_image_data=True)
+    _error = None
+    try:
+        dhdu = _data[0]
+        ddtype = _image_dtype(dhdu)
+        # the uncertainty is floating point even if the data are integers
+        edtype = ddtype if ddtype.kind == 'f' else np.dtype(np.float64)
+        if error == 'rms':
+            if rms is None:
+                rms = dhdu.header.get("RMS",None)
+                if rms is None:
+                    raise Exception("rms not given as parameter and RMS keyword not present in data header")
+                else:
+                    print("Found RMS in header: %.2E %s"%(rms,dhdu.shape))
+            eheader = dhdu.header
+            error_section = lambda s,d: np.full(d.shape,rms,dtype=edtype)
+        elif "%" in error:
+            percent = float(error.strip('%')) / 100.0
+            eheader = dhdu.header
+            error_section = lambda s,d: (d*percent).astype(edtype,copy=False)
+        else:
+            _error = fits.open(error,memmap=True,do_not_scale_image_data=True)
+            ehdu = _error[0]
+            if ehdu.shape != dhdu.shape:
+                raise Exception("Data %s and error %s maps must have the same shape"%(dhdu.shape,ehdu.shape))
+            eheader = ehdu.header
+            edtype = _image_dtype(ehdu)
+            error_section = lambda s,d: _image_section(ehdu,s)
+
+        fb = dhdu.header.get('bunit',str(unit)) #use str in case Unit was given
+        eb = eheader.get('bunit',str(unit))
+        if fb != eb:
+            raise Exception("BUNIT must be the same in both data (%s) and error (%s) maps"%(fb,eb))
+        if exists(outfile):
+            if not overwrite:
+                raise OSError(f"File {outfile!r} already exists.")
+            remove(outfile)
+
+        sections = _image_sections(dhdu.shape,max(ddtype.itemsize,edtype.itemsize))
+        # the mask is filled in while the data and uncertainty are written, so that
+        # neither is read again for it. Masks are saved as uint8 since io.fits cannot handle bool.
+        mask = np.zeros(dhdu.shape,dtype=np.uint8) if masknan else None
+        def data_sections():
+            for s in sections:
+                d = _image_section(dhdu,s)
+                if mask is not None:
+                    mask[s] = ~np.isfinite(d)
+                yield d
+        def error_sections():
+            for s in sections:
+                e = error_section(s,_image_section(dhdu,s))
+                if mask is not None:
+                    mask[s] |= ~np.isfinite(e)
+                yield e
+
+        header = _stream_header(dhdu,ddtype)
+        header['bunit'] = fb
+        _write_sections(outfile,header,data_sections(),ddtype)
+
+        header = _stream_header(_error[0] if _error is not None else dhdu,edtype)
+        header['extname'] = 'UNCERT'
+        header['bunit'] = eb
+        header['utype'] = 'StdDevUncertainty'
+        _write_sections(outfile,header,error_sections(),edtype)
+
+        if mask is not None:
+            header = fits.Header([("XTENSION","IMAGE"),("BITPIX",8),("NAXIS",len(dhdu.shape))]
+                                 +[("NAXIS%d"%(i+1),n) for i,n in enumerate(dhdu.shape[::-1])]
+                                 +[("PCOUNT",0),("GCOUNT",1),("EXTNAME","MASK")])
+            _write_sections(outfile,header,(mask[s] for s in sections),np.dtype(np.uint8))
+    finally:
+        _data.close()
+        if _error is not None:
+            _error.close()
+
+_SECTION_SIZE_ = 2**24
+"""Number of bytes of an image written at a time by :meth:`Measurement.make_measurement`"""
+
+def _image_sections(shape,itemsize):
+    """Slices along the first (slowest) axis of an image that divide it into sections of about _SECTION_SIZE_ bytes"""
+    if len(shape) == 0:
+        raise Exception("The FITS file has no image data")
+    rows = max(1,_SECTION_SIZE_//(itemsize*max(1,int(np.prod(shape[1:])))))
+    return [slice(i,min(i+rows,shape[0])) for i in range(0,shape[0],rows)]
+
+def _image_scaling(hdu):
+    """BSCALE and BZERO of an image HDU"""
+    return hdu.header.get("BSCALE",1),hdu.header.get("BZERO",0)
+
+def _image_dtype(hdu):
+    """The data type of the physical values of an image HDU opened with do_not_scale_image_data=True"""
+    bscale,bzero = _image_scaling(hdu)
+    raw = np.dtype(fits.hdu.base.BITPIX2DTYPE[hdu.header["BITPIX"]])
+    if bscale == 1 and bzero == 0:
+        return raw
+    # as astropy.io.fits scales them
+    return np.dtype(np.float32) if raw.itemsize <= 2 else np.dtype(np.float64)
+
+def _image_section(hdu,s):
+    """The physical values of a section of an image HDU opened with do_not_scale_image_data=True"""
+    raw = hdu.data[s]
+    bscale,bzero = _image_scaling(hdu)
+    if bscale == 1 and bzero == 0:
+        return raw
+    data = raw.astype(_image_dtype(hdu))
+    if "BLANK" in hdu.header:
+        data[raw == hdu.header["BLANK"]] = np.nan
+    data *= bscale
+    data += bzero
+    return data
+
+def _stream_header(hdu,dtype):
+    """A copy of the header of an image HDU for writing its physical values with the given data type"""
+    header = hdu.header.copy()
+    if header["BITPIX"] != fits.hdu.base.DTYPE2BITPIX[dtype.name]:
+        header["BITPIX"] = fits.hdu.base.DTYPE2BITPIX[dtype.name]
+        for key in ["BSCALE","BZERO","BLANK"]:
+            header.remove(key,ignore_missing=True)
+    return header
+
+def _write_sections(filename,header,sections,dtype):
+    """Append an image HDU to a FITS file, writing its data one section at a time"""
+    if exists(filename):
+        # an extension
+        header.remove("EXTEND",ignore_missing=True)
+    elif "EXTEND" not in header:
+        header.set("EXTEND",True,after="NAXIS%d"%header["NAXIS"])
+    hdu = fits.StreamingHDU(filename,header)
+    try:
+        for d in sections:
+            hdu.write(np.ascontiguousarray(d,dtype=dtype.newbyteorder('>')))
+    finally:
+        hdu.close()
+
+def _is_memmap(array):
+    """Is the array a view of a memory-mapped file?"""
+    while array is not None:
+        if isinstance(array,(np.memmap,mmap.mmap)):
+            return True
+        array = getattr(array,"base",None)
+    return False
+
 with registry.delay_doc_updates(Measurement):
     registry.register_reader('fits', Measurement, fits_measurement_reader)
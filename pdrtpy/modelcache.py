@@ -0,0 +1,229 @@
+"""Process-wide, size-limited cache of models read from ModelSets"""
+
+import copy
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from .measurement import _is_memmap
+
+DEFAULT_BUDGET = 128*1024*1024
+"""Default memory budget of the model cache in bytes"""
+
+class ModelCache(object):
+    """A thread-safe least-recently-used cache of :class:`~pdrtpy.measurement.Measurement` models with a memory budget.  Entries are keyed by (model path, identifier, unit, file extension).  Only data held in memory count against the budget, not data that are views of memory-mapped files such as model packs.  When adding an entry would exceed the budget, the least recently used entries are evicted.  A budget of zero disables caching.
+
+    The data arrays of cached models are made read-only.  Each lookup returns a shallow copy of the cached model with its own header, which shares the data arrays and the WCS of the cached model, so changing the returned model, e.g., with in-place arithmetic, does not change the cache.
+
+    :param budget: maximum number of bytes of model data to hold. Default: :data:`DEFAULT_BUDGET`
+    :type budget: int
+    """
+    def __init__(self,budget=DEFAULT_BUDGET):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._budget = int(budget)
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def budget(self):
+        """The maximum number of bytes of model data held in this cache.  Setting a smaller budget evicts entries immediately.
+
+        :rtype: int
+        """
+        return self._budget
+
+    @budget.setter
+    def budget(self,value):
+        if value < 0:
+            raise ValueError("Cache budget must be non-negative")
+        with self._lock:
+            self._budget = int(value)
+            self._evict()
+
+    @property
+    def nbytes(self):
+        """The number of bytes of model data currently held in this cache
+
+        :rtype: int
+        """
+        return self._nbytes
+
+    @property
+    def hits(self):
+        """The number of lookups that found a cached model
+
+        :rtype: int
+        """
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of lookups that did not find a cached model
+
+        :rtype: int
+        """
+        return self._misses
+
+    def stats(self):
+        """Summary of the cache state
+
+        :returns: dictionary with keys 'entries', 'nbytes', 'budget', 'hits', and 'misses'
+        :rtype: dict
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "nbytes": self._nbytes,
+                    "budget": self._budget, "hits": self._hits, "misses": self._misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self,key):
+        return key in self._entries
+
+    def get(self,key):
+        """Look up a model in the cache, marking it as most recently used.
+
+        :param key: the cache key
+        :type key: tuple
+        :returns: a copy of the cached model or None if not present
+        """
+        with self._lock:
+            entry = self._entries.get(key,None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return _shallow_copy(entry[0])
+
+    def put(self,key,model):
+        """Add a model to the cache, evicting least recently used models if needed to stay within the budget.  Models larger than the budget are not cached.  The data arrays of the model are made read-only.
+
+        :param key: the cache key
+        :type key: tuple
+        :param model: the model
+        :type model: :class:`~pdrtpy.measurement.Measurement`
+        :returns: a copy of the model as returned by :meth:`get`, or the model itself if it is not cached
+        """
+        size = _sizeof(model)
+        with self._lock:
+            self._remove(key)
+            if self._budget == 0 or size > self._budget:
+                return model
+            for array in _arrays(model):
+                array.flags.writeable = False
+            self._entries[key] = (model,size)
+            self._nbytes += size
+            self._evict()
+        return _shallow_copy(model)
+
+    def invalidate(self,path=None,identifier=None):
+        """Remove entries from the cache.  With no arguments all entries are removed.
+
+        :param path: If given, only remove entries for models from this model path.
+        :type path: str
+        :param identifier: If given, only remove entries for this model identifier.
+        :type identifier: str
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if path is not None and key[0] != path:
+                    continue
+                if identifier is not None and key[1] != identifier:
+                    continue
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._hits = 0
+            self._misses = 0
+
+    def _remove(self,key):
+        entry = self._entries.pop(key,None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def _evict(self):
+        while self._entries and (self._nbytes > self._budget or self._budget == 0):
+            key,entry = self._entries.popitem(last=False)
+            self._nbytes -= entry[1]
+
+def _arrays(model):
+    """The data and uncertainty arrays of a model"""
+    arrays = [getattr(model,"data",None)]
+    uncertainty = getattr(model,"uncertainty",None)
+    if uncertainty is not None:
+        arrays.append(uncertainty.array)
+    return [a for a in arrays if isinstance(a,np.ndarray)]
+
+def _sizeof(model):
+    """The number of bytes of the data of a model held in memory.  Arrays that are views of memory-mapped files are paged in and out by the operating system, so they do not count."""
+    return sum(a.nbytes for a in _arrays(model) if not _is_memmap(a))
+
+def _shallow_copy(model):
+    """A copy of a model that shares its data arrays and WCS, but has its own header"""
+    c = copy.copy(model)
+    c.meta = model.meta.copy()
+    return c
+
+_model_cache = ModelCache()
+
+def model_cache():
+    """The process-wide model cache shared by all :class:`~pdrtpy.modelset.ModelSet` instances.
+
+    :rtype: :class:`ModelCache`
+    """
+    return _model_cache
+
+# Values derived from model data, keyed by the id of the data array and then by name.
+# An entry is removed when its data array is freed, so ids are not reused while in here.
+_memos = dict()
+_memo_lock = threading.Lock()
+
+def memoize(model,name,compute):
+    """A value derived from the data of a model, e.g., its gradient or checksum, computed once for its data array.  The value is shared by all models with the same data array, such as the models returned by the model cache, and kept until the data array is freed.  A model whose data are replaced, e.g., when it is trimmed or copied, gets the value computed again.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :param name: the name of the value, e.g., "gradient"
+    :type name: str or tuple
+    :param compute: function that computes the value from the model
+    :type compute: callable
+    :returns: the value of `compute(model)`
+    """
+    data = model.data
+    key = id(data)
+    with _memo_lock:
+        values = _memos.get(key,None)
+        if values is not None and name in values:
+            return values[name]
+    value = compute(model)
+    with _memo_lock:
+        values = _memos.get(key,None)
+        if values is None:
+            try:
+                weakref.finalize(data,_memos.pop,key,None)
+            except TypeError:
+                # not an array, so it can not be tracked
+                return value
+            values = _memos[key] = dict()
+        # keep the first value if another thread computed it at the same time
+        return values.setdefault(name,value)
+
+def forget(data):
+    """Drop the values memoized for a data array (see :func:`memoize`), e.g., after the array is changed in place, so that they are computed again.
+
+    :param data: the data array of a model
+    :type data: :class:`numpy.ndarray`
+    """
+    with _memo_lock:
+        values = _memos.get(id(data),None)
+        if values is not None:
+            values.clear()
@@ -0,0 +1,136 @@
+"""Nearest-neighbor inverse lookup from observed values to model grid points"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .modelcache import memoize
+
+class ModelIndex(object):
+    r"""A KD-tree over the grid points of a set of models, e.g. line ratios, in :math:`\log_{10}` model space.  Each grid point is the vector of the :math:`\log_{10}` values of all the models at that point, with each model divided by the typical uncertainty of its :math:`\log_{10}` value, so that the distance between an observed vector and a grid point approximates :math:`\sqrt{\chi^2}`.  The grid point nearest to each observed vector gives a first guess of the world coordinates, e.g., density and radiation field, for any number of pixels in one vectorized query.
+
+    Grid points where any model is not positive or not finite are left out of the tree.
+
+    :param models: the models, keyed by identifier, e.g., the result of :meth:`~pdrtpy.modelset.ModelSet.get_models`
+    :type models: dict of :class:`~pdrtpy.measurement.Measurement`
+    :param sigma: the typical uncertainty of :math:`\log_{10}` of each model, in the order of `models`. Default: 1 for all models
+    :type sigma: array-like
+    :raises ValueError: if the models do not have the same axes or there are no grid points where all models are valid
+    """
+    def __init__(self,models,sigma=None):
+        if len(models) == 0:
+            raise ValueError("At least one model is required")
+        self._identifiers = list(models.keys())
+        points = [model_points(m) for m in models.values()]
+        x,y = points[0][2],points[0][3]
+        for p in points[1:]:
+            if p[0].shape != points[0][0].shape or not (np.array_equal(p[2],x) and np.array_equal(p[3],y)):
+                raise ValueError("All models must have the same axes")
+        if sigma is None:
+            sigma = np.ones(len(points))
+        sigma = np.asarray(sigma,dtype=float)
+        if sigma.shape != (len(points),):
+            raise ValueError(f"Expected {len(points)} uncertainties, got {sigma.size}")
+        if np.any(~np.isfinite(sigma) | (sigma <= 0)):
+            raise ValueError("Uncertainties must be positive")
+        valid = np.all([p[1] for p in points],axis=0)
+        if not np.any(valid):
+            raise ValueError("There are no grid points where all models are valid")
+        self._sigma = sigma
+        self._shape = valid.shape
+        self._x = x
+        self._y = y
+        # flat grid indices of the points in the tree
+        self._nodes = np.flatnonzero(valid)
+        logdata = np.array([p[0].ravel()[self._nodes] for p in points])
+        self._tree = cKDTree((logdata/sigma[:,np.newaxis]).T)
+
+    @property
+    def identifiers(self):
+        """The identifiers of the models, in the order expected along the first axis of queried values
+
+        :rtype: list
+        """
+        return self._identifiers
+
+    @property
+    def sigma(self):
+        r"""The typical uncertainty of :math:`\log_{10}` of each model
+
+        :rtype: :class:`numpy.ndarray`
+        """
+        return self._sigma
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def nearest(self,values,log=False):
+        """Find the nearest grid point to each observed vector.
+
+        :param values: the observed values, with shape (number of models,)+shape of the points
+        :type values: array-like
+        :param log: True if the values are logarithmic. Default: False
+        :type log: bool
+        :returns: the indices of the nearest grid points along the second and first model axes, and the weighted distance to them, each with the shape of the points.  Points with values that are not positive or not finite have indices -1 and distance NaN.
+        :rtype: tuple of :class:`numpy.ndarray`
+        """
+        values = np.asarray(values,dtype=float)
+        if values.shape[0] != len(self):
+            raise ValueError(f"Expected {len(self)} values per point, got {values.shape[0]}")
+        shape = values.shape[1:]
+        v = values.reshape(len(self),-1)
+        if not log:
+            with np.errstate(divide='ignore',invalid='ignore'):
+                v = np.log10(v)
+        good = np.all(np.isfinite(v),axis=0)
+        iy = np.full(good.shape,-1)
+        ix = np.full(good.shape,-1)
+        distance = np.full(good.shape,np.nan)
+        if np.any(good):
+            d,i = self._tree.query((v[:,good]/self._sigma[:,np.newaxis]).T)
+            iy[good],ix[good] = np.unravel_index(self._nodes[i],self._shape)
+            distance[good] = d
+        return iy.reshape(shape),ix.reshape(shape),distance.reshape(shape)
+
+    def query(self,values,log=False):
+        """The world coordinates, e.g., density and radiation field, of the nearest grid point to each observed vector.  See :meth:`nearest`.
+
+        :returns: the first and second world coordinates, each with the shape of the points.  Points with values that are not positive or not finite are NaN.
+        :rtype: tuple of :class:`numpy.ndarray`
+        """
+        iy,ix,distance = self.nearest(values,log)
+        return self.coordinates(iy,ix)
+
+    def coordinates(self,iy,ix):
+        """The world coordinates, e.g., density and radiation field, of grid points given by their indices, e.g., as returned by :meth:`nearest`.
+
+        :param iy: the indices along the second model axis
+        :type iy: :class:`numpy.ndarray`
+        :param ix: the indices along the first model axis
+        :type ix: :class:`numpy.ndarray`
+        :returns: the first and second world coordinates, each with the shape of the indices.  Indices of -1 give NaN.
+        :rtype: tuple of :class:`numpy.ndarray`
+        """
+        good = iy >= 0
+        x = np.where(good,self._x[ix],np.nan)
+        y = np.where(good,self._y[iy],np.nan)
+        return x,y
+
+def model_points(model):
+    r""":math:`\log_{10}` of the data of a model on its grid.  Grid points where the model is not positive or not finite are zero.  The result is computed once per model and kept with it.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :returns: the log of the data with shape (second axis,first axis), the mask of valid grid points, and the linear world coordinates of the grid along the first and second axes
+    :rtype: tuple
+    """
+    return memoize(model,"points",_points)
+
+def _points(model):
+    """The log data of a model on its grid, see :func:`model_points`"""
+    data = np.asarray(model.data,dtype=float)
+    data = data.reshape(data.shape[-2:])
+    valid = np.isfinite(data) & (data > 0)
+    logdata = np.log10(np.where(valid,data,1.0))
+    x = np.asarray(model._world_axis_lin[0],dtype=float)
+    y = np.asarray(model._world_axis_lin[1],dtype=float)
+    return (logdata,valid,x,y)
@@ -0,0 +1,392 @@
+"""Packed, memory-mapped storage of the model grids in a ModelSet"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from .measurement import Measurement
+from .modelcache import memoize
+from .pdrutils import _default_permissions,_model_unit
+
+# The layout of a pack file is:
+#
+#    magic (8 bytes) | version (uint32) | index length (uint64) | JSON index | padding | data
+#
+# The data block is a single contiguous little-endian float64 array holding
+# every grid in the pack back to back.  The JSON index gives, for each model
+# identifier, its offset and shape in the data block, which shared axis
+# description it uses, the SHA-256 checksum of its data, its version, and the
+# non-WCS header cards of the original FITS file.  It may also hold tables, e.g. the model
+# table and the precomputed identifier and ratio tables of the ModelSet.
+PACK_MAGIC = b"PDRTPACK"
+# version 4 packs also hold the models whose FITS files have no BUNIT
+PACK_VERSION = 4
+PACK_FILENAME = "models.pack"
+"""Name of a pack file built in a model directory, see :mod:`~pdrtpy.packbuilder`"""
+_PREAMBLE = struct.Struct("<8sIQ")
+_ALIGN = 64
+_DTYPE = np.dtype("<f8")
+
+class ModelPack(object):
+    """A read-only, memory-mapped pack of all the model grids of a :class:`~pdrtpy.modelset.ModelSet`.  The grids are held as one contiguous array on disk, so opening a pack costs one file open and one read of the index regardless of how many models are in it.  Grids returned by :meth:`array` are zero-copy views onto the mapped file.
+
+    :param filename: the pack file to open
+    :type filename: str
+    :raises ValueError: if the file is not a pack file or has an unsupported version
+    """
+    def __init__(self,filename):
+        self._filename = filename
+        with open(filename,"rb") as f:
+            magic,version,nindex = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != PACK_MAGIC:
+                raise ValueError(f"{filename} is not a ModelSet pack file")
+            if version != PACK_VERSION:
+                raise ValueError(f"Unsupported pack version {version} in {filename}. Expected {PACK_VERSION}")
+            self._index = json.loads(f.read(nindex).decode("utf-8"))
+        self._offset = _data_offset(nindex)
+        size = self._index["size"]
+        if size > 0:
+            self._data = np.memmap(filename,dtype=_DTYPE,mode="r",offset=self._offset,shape=(size,))
+        else:
+            self._data = np.empty(0,dtype=_DTYPE)
+        self._axis_headers = [fits.Header(_to_cards(a)) for a in self._index["axes"]]
+        self._tables = dict()
+
+    @property
+    def filename(self):
+        """The name of the pack file
+
+        :rtype: str
+        """
+        return self._filename
+
+    @property
+    def identifiers(self):
+        """The model identifiers in this pack
+
+        :rtype: list
+        """
+        return list(self._index["models"].keys())
+
+    @property
+    def source(self):
+        """Information about the model directory this pack was built from
+
+        :rtype: dict
+        """
+        return self._index["source"]
+
+    @property
+    def naxes(self):
+        """The number of distinct axis descriptions shared by the grids in this pack
+
+        :rtype: int
+        """
+        return len(self._axis_headers)
+
+    def __contains__(self,identifier):
+        return identifier in self._index["models"]
+
+    def __len__(self):
+        return len(self._index["models"])
+
+    def array(self,identifier):
+        """The model grid for the given identifier, as a read-only view onto the mapped file.
+
+        :param identifier: model identifier, e.g., "CII_158/CO_10"
+        :type identifier: str
+        :rtype: :class:`numpy.ndarray`
+        :raises KeyError: if identifier is not in this pack
+        """
+        entry = self._index["models"][identifier]
+        n = int(np.prod(entry["shape"]))
+        start = entry["offset"]
+        return np.asarray(self._data[start:start+n]).reshape(entry["shape"])
+
+    def axis_index(self,identifier):
+        """The index of the axis description used by the grid of the given identifier.  Grids with the same index have identical axes.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: int
+        """
+        return self._index["models"][identifier]["axes"]
+
+    def axis_header(self,identifier):
+        """The WCS keywords shared by the grid of the given identifier.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: :class:`astropy.io.fits.Header`
+        """
+        return self._axis_headers[self.axis_index(identifier)]
+
+    def checksum(self,identifier):
+        """The SHA-256 checksum of the grid of the given identifier, computed when the pack was written.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: str
+        """
+        return self._index["models"][identifier]["sha256"]
+
+    def verify(self,identifier=None):
+        """Check that grids in this pack match their checksums.
+
+        :param identifier: model identifier. If None, check all grids.
+        :type identifier: str
+        :returns: True if the grids match their checksums
+        :rtype: bool
+        """
+        identifiers = self.identifiers if identifier is None else [identifier]
+        return all(data_checksum(self.array(i)) == self.checksum(i) for i in identifiers)
+
+    def version(self,identifier):
+        """The version of the grid of the given identifier, from the VERSION keyword of the original FITS file, or the empty string if it has none.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: str
+        """
+        return self._index["models"][identifier]["version"]
+
+    @property
+    def tablenames(self):
+        """The names of the tables stored in this pack
+
+        :rtype: list
+        """
+        return list(self._index.get("tables",dict()).keys())
+
+    def table(self,name):
+        """A table stored in this pack.  The table is shared by all callers and must not be modified.
+
+        :param name: the table name, one of :attr:`tablenames`
+        :type name: str
+        :returns: the table or None if there is no table with that name
+        :rtype: :class:`astropy.table.Table`
+        """
+        if name not in self._tables:
+            t = self._index.get("tables",dict()).get(name,None)
+            if t is None:
+                return None
+            self._tables[name] = _to_table(t)
+        return self._tables[name]
+
+    def header(self,identifier):
+        """The non-WCS header cards of the grid of the given identifier.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: :class:`astropy.io.fits.Header`
+        """
+        return fits.Header(_to_cards(self._index["models"][identifier]["cards"]))
+
+    def wcs(self,identifier):
+        """A World Coordinate System for the grid of the given identifier.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :rtype: :class:`astropy.wcs.WCS`
+        """
+        return WCS(self.axis_header(identifier))
+
+    def get(self,identifier,unit,title=None):
+        """Create a :class:`~pdrtpy.measurement.Measurement` from the packed grid of the given identifier.  The data of the returned Measurement are a view onto the mapped file and must not be modified in place.
+
+        :param identifier: model identifier
+        :type identifier: str
+        :param unit: the unit of the model
+        :type unit: str or :class:`astropy.units.Unit`
+        :param title: A formatted string describing this model
+        :type title: str
+        :rtype: :class:`~pdrtpy.measurement.Measurement`
+        """
+        return Measurement(self.array(identifier),unit=unit,wcs=self.wcs(identifier),
+                           header=self.header(identifier),title=title,identifier=identifier)
+
+    # ============= Static Methods =============
+    @staticmethod
+    def write(filename,models,source=None,tables=None):
+        """Write models to a pack file.  The file is written to a temporary file first and then moved into place, so concurrent readers never see a partial pack.
+
+        :param filename: the output pack file
+        :type filename: str
+        :param models: the models to pack, keyed by identifier
+        :type models: dict of :class:`~pdrtpy.measurement.Measurement`
+        :param source: information identifying where the models came from, used to decide if the pack is out of date.
+        :type source: dict
+        :param tables: tables to store in the pack, keyed by name
+        :type tables: dict of :class:`astropy.table.Table`
+        """
+        axes = list()
+        entries = dict()
+        offset = 0
+        for identifier,m in models.items():
+            ah = _axis_cards(m)
+            if ah not in axes:
+                axes.append(ah)
+            cards = [[c.keyword,_card_value(c.value),c.comment] for c in m.header.cards]
+            entries[identifier] = {"offset": offset,
+                                   "shape": list(m.data.shape),
+                                   "axes": axes.index(ah),
+                                   "sha256": data_checksum(m.data),
+                                   "version": grid_version(m),
+                                   "file": os.path.basename(m.filename or ""),
+                                   "cards": cards}
+            offset += m.data.size
+        index = {"source": source or dict(),
+                 "size": offset,
+                 "axes": axes,
+                 "models": entries}
+        if tables:
+            index["tables"] = {name:_from_table(t) for name,t in tables.items()}
+        blob = json.dumps(index).encode("utf-8")
+        dirname = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(dirname,exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=dirname,suffix=".tmp")
+        try:
+            with os.fdopen(fd,"wb") as f:
+                f.write(_PREAMBLE.pack(PACK_MAGIC,PACK_VERSION,len(blob)))
+                f.write(blob)
+                f.write(b"\0"*(_data_offset(len(blob))-_PREAMBLE.size-len(blob)))
+                for m in models.values():
+                    f.write(np.ascontiguousarray(m.data,dtype=_DTYPE).tobytes())
+            # packs built into a shared model directory are read by other users.
+            _default_permissions(tmp)
+            os.replace(tmp,filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @staticmethod
+    def build(filename,directory,table,ext="fits",source=None,tables=None):
+        """Build a pack file from a directory of model FITS files.
+
+        :param filename: the output pack file
+        :type filename: str
+        :param directory: the directory containing the model FITS files, including trailing slash
+        :type directory: str
+        :param table: the table describing the models, with columns "ratio" and "filename" as in a ModelSet `models.tab`
+        :type table: :class:`astropy.table.Table`
+        :param ext: file extension of the model files. Default: "fits"
+        :type ext: str
+        :param source: see :meth:`write`
+        :type source: dict
+        :param tables: see :meth:`write`
+        :type tables: dict of :class:`astropy.table.Table`
+        :returns: the opened pack
+        :rtype: :class:`ModelPack`
+        """
+        models = dict()
+        for identifier,fname in zip(table["ratio"],table["filename"]):
+            thefile = directory+fname+"."+ext
+            if not os.path.exists(thefile):
+                continue
+            try:
+                # models without BUNIT are read with the unit ModelSet.get_model gives them
+                unit = _model_unit(str(identifier))[0]
+                models[str(identifier)] = Measurement.read(thefile,unit=unit,identifier=str(identifier))
+            except (OSError,ValueError) as e:
+                # leave it out of the pack; reading it directly will raise the error again.
+                warnings.warn(f"ModelPack: Leaving {thefile} out of {filename}: {e}",stacklevel=2)
+        ModelPack.write(filename,models,source,tables)
+        return ModelPack(filename)
+
+def _data_offset(nindex):
+    n = _PREAMBLE.size + nindex
+    return n + (-n % _ALIGN)
+
+def _axis_cards(m):
+    h = m.wcs.to_header()
+    # to_header() rounds the values, keep them at full precision.
+    for i in range(m.wcs.wcs.naxis):
+        for key in ["crval","cdelt","crpix"]:
+            h[f"{key.upper()}{i+1}"] = float(getattr(m.wcs.wcs,key)[i])
+    cards = [["NAXIS",m.data.ndim,""]]
+    for i,n in enumerate(m.data.shape[::-1]):
+        cards.append([f"NAXIS{i+1}",n,""])
+    cards.extend([c.keyword,_card_value(c.value),c.comment] for c in h.cards)
+    return cards
+
+def _card_value(value):
+    if isinstance(value,fits.card.Undefined):
+        return None
+    if isinstance(value,np.generic):
+        return value.item()
+    return value
+
+def _to_cards(cards):
+    return [tuple(c) for c in cards]
+
+def file_checksum(filename):
+    """The SHA-256 checksum of the contents of a file, e.g., the model table a pack was built from.
+
+    :param filename: the file
+    :type filename: str
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda: f.read(1<<20),b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def data_checksum(data):
+    """The SHA-256 checksum of model data as stored in a pack.  Data of any float type give the same checksum as the same values stored in a pack.
+
+    :param data: the model data
+    :type data: :class:`numpy.ndarray`
+    :rtype: str
+    """
+    return hashlib.sha256(np.ascontiguousarray(data,dtype=_DTYPE).tobytes()).hexdigest()
+
+def model_data_checksum(model):
+    """The SHA-256 checksum of the data of a model, see :func:`data_checksum`.  Models loaded from a pack by a :class:`~pdrtpy.modelset.ModelSet` carry the checksum recorded when the pack was built.  Otherwise it is computed once per model and kept with it.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :rtype: str
+    """
+    return memoize(model,"checksum",lambda m: data_checksum(m.data))
+
+def grid_version(model):
+    """The version of a model grid, from the VERSION keyword of its header.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :returns: the version or the empty string if the header has no VERSION keyword
+    :rtype: str
+    """
+    version = model.header.get("VERSION","")
+    if isinstance(version,float) and version.is_integer():
+        version = int(version)
+    return str(version)
+
+def _from_table(table):
+    """A JSON serializable description of a table of strings and numbers"""
+    rows = [[None if v is np.ma.masked else _card_value(v) for v in row] for row in table.iterrows()]
+    return {"names": table.colnames, "rows": rows}
+
+def _to_table(t):
+    """The table described by :func:`_from_table`"""
+    if len(t["rows"]) == 0:
+        return Table(names=t["names"],dtype=[str]*len(t["names"]))
+    columns = list()
+    for i in range(len(t["names"])):
+        values = [row[i] for row in t["rows"]]
+        if any(v is None for v in values):
+            fill = type(next((v for v in values if v is not None),0.0))()
+            columns.append(np.ma.masked_array([fill if v is None else v for v in values],mask=[v is None for v in values]))
+        else:
+            columns.append(values)
+    return Table(columns,names=t["names"])
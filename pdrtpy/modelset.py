@@ -2,12 +2,81 @@
 
 import itertools
 import collections
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from astropy.io import fits
 from astropy.table import Table, Column, unique, vstack
 import astropy.units as u
-from .pdrutils import get_table,model_dir, _OBS_UNIT_
+from .pdrutils import get_table,get_xy_from_wcs,model_dir,model_file,model_archive,cache_dir,_safe_path,_tablename,warn,comment,habing_unit,draine_unit,_MODEL_UNIT_,_model_unit
 from .measurement import Measurement
+from .modelpack import ModelPack, PACK_FILENAME, file_checksum, model_data_checksum, grid_version
+from .modelcache import model_cache, memoize
+from .modelsurrogate import ModelSurrogate, upsample_model
+from .modelindex import ModelIndex
+
+class ModelAxes(object):
+    """The density and radiation field axes of model grids.  All grids in a :class:`ModelSet` that have the same axes share one ModelAxes, so the WCS is built, its units fixed up, and its world coordinates computed only once.
+
+    :param wcs: the World Coordinate System of the grids.  It is shared by all models using these axes and must not be modified.
+    :type wcs: :class:`astropy.wcs.WCS`
+    :param cards: header cards describing the axis units, e.g. {"CUNIT1":"cm^-3","CUNIT2":"Habing"}
+    :type cards: dict
+    """
+    def __init__(self,wcs,cards):
+        self._wcs = wcs
+        self._cards = dict(cards)
+        self._world_axis = None
+        self._world_axis_lin = None
+
+    @property
+    def wcs(self):
+        """The World Coordinate System of the grids
+
+        :rtype: :class:`astropy.wcs.WCS`
+        """
+        return self._wcs
+
+    @property
+    def cards(self):
+        """The header cards describing the axis units
+
+        :rtype: dict
+        """
+        return self._cards
+
+    @property
+    def header(self):
+        """The header cards describing the axis units as a FITS header
+
+        :rtype: :class:`astropy.io.fits.Header`
+        """
+        return fits.Header(list(self._cards.items()))
+
+    @property
+    def world_axis(self):
+        """The world coordinates of the pixel centers along each axis, in log space. See :func:`~pdrtpy.pdrutils.get_xy_from_wcs`.
+
+        :rtype: list of :class:`numpy.ndarray`
+        """
+        if self._world_axis is None:
+            self._world_axis = get_xy_from_wcs(self,quantity=False,linear=False)
+        return self._world_axis
+
+    @property
+    def world_axis_lin(self):
+        """The world coordinates of the pixel centers along each axis, in linear space. See :func:`~pdrtpy.pdrutils.get_xy_from_wcs`.
+
+        :rtype: list of :class:`numpy.ndarray`
+        """
+        if self._world_axis_lin is None:
+            self._world_axis_lin = get_xy_from_wcs(self,quantity=False,linear=True)
+        return self._world_axis_lin
 
 class ModelSet(object):
     """Class for computed PDR Model Sets. :class:`ModelSet` provides interface to a directory containing the model FITS files and the ability to query details about.
@@ -34,60 +103,43 @@ class ModelSet(object):
     #@ToDo replace with kwargs?
     def __init__(self,name,z,medium="constant density",mass=None,modelsetinfo=None,format='ipac'):
         if modelsetinfo is None:
-            #get the package default
-            self._all_models = get_table("all_models.tab")
-        elif type(modelsetinfo) is str:
-            self._all_models = Table.read(modelsetinfo,format=format)
-        else: # must be an Astropy Table
-            self._all_models = deepcopy(modelsetinfo)
-        self._all_models.add_index("name")
-        possible = dict()
-        if name not in self._all_models["name"]:
-            raise ValueError(f'Unrecognized model {name:s}. Choices  are: {list(self._all_models["name"])}')
-        if np.all(self._all_models.loc[name]["mass"].mask):
-            matching_rows = np.where((self._all_models["z"]==z) &
-                                 (self._all_models["medium"]==medium))
-            possible["mass"] = None
+            #get the package default, parsed once and shared by all ModelSets
+            all_models = _catalog("all_models.tab")
+            key = (name,z,medium,mass)
+            try:
+                entry = _tabrows.get(key,None)
+                if entry is None or entry[0] is not all_models:
+                    entry = _tabrows[key] = (all_models,_find_tabrow(all_models,name,z,medium,mass))
+                self._tabrow = entry[1]
+            except TypeError:
+                # unhashable parameters, e.g. masked mass values from a Table
+                self._tabrow = _find_tabrow(all_models,name,z,medium,mass)
         else:
-            matching_rows = np.where((self._all_models["z"]==z) &
-                     (self._all_models["medium"]==medium) &
-                     (self._all_models["mass"] == mass))
-            possible["mass"] = self._all_models.loc[name]["mass"]
-        for key in ["z", "medium"]:
-            possible[key]=  self._all_models.loc[name][key]
-        # ugh, possible[] resulting from above can be a Python native or a Column.
-        # If only one row matches it will be a native, otherwise it will be a Column,
-        # so we have to check if it is a Column or not, so that we can successfully
-        # import numberscreate a numpy array.
-        for i in possible:
-            if possible[i] is None:
-                continue
-            if isinstance(possible[i],Column):
-                # convert Column to np.array
-                possible[i] = sorted(set(np.array(possible[i])))
-            else:
-                # convert native to np.array
-                possible[i] = sorted(set(np.array([possible[i]])))
-
-        #print("possible:",possible)
-        if mass is None and possible['mass'] is not None:
-            raise ValueError(f'mass value is required for model {name:s}. Allowed values are {possible["mass"]}')
-        if matching_rows[0].size == 0:
-            msg = f"Requested ModelSet not found in {name:s}. Check your input values.  Allowed z are {possible['z']}.  Allowed medium are {possible['medium']}."
-            if possible['mass'] is not None:
-                msg = msg + f" Allowed mass are {possible['mass']}."
-            raise ValueError(msg)
-
-        self._tabrow = self._all_models[matching_rows].loc[name]
-        self._table = get_table(path=self._tabrow["path"],filename=self._tabrow["filename"],format=format)
-        self._table.add_index("ratio")
-        self._set_identifiers()
-        self._set_ratios()
-        self._default_unit = dict()
-        self._default_unit["ratio"] = u.dimensionless_unscaled
-        self._default_unit["intensity"] = _OBS_UNIT_
-        self._default_unit["emissivity"] = "erg / (cm3 ion s)"
+            if type(modelsetinfo) is str:
+                all_models = Table.read(modelsetinfo,format=format)
+            else: # must be an Astropy Table
+                all_models = deepcopy(modelsetinfo)
+            all_models.add_index("name")
+            self._tabrow = _find_tabrow(all_models,name,z,medium,mass)
+        # The model table is read on first use and shared with other ModelSets until add_model() changes it.
+        self._catalog_key = (self._tabrow["path"],self._tabrow["filename"],format)
+        self._table = None
+        self._table_shared = True
+        self._ratio_index = None
+        self._identifiers = None
+        self._supported_ratios = None
+        self._supported_lines = None
+        self._default_unit = dict(_MODEL_UNIT_)
         self._user_added_models = dict()
+        self._reference = None
+        self._pack = None
+        self._pack_checked = False
+        self._prebuilt = None
+        self._prebuilt_checked = False
+        self._load_times = dict()
+        self._axes = dict()
+        self._surrogates = dict()
+        self._indexes = dict()
 
     @property
     def description(self):
@@ -151,6 +203,9 @@ class ModelSet(object):
 
         :rtype: :class:`astropy.table.Table`
         """
+        if self._table is None:
+            path,filename,format = self._catalog_key
+            self._table = _catalog(filename,path=path,format=format,pack=self._prebuilt_pack())
         return self._table
 
     @property
@@ -159,6 +214,8 @@ class ModelSet(object):
 
         :rtype: :class:`astropy.table.Table`
         """
+        if self._identifiers is None:
+            self._set_identifiers()
         return self._identifiers
 
     @property
@@ -168,6 +225,8 @@ class ModelSet(object):
 
         :rtype: :class:`astropy.table.Table`
         """
+        if self._supported_lines is None:
+            self._set_ratios()
         return self._supported_lines
 
     @property
@@ -176,6 +235,8 @@ class ModelSet(object):
 
         :rtype: :class:`astropy.table.Table`
         """
+        if self._supported_ratios is None:
+            self._set_ratios()
         return self._supported_ratios
 
     @property
@@ -207,12 +268,9 @@ class ModelSet(object):
         if not isinstance(m, collections.abc.Iterable) or isinstance(m, (str, bytes)) :
             raise Exception("m must be an array of strings")
 
-        for q in itertools.product(m,m):
-            if q[0] == "FIR" and (q[1] == "OI_145" or q[1] == "OI_63") and "CII_158" in m:
-                s = q[1] + "+CII_158/" + q[0]
-            else:
-                s = q[0]+"/"+q[1]
-            if s in self.table["ratio"]:
+        index = self._get_ratio_index()
+        for s in self._candidate_ratios(m):
+            if s in index:
                 yield s
 
     def find_files(self,m,ext="fits"):
@@ -227,19 +285,29 @@ class ModelSet(object):
         """
         if not isinstance(m, collections.abc.Iterable) or isinstance(m, (str, bytes)):
             raise Exception("m must be an array of strings")
+        index = self._get_ratio_index()
+        for s in self._candidate_ratios(m):
+            if s in index:
+                fullpath = self._tabrow["path"]+index[s]["filename"]+"."+ext
+                tup = (s,fullpath)
+                yield tup
+
+    def _candidate_ratios(self,m):
+        """All the ratio labels that could be formed from a list of measurement IDs, in the order of :func:`itertools.product`, including the OI+CII/FIR special case.
+
+        :param m: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g. ["CII_158","OI_145","FIR"]
+        :type m: list
+        :rtype: iterator
+        """
+        m = list(m)
+        has_cii = "CII_158" in m
         for q in itertools.product(m,m):
             # must deal with OI+CII/FIR models. Note we must check for FIR first, since
             # if you check q has OI,CII and m has FIR order you'll miss OI/CII.
-            if q[0] == "FIR" and (q[1] == "OI_145" or q[1] == "OI_63") and "CII_158" in m:
-                #print("SPECIAL doing %s %s"%(q[0],q[1]))
-                s = q[1] + "+CII_158/" + q[0]
+            if has_cii and q[0] == "FIR" and (q[1] == "OI_145" or q[1] == "OI_63"):
+                yield q[1] + "+CII_158/" + q[0]
             else:
-                #print("doing %s %s"%(q[0],q[1]))
-                s = q[0]+"/"+q[1]
-            if s in self.table["ratio"]:
-                fullpath = self._tabrow["path"]+self.table.loc[s]["filename"]+"."+ext
-                tup = (s,fullpath)
-                yield tup
+                yield q[0]+"/"+q[1]
 
     def model_ratios(self,m):
         '''Return the model ratios that match the input Measurement ID list.  You must provide at least 2 Measurements IDs
@@ -266,14 +334,14 @@ class ModelSet(object):
         :rtype: list
         '''
         # get intersection of input list and supported lines
-        return list(set(m) & set(self._supported_lines["intensity label"]))
+        return list(set(m) & set(self.supported_intensities["intensity label"]))
 
     def get_model(self,identifier,unit=None,ext="fits"):
         '''Get a specific model by its identifier
 
         :param identifier: a :class:`~pdrtpy.measurement.Measurement` ID. It can be an intensity or a ratio, e.g., "CII_158","CI_609/FIR".
         :type identifier: str
-        :returns: The model matching the identifier
+        :returns: The model matching the identifier.  Models are kept in a process-wide cache (see :meth:`model_cache`).  Each call returns a new Measurement that shares the read-only data arrays of the cached model.
         :rtype: :class:`~pdrtpy.measurement.Measurement`
         :raises: KeyError if identifier not found in this ModelSet
         '''
@@ -281,48 +349,184 @@ class ModelSet(object):
         if identifier in self._user_added_models:
             return self._user_added_models[identifier]
 
-        if identifier not in self.table["ratio"]:
+        index = self._get_ratio_index()
+        if identifier not in index:
             raise KeyError(f"{identifier} is not in this ModelSet")
-        _filename = self.table.loc[identifier]["filename"] +"."+ext
+        _filename = index[identifier]["filename"] +"."+ext
         d = model_dir()
         _thefile = d+self._tabrow["path"] + _filename
-        _title = self._table.loc[identifier]['title']
-        # @TODO Fix this: see issues 66 & 67
+        _title = index[identifier]['title']
         if unit is None or unit == "":
-            if identifier == "TS":
-                #print("Setting unit to K")
-                unit = "K"
-                modeltype = "intensity" #??'temperature'
             # make a guess at the unit
-            elif '/' in identifier:
-                unit = self._default_unit["ratio"]
-                modeltype = "ratio"
-            else:
-                unit = self._default_unit['intensity']
-                modeltype = "intensity" #this is wrong for emissivity modeltypes
+            unit,modeltype = _model_unit(identifier,self._default_unit)
         else:
             if unit == u.dimensionless_unscaled:
                 modeltype = "ratio"
             else:
                 modeltype = "intensity"
         #print("Unit = ",unit)
-        _model = Measurement.read(_thefile,title=_title,unit=unit,identifier=identifier)
-        #if _model.unit=="":
-        #    _model.unit = u.Unit("adu")#self._default_unit["ratio"]
-        _wcs = _model.wcs
+        key = self._cache_key(identifier,unit,ext)
+        _model = model_cache().get(key)
+        if _model is not None:
+            return _model
+        pack = self._get_pack() if ext == "fits" else None
+        if pack is not None and identifier in pack:
+            # all grids with the same axes share one WCS and one set of world axis values.
+            axes = self._get_axes(("pack",pack.axis_index(identifier)),lambda: pack.wcs(identifier))
+            _model = Measurement(pack.array(identifier),unit=unit,header=pack.header(identifier),
+                                 title=_title,identifier=identifier)
+            _model.wcs = axes.wcs
+            _model._set_up_for_interp(world_axis=axes.world_axis,world_axis_lin=axes.world_axis_lin)
+            _model._filename = _thefile
+            # the checksum computed when the pack was built
+            memoize(_model,"checksum",lambda m: pack.checksum(identifier))
+        else:
+            # extracts the file if this ModelSet is distributed as an archive.
+            _thefile = model_file(self._tabrow["path"],_filename)
+            _model = Measurement.read(_thefile,title=_title,unit=unit,identifier=identifier)
+            axes = self._get_axes(("fits",_model.wcs.to_header_string(),_model.data.shape),lambda: _model.wcs)
+            # CCDData does not allow replacing a WCS through the property.
+            _model._wcs = axes.wcs
         if "MODELTYP" not in _model.header:
             _model.header["MODELTYP"] = modeltype
         _model.modeltype = modeltype
-        #@todo this is messy.  clean up by doing if wcs.. first?
+        _model.header.update(axes.cards)
+        return model_cache().put(key,_model)
+
+    def get_gradient(self,identifier,unit=None,ext="fits"):
+        r"""Get the derivatives of a model with respect to its axes, e.g., :math:`\partial R/\partial \log n` and :math:`\partial R/\partial \log G_0`.  See :func:`model_gradient`.
+
+        :param identifier: a :class:`~pdrtpy.measurement.Measurement` ID. It can be an intensity or a ratio, e.g., "CII_158","CI_609/FIR".
+        :type identifier: str
+        :returns: The derivative grids along the first (density) and second (radiation field) world axes.
+        :rtype: tuple of :class:`numpy.ndarray`
+        :raises: KeyError if identifier not found in this ModelSet
+        """
+        return model_gradient(self.get_model(identifier,unit=unit,ext=ext))
+
+    def get_surrogate(self,identifiers,model_type="ratio"):
+        """Get a smooth bicubic spline surrogate of the models that match the input list of identifiers, which evaluates all of them at once at any number of points.  The surrogate is built once and kept for later calls with the same identifiers.  See :class:`~pdrtpy.modelsurrogate.ModelSurrogate`.
+
+        :param identifiers: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g., ["CII_158","OI_145","CS_21"]
+        :type identifiers: list
+        :param model_type: indicates which type of model is requested one of 'ratio', 'intensity', or 'both'
+        :type model_type: str
+        :rtype: :class:`~pdrtpy.modelsurrogate.ModelSurrogate`
+        """
+        models = self.get_models(identifiers,model_type=model_type)
+        key = (tuple(models.keys()),tuple(model_data_checksum(m) for m in models.values()))
+        if key not in self._surrogates:
+            self._surrogates[key] = ModelSurrogate(models)
+        return self._surrogates[key]
+
+    def get_upsampled_models(self,identifiers,oversample,model_type="ratio",directory=None):
+        """Get the models that match the input list of identifiers on grids `oversample` times finer along each axis, interpolated in log space.  For example, `oversample=10` refines the 0.125 dex grid spacing of the wk2020 models to 0.0125 dex.  The upsampled grids are kept in memory with the models and saved in `directory`, so they are computed once for all sessions.  See :func:`~pdrtpy.modelsurrogate.upsample_model`.
+
+        :param identifiers: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g., ["CII_158","OI_145","CS_21"]
+        :type identifiers: list
+        :param oversample: the number of new grid cells per original grid cell along each axis
+        :type oversample: int
+        :param model_type: indicates which type of model is requested one of 'ratio', 'intensity', or 'both'
+        :type model_type: str
+        :param directory: the directory in which to save and look up the upsampled grids, or False to keep them in memory only. Default: None, meaning `upsampled` in the user cache directory (see :func:`~pdrtpy.pdrutils.cache_dir`)
+        :type directory: str or bool
+        :returns: The upsampled models, keyed by identifier
+        :rtype: dict of :class:`~pdrtpy.measurement.Measurement`
+        """
+        models = self.get_models(identifiers,model_type=model_type)
+        return {k:upsample_model(m,oversample,directory) for k,m in models.items()}
+
+    def get_clipped_models(self,identifiers,nax1_clip=None,nax2_clip=None,model_type="ratio"):
+        """Get the models that match the input list of identifiers, restricted to ranges of density and radiation field, or whatever the model axes are.  The restricted models are views onto the model grids, not copies.  See :func:`clip_models`.
+
+        :param identifiers: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g., ["CII_158","OI_145","CS_21"]
+        :type identifiers: list
+        :param nax1_clip: The range of values on NAXIS1, e.g., [1E3,1E5]*Unit("cm-3"). Default: None, meaning the whole axis
+        :type nax1_clip: array-like, may contain :class:`~astropy.units.Quantity`
+        :param nax2_clip: The range of values on NAXIS2, e.g., [10,1E4]*utils.habing_unit. Default: None, meaning the whole axis
+        :type nax2_clip: array-like, may contain :class:`~astropy.units.Quantity`
+        :param model_type: indicates which type of model is requested one of 'ratio', 'intensity', or 'both'
+        :type model_type: str
+        :returns: The restricted models, keyed by identifier
+        :rtype: dict of :class:`~pdrtpy.measurement.Measurement`
+        :raises ValueError: if a range does not overlap the axis of a model
+        """
+        return clip_models(self.get_models(identifiers,model_type=model_type),nax1_clip,nax2_clip)
+
+    def get_index(self,identifiers,sigma=None,model_type="ratio"):
+        """Get a KD-tree index over the grid points of the models that match the input list of identifiers, which finds the model grid point nearest to any number of observed vectors in one query.  The index is built once and kept for later calls with the same identifiers and uncertainties.  See :class:`~pdrtpy.modelindex.ModelIndex`.
+
+        :param identifiers: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g., ["CII_158/OI_145","CII_158/CO_10"]
+        :type identifiers: list
+        :param sigma: the typical uncertainty of :math:`\\log_{10}` of each model, in the order of `identifiers`. Default: 1 for all models
+        :type sigma: array-like
+        :param model_type: indicates which type of model is requested one of 'ratio', 'intensity', or 'both'
+        :type model_type: str
+        :rtype: :class:`~pdrtpy.modelindex.ModelIndex`
+        """
+        models = self.get_models(identifiers,model_type=model_type)
+        key = (tuple(models.keys()),tuple(model_data_checksum(m) for m in models.values()),
+               None if sigma is None else tuple(np.asarray(sigma,dtype=float)))
+        if key not in self._indexes:
+            self._indexes[key] = ModelIndex(models,sigma)
+        return self._indexes[key]
+
+    def checksum(self,identifier):
+        """The SHA-256 checksum of the data of a model in this ModelSet.  For models in the model pack it is the checksum recorded when the pack was built, so the model is not read.  For models added with :meth:`add_model` it is computed when they are added.  It changes exactly when the model data change, so it can be used to key anything derived from the model.  See :func:`~pdrtpy.modelpack.data_checksum`.
+
+        :param identifier: a :class:`~pdrtpy.measurement.Measurement` ID, e.g., "CII_158/CO_10"
+        :type identifier: str
+        :rtype: str
+        :raises: KeyError if identifier not found in this ModelSet
+        """
+        return self.stamp(identifier)[1]
+
+    def stamp(self,identifier):
+        """The version and checksum of a model in this ModelSet.  The version is the version of this ModelSet, followed by the version of the model grid if its FITS header has one, or "user" for models added with :meth:`add_model`.  See :meth:`checksum`.
+
+        :param identifier: a :class:`~pdrtpy.measurement.Measurement` ID, e.g., "CII_158/CO_10"
+        :type identifier: str
+        :returns: the version and the checksum
+        :rtype: tuple of str
+        :raises: KeyError if identifier not found in this ModelSet
+        """
+        if identifier in self._user_added_models:
+            return ("user",model_data_checksum(self._user_added_models[identifier]))
+        pack = self._get_pack()
+        if pack is not None and identifier in pack:
+            version,checksum = pack.version(identifier),pack.checksum(identifier)
+        else:
+            model = self.get_model(identifier)
+            version,checksum = grid_version(model),model_data_checksum(model)
+        return (str(self.version)+("/"+version if version else ""),checksum)
+
+    def _get_axes(self,key,make_wcs):
+        """The shared :class:`ModelAxes` for grids with the given axis key, created from the WCS returned by `make_wcs` the first time the key is seen."""
+        axes = self._axes.get(key,None)
+        if axes is None:
+            wcs = make_wcs()
+            # setdefault so that concurrent loaders agree on one instance
+            axes = self._axes.setdefault(key,ModelAxes(wcs,self._axis_unit_cards(wcs)))
+        return axes
+
+    def _axis_unit_cards(self,_wcs):
+        """Fix up the axis units of a model WCS for the quirks of this ModelSet.
+
+        :param _wcs: the model WCS, which is modified in place
+        :type _wcs: :class:`astropy.wcs.WCS`
+        :returns: the CUNIT header cards that describe the model axes
+        :rtype: dict
+        """
+        cards = dict()
         if self.is_wk2006 or self.name == "smc":
         # fix WK2006 model headerslisthd
             if _wcs.wcs.cunit[0] == "":
-                _model.header["CUNIT1"] = "cm^-3"
+                cards["CUNIT1"] = "cm^-3"
                 _wcs.wcs.cunit[0] = u.Unit("cm^-3")
             else:
-                _model.header["CUNIT1"] = str(_wcs.wcs.cunit[0])
+                cards["CUNIT1"] = str(_wcs.wcs.cunit[0])
             if _wcs.wcs.cunit[1] == "":
-                _model.header["CUNIT2"] = "Habing"
+                cards["CUNIT2"] = "Habing"
                 # Raises UnitScaleError:
                 # "The FITS unit format is not able to represent scales that are not powers of 10.  Multiply your data by 1.600000e-03."
                 # This causes all sorts of downstream problems.  Workaround in LineRatioFit.read_models().
@@ -330,28 +534,33 @@ class ModelSet(object):
         elif self.code == "KOSMA-tau":
         # fix KosmaTau model headers
             if _wcs.wcs.cunit[0] == "":
-                _model.header["CUNIT1"] = "cm^-3"
+                cards["CUNIT1"] = "cm^-3"
                 _wcs.wcs.cunit[0] = u.Unit("cm^-3")
             else:
-                _model.header["CUNIT1"] = str(_wcs.wcs.cunit[0])
+                cards["CUNIT1"] = str(_wcs.wcs.cunit[0])
             if _wcs.wcs.cunit[1] == "":
-                _model.header["CUNIT2"] = "Draine"
+                cards["CUNIT2"] = "Draine"
             else:
-                _model.header["CUNIT2"] = str(_wcs.wcs.cunit[1])
+                cards["CUNIT2"] = str(_wcs.wcs.cunit[1])
         else:
             # copy wcs cunit to header. used later.
-            _model.header["CUNIT1"] = str(_wcs.wcs.cunit[0])
-            _model.header["CUNIT2"] = str(_wcs.wcs.cunit[1])
+            cards["CUNIT1"] = str(_wcs.wcs.cunit[0])
+            cards["CUNIT2"] = str(_wcs.wcs.cunit[1])
+        return cards
 
-        return _model
+    def _cache_key(self,identifier,unit,ext):
+        """The key for a model from this ModelSet in the process-wide model cache"""
+        return (model_dir()+self._tabrow["path"],identifier,str(u.Unit(unit)),ext)
 
-    def get_models(self,identifiers,model_type="ratio",ext="fits"):
-        '''get the models from thie ModelSet that match the input list of identifiers
+    def get_models(self,identifiers,model_type="ratio",ext="fits",max_workers=None):
+        '''get the models from thie ModelSet that match the input list of identifiers. Models that are not already in the model cache are loaded concurrently on a thread pool. The time taken to load each model is available afterwards in :attr:`load_times`.
 
         :param identifiers: list of string :class:`~pdrtpy.measurement.Measurement` IDs, e.g., ["CII_158","OI_145","CS_21"]
         :type identifiers: list
         :param model_type: indicates which type of model is requested one of 'ratio' or 'intensity'
         :type model_type: str
+        :param max_workers: maximum number of threads used to load models. Default: None, meaning one per CPU up to the number of models. Use 1 to load models one after another.
+        :type max_workers: int
         :returns: The matching models as a list of :class:`~pdrtpy.measurement.Measurement`.
         :rtype: list
         :raises: KeyError if identifiers not found in this ModelSet
@@ -363,8 +572,6 @@ class ModelSet(object):
             raise ValueError("Unrecognized model_type: must be one of 'intensity', 'ratio', or 'both'")
         models=dict()
         a = list()
-        self._table.remove_indices('ratio')
-        self._table.add_index('ratio')
         if model_type == "intensity" or model_type == "both":
             a.extend(self.model_intensities(identifiers))
         if model_type == "ratio" or model_type == "both":
@@ -374,63 +581,267 @@ class ModelSet(object):
             _unit = self._default_unit[model_type]
         else:
             _unit = None
+        units = dict()
         for k in a:
             if k == "TS": 
                 #kluge. we need to support model_type = "temperature"
-                models[k] = self.get_model(k,unit="K",ext=ext)
+                units[k] = "K"
             else:
-                models[k] = self.get_model(k,unit=_unit,ext=ext)
-
+                units[k] = _unit
+
+        def load(k):
+            start = time.perf_counter()
+            model = self.get_model(k,unit=units[k],ext=ext)
+            return model,time.perf_counter()-start
+
+        if max_workers is None:
+            max_workers = min(len(a),os.cpu_count() or 1)
+        if ext == "fits":
+            # open or build the pack before starting threads that share it.
+            self._get_pack()
+        self._load_times = dict()
+        if max_workers > 1 and len(a) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(load,a))
+        else:
+            results = [load(k) for k in a]
+        for k,(model,dt) in zip(a,results):
+            models[k] = model
+            self._load_times[k] = dt
         return models
 
+    @property
+    def load_times(self):
+        """The time in seconds taken to load each model in the most recent call to :meth:`get_models`, keyed by identifier. Models found in the model cache take close to zero time.
+
+        :rtype: dict
+        """
+        return self._load_times
+
     def add_model(self,identifier,model,title,overwrite=False):
-        r"""Add your own model to this ModelSet.
+        r"""Add your own model to this ModelSet.  The model is checked against the grid of the ModelSet when it is added.  If its grid points differ from those of the ModelSet, it is resampled once onto the ModelSet grid by linear interpolation in log space, and the resampled model is kept.  Points of the ModelSet grid outside the model grid are NaN.
 
         :param identifier: a :class:`~pdrtpy.measurement.Measurement` ID. It can be an intensity or a ratio, e.g., "CII_158","CI_609/FIR".
         :type identifier: str
-        :param model:  the model to add.  If a string, this must be the fully-qualified path of a FITS file.  If a :class:`~pdrtpy.measurement.Measurement` it must have the same CTYPEs and CUNITs as the models in the ModelSet(?).
+        :param model:  the model to add.  If a string, this must be the fully-qualified path of a FITS file.  If a :class:`~pdrtpy.measurement.Measurement` it must have the same CTYPEs as the models in the ModelSet and CUNITs that can be converted to theirs.
         :type model: str or :class:`~pdrtpy.measurement.Measurement`
         :param title: A formatted string (e.g., LaTeX) describing this observation that can be used for plotting. Python r-strings are accepted, e.g., r'$^{13}$CO(3-2)'  would give :math:`^{13}{\rm CO(3-2)}`.
-    :type title: str
+        :type title: str
         :param overwrite:  Whether to overwrite the model if the identifier already exists in the ModelSet or has been previously added.  Default: False
         :type overwrite: bool
+        :raises ValueError: if the model has no world coordinate system, its axes do not match those of the ModelSet, or it does not overlap the ModelSet grid.
         """
-        if identifier not in self.table["ratio"] and identifier not in self._user_added_models:
-            self._really_add_model(identifier,model,title)
-        elif identifier in self._user_added_models and not overwrite:
-            raise Exception(f"{identifier} was previously added to this ModelSet. If you wish to overwrite it, use overwrite=True")
-        elif identifier in self.table["ratio"] and not overwrite:
-            raise Exception(f"{identifier} is already in the {self.name} ModelSet. If you wish to overwrite it, use overwrite=True")
-        else:
-            #print(f"Overwriting {identifier}.")
-            self._really_add_model(identifier,model,title)
+        self.add_models([(identifier,model,title)],overwrite=overwrite)
 
-    def _really_add_model(self,identifier,model,title):
-        print("Adding user model %s"%identifier)
+    def add_models(self,models,overwrite=False):
+        r"""Add many of your own models to this ModelSet at once.  Each model is validated and aligned as in :meth:`add_model`, and the tables of supported ratios and intensities are updated once for all of them.  If any model cannot be added, none are.
+
+        :param models: the models to add, as (identifier, model, title) tuples. See :meth:`add_model`.
+        :type models: list of tuple
+        :param overwrite:  Whether to overwrite models if their identifiers already exist in the ModelSet or have been previously added.  Default: False
+        :type overwrite: bool
+        :raises ValueError: if a model cannot be aligned to the grid of this ModelSet
+        """
+        index = self._get_ratio_index()
+        for identifier,model,title in models:
+            if identifier in self._user_added_models and not overwrite:
+                raise Exception(f"{identifier} was previously added to this ModelSet. If you wish to overwrite it, use overwrite=True")
+            elif identifier in index and not overwrite:
+                raise Exception(f"{identifier} is already in the {self.name} ModelSet. If you wish to overwrite it, use overwrite=True")
+        added = dict()
+        for identifier,model,title in models:
+            print("Adding user model %s"%identifier)
+            aligned = self._align_user_model(identifier,model,title)
+            # checksum once now, rather than whenever the model is used.
+            model_data_checksum(aligned)
+            added[identifier] = (aligned,title)
+        self._really_add_models(added)
+
+    def _align_user_model(self,identifier,model,title):
+        """Check a user model against the grid of this ModelSet and resample it onto that grid if needed.
+
+        :returns: the model on the grid of this ModelSet
+        :rtype: :class:`~pdrtpy.measurement.Measurement`
+        """
         if type(model) is str:
             m = Measurement.read(model,identifier=identifier)
         else:
             m = model
-        m._title = title
-        self._user_added_models[identifier] = m
-        if "/" in identifier: # it's a ratio
-            if identifier in self._supported_ratios["ratio label"]:
-                # ack, there should be a way just to replace title but I can't get Table.loc to work.
-                index = np.where(self._supported_ratios["ratio label"] == identifier)[0][0]
-                self._supported_ratios.remove_row(index)
-            self._supported_ratios.add_row([title,identifier])
-            numerator, denominator = identifier.split('/')
-            fakefilename = "user-"+numerator.replace("_","")+"_"+denominator.replace("_","")
-        else:
-            if identifier in self._supported_lines["intensity label"]:
-                index = np.where(self._supported_lines["intensity label"] == identifier)[0][0]
-                self._supported_lines.remove_row(index)
-            self._supported_lines.add_row([title,identifier])
-            numerator = identifier
-            denominator = 1
-            fakefilename = "user-"+numerator.replace("_","")
-          #numerator denominator ratio filename z title
-        self.table.add_row([numerator, denominator, identifier, fakefilename, self.z, title])
+        if m.wcs is None or m.wcs.naxis < 2 or m.data.size != np.prod(m.data.shape[-2:]):
+            raise ValueError(f"User model {identifier} must be a two dimensional grid with a world coordinate system")
+        ref = self._reference_model()
+        if m.wcs is ref.wcs and m.data.shape == ref.data.shape:
+            m._title = title
+            return m
+        for i in range(2):
+            if m.wcs.wcs.ctype[i].lower() != ref.wcs.wcs.ctype[i].lower():
+                raise ValueError(f"CTYPE{i+1} of user model {identifier} is {m.wcs.wcs.ctype[i]}, expected {ref.wcs.wcs.ctype[i]}")
+        rx,ry = _linear_axes(ref)
+        x,y = _linear_axes(m)
+        try:
+            lx = np.log10(x.to_value(rx.unit))
+            ly = np.log10(y.to_value(ry.unit))
+        except u.UnitConversionError as e:
+            raise ValueError(f"Axis units of user model {identifier} are not compatible with those of this ModelSet: {e}")
+        rlx = np.log10(rx.value)
+        rly = np.log10(ry.value)
+        if len(lx) == len(rlx) and len(ly) == len(rly) and np.allclose(lx,rlx,rtol=0,atol=_ALIGN_TOL_) and np.allclose(ly,rly,rtol=0,atol=_ALIGN_TOL_):
+            m._title = title
+            return m
+        data = np.asarray(m.data,dtype=float).reshape(len(ly),len(lx))
+        # RegularGridInterpolator needs increasing axes
+        if lx[0] > lx[-1]:
+            lx = lx[::-1]
+            data = data[:,::-1]
+        if ly[0] > ly[-1]:
+            ly = ly[::-1]
+            data = data[::-1,:]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            logdata = np.log10(np.where(data > 0,data,np.nan))
+        interp = RegularGridInterpolator((ly,lx),logdata,bounds_error=False,fill_value=np.nan)
+        gy,gx = np.meshgrid(rly,rlx,indexing="ij")
+        resampled = np.power(10.0,interp((gy,gx)))
+        if np.all(np.isnan(resampled)):
+            raise ValueError(f"User model {identifier} does not overlap the grid of this ModelSet")
+        warn(self,f"Resampled user model {identifier} onto the grid of this ModelSet")
+        header = m.header.copy()
+        for key in ["CUNIT1","CUNIT2"]:
+            if key in ref.header:
+                header[key] = ref.header[key]
+        aligned = Measurement(resampled.reshape(ref.data.shape),unit=m.unit,header=header,title=title,identifier=identifier)
+        aligned.wcs = ref.wcs
+        aligned._set_up_for_interp(world_axis=ref._world_axis,world_axis_lin=ref._world_axis_lin)
+        aligned._filename = m._filename
+        comment("Resampled onto %s ModelSet grid"%self.name,aligned)
+        return aligned
+
+    def _reference_model(self):
+        """The model whose grid is the grid of this ModelSet: the first model in its table with the axes shared by most of its models.  Some models may have other axes, e.g., the wk2006 H2 models cover a smaller range of density and radiation field.  The axes are compared from the model pack, or from the FITS headers if there is no pack."""
+        if self._reference is None:
+            ids = [str(r) for r in self.table["ratio"] if r not in self._user_added_models]
+            pack = self._get_pack()
+            keys = list()
+            for identifier in ids:
+                if pack is not None and identifier in pack:
+                    keys.append(("pack",pack.axis_index(identifier)))
+                else:
+                    filename = model_file(self._tabrow["path"],self._get_ratio_index()[identifier]["filename"]+".fits")
+                    h = fits.getheader(filename)
+                    keys.append(("fits",)+tuple(h.get(k,None) for k in _AXIS_KEYWORDS_))
+            counts = collections.Counter(keys)
+            most = max(counts.values())
+            self._reference = self.get_model(next(i for i,k in zip(ids,keys) if counts[k] == most))
+        return self._reference
+
+    def _really_add_models(self,added):
+        """Add aligned user models to this ModelSet and update its tables once for all of them.
+
+        :param added: (model, title) tuples keyed by identifier
+        :type added: dict
+        """
+        # The process-wide model cache is left alone: other ModelSets for the same
+        # models keep using it, and this one looks in its user models first.
+        # drop the derived models of the models these replace.
+        self._surrogates = {k:v for k,v in self._surrogates.items() if added.keys().isdisjoint(k[0])}
+        self._indexes = {k:v for k,v in self._indexes.items() if added.keys().isdisjoint(k[0])}
+        # make sure the lazily computed tables exist before changing them,
+        # and stop sharing the model table with other ModelSets.
+        if self._identifiers is None:
+            self._set_identifiers()
+        self._set_ratios()
+        ratio_index = self._get_ratio_index()
+        if self._table_shared:
+            self._table = deepcopy(self.table)
+            self._ratio_index = ratio_index = dict(ratio_index)
+            self._table_shared = False
+        ratios = list()
+        lines = list()
+        rows = list()
+        for identifier,(m,title) in added.items():
+            self._user_added_models[identifier] = m
+            if "/" in identifier: # it's a ratio
+                ratios.append([title,identifier])
+                numerator, denominator = identifier.split('/')
+                fakefilename = "user-"+numerator.replace("_","")+"_"+denominator.replace("_","")
+            else:
+                lines.append([title,identifier])
+                numerator = identifier
+                denominator = 1
+                fakefilename = "user-"+numerator.replace("_","")
+            #numerator denominator ratio filename z title
+            rows.append([numerator, str(denominator), identifier, fakefilename, self.z, title])
+            ratio_index[identifier] = _index_entry(numerator,str(denominator),fakefilename,title)
+        # replace rows of models that are overwritten, then add all the new rows at once.
+        self._supported_ratios = _replace_rows(self._supported_ratios,"ratio label",ratios)
+        self._supported_lines = _replace_rows(self._supported_lines,"intensity label",lines)
+        self._table = _replace_rows(self._table,"ratio",rows)
+
+    @property
+    def pack(self):
+        """The packed, memory-mapped store of the model grids in this ModelSet, or None if it could not be created.  The pack is built in the user cache directory (see :func:`~pdrtpy.pdrutils.cache_dir`) the first time it is needed and is rebuilt whenever the model table, any model file, or the archive the ModelSet is distributed in changes.
+
+        :rtype: :class:`~pdrtpy.modelpack.ModelPack`
+        """
+        return self._get_pack()
+
+    def _get_pack(self):
+        """Open the pack for this ModelSet, building it first if there is no up to date pack in the cache."""
+        if self._pack_checked:
+            return self._pack
+        self._pack_checked = True
+        self._pack = self._prebuilt_pack()
+        if self._pack is not None:
+            return self._pack
+        directory = model_dir()+self._tabrow["path"]
+        packfile = os.path.join(cache_dir(),"packs",_safe_path(self._tabrow["path"]),"models.pack")
+        archive = model_archive(self._tabrow["path"])
+        try:
+            source = self._pack_source(directory,archive)
+        except OSError:
+            # no model directory or archive
+            return None
+        if os.path.exists(packfile):
+            try:
+                p = ModelPack(packfile)
+                if p.source == source:
+                    self._pack = p
+                    return p
+            except (OSError,ValueError):
+                pass
+        try:
+            if archive is None:
+                self._pack = ModelPack.build(packfile,directory,self.table,source=source)
+            else:
+                # the archive is extracted once into a temporary directory, rather than
+                # file by file into the size-limited extraction directory.
+                os.makedirs(os.path.dirname(packfile),exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(packfile)) as tmp:
+                    with zipfile.ZipFile(archive) as z:
+                        z.extractall(tmp)
+                    self._pack = ModelPack.build(packfile,os.path.join(tmp,""),self.table,source=source)
+        except (OSError,zipfile.BadZipFile) as e:
+            warn(self,f"Could not create model pack {packfile}, reading FITS files instead: {e}")
+        return self._pack
+
+    def _prebuilt_pack(self):
+        """The pack built in the model directory with :mod:`~pdrtpy.packbuilder`, or None if there is none or it was built from a different model table."""
+        if not self._prebuilt_checked:
+            self._prebuilt_checked = True
+            self._prebuilt = _open_prebuilt(model_dir()+self._tabrow["path"],self._tabrow["filename"])
+        return self._prebuilt
+
+    def _pack_source(self,directory,archive=None):
+        """Information used to decide if a pack was built from the current contents of the model directory: the size and modification time of the model table and of every model file in it.  A model file that is rewritten in place changes its own modification time, but not that of the directory.  For a ModelSet distributed as an archive, the size and modification time of the archive."""
+        if archive is not None:
+            st = os.stat(archive)
+            return {"path": str(self._tabrow["path"]),
+                    "archive_size": st.st_size,
+                    "archive_mtime": st.st_mtime_ns}
+        st = os.stat(directory+self._tabrow["filename"])
+        return {"path": str(self._tabrow["path"]),
+                "table_size": st.st_size,
+                "table_mtime": st.st_mtime_ns,
+                "files": _file_stats(directory,self.table["filename"])}
 
     def _find_ratio_elements(self,m):
         # TODO handle case of OI+CII/FIR so it is not special cased in lineratiofit.py
@@ -443,13 +854,12 @@ class ModelSet(object):
         if not isinstance(m, collections.abc.Iterable) or isinstance(m, (str, bytes)) :
             raise Exception("m must be an array of strings")
 
+        index = self._get_ratio_index()
         for q in itertools.product(m,m):
             s = q[0]+"/"+q[1]
-            z = dict()
-            if s in self.table["ratio"]:
-                z={"numerator":self.table.loc[s]["numerator"],
-                   "denominator":self.table.loc[s]["denominator"]}
-                yield z
+            if s in index:
+                yield {"numerator":index[s]["numerator"],
+                       "denominator":index[s]["denominator"]}
 
     def _get_ratio_elements(self,m):
         """Get the valid model numerator,denominator pairs in this ModelSet for a given list of measurement IDs. See :meth:`~pdrtpy.measurement.Measurement.id`
@@ -460,13 +870,7 @@ class ModelSet(object):
         """
         if not isinstance(m, collections.abc.Iterable) or isinstance(m, (str, bytes)) :
             raise Exception("m must be an array of strings")
-        k = list()
-        for q in itertools.product(m,m):
-            s = q[0]+"/"+q[1]
-            if s in self.table["ratio"]:
-                z={"numerator":self.table.loc[s]["numerator"],
-                   "denominator":self.table.loc[s]["denominator"]}
-                k.append(z)
+        k = list(self._find_ratio_elements(m))
         self._get_oi_cii_fir(m,k)
         return k
 
@@ -493,50 +897,39 @@ class ModelSet(object):
                 z = {"numerator":num,"denominator":den}
                 k.append(z)
 
+    def _get_ratio_index(self):
+        """The dictionary of the models in this ModelSet, keyed by ratio label (the `ratio` column of :attr:`table`).  Each value is a dictionary with keys 'numerator', 'denominator', 'filename', and 'title'.  While the model table is shared, so is its index.
+
+        :rtype: dict
+        """
+        if self._ratio_index is None:
+            if self._table_shared:
+                entry = _ratio_indexes.get(self._catalog_key,None)
+                if entry is None or entry[0] is not self.table:
+                    entry = _ratio_indexes[self._catalog_key] = (self.table,_make_ratio_index(self.table))
+                self._ratio_index = entry[1]
+            else:
+                self._ratio_index = _make_ratio_index(self.table)
+        return self._ratio_index
+
     def _set_ratios(self):
         """make a useful table of ratios covered by this model"""
-        self._supported_ratios = Table( [ self.table["title"], self.table["denominator"], self.table["ratio"] ],copy=True)
-        matching_rows = np.where(self._supported_ratios["denominator"]=="1")[0]
-        self._supported_lines = Table(self._supported_ratios[matching_rows],copy=True)
-        self._supported_lines.remove_column("denominator")
-        self._supported_ratios.remove_rows(matching_rows)
-        self._supported_ratios['title'].unit = None
-        self._supported_ratios['ratio'].unit = None
-        self._supported_ratios.remove_column("denominator")
-        self._supported_ratios.rename_column("ratio","ratio label")
-        self._supported_lines.rename_column("ratio","intensity label")
+        if self._supported_ratios is not None:
+            return
+        pack = self._prebuilt_pack() if self._table_shared else None
+        if pack is not None and "ratios" in pack.tablenames and "intensities" in pack.tablenames:
+            self._supported_ratios = pack.table("ratios").copy()
+            self._supported_lines = pack.table("intensities").copy()
+        else:
+            self._supported_ratios,self._supported_lines = make_supported_tables(self.table)
 
     def _set_identifiers(self):
         """make a useful table of identifiers of lines covered by ratios in this ModelSet"""
-        # remove the single line intensity models from the list.
-        matching_rows = np.where((self._table['denominator'] != "1"))[0]
-        n=deepcopy(self._table['numerator'][matching_rows])
-        n.name = 'ID'
-        d=deepcopy(self._table['denominator'][matching_rows])
-        d.name='ID'
-
-        t1 = Table([self._table['title'][matching_rows],n],copy=True)
-        # discard the summed fluxes as user would input them individually
-        for id in ['OI_145+CII_158','OI_63+CII_158']:
-            a = np.where(t1['ID']==id)[0]
-            for z in a:
-                t1.remove_row(z)
-        # now remove denominator from title (everything from / onwards)
-        for i in range(len(t1['title'])):
-            if '/' in t1['title'][i]:
-                t1['title'][i] = t1['title'][i][0:t1['title'][i].index('/')]
-
-        t2 = Table([self._table['title'][matching_rows],d],copy=True)
-        # remove numerator from title (everything before and including /)
-        for i in range(len(t2['title'])):
-            if '/' in t2['title'][i]:
-                t2['title'][i] = t2['title'][i][t2['title'][i].index('/')+1:]
-        t = vstack([t1,t2])
-        t = unique(t,keys=['ID'],keep='first',silent=True)
-        t['title'].unit = None
-        t['ID'].unit = None
-        t.rename_column('title','canonical name')
-        self._identifiers = t
+        pack = self._prebuilt_pack() if self._table_shared else None
+        if pack is not None and "identifiers" in pack.tablenames:
+            self._identifiers = pack.table("identifiers").copy()
+        else:
+            self._identifiers = make_identifiers(self.table)
 
     @property
     def is_wk2006(self):
@@ -554,13 +947,446 @@ class ModelSet(object):
         """Print the names and descriptions of available ModelSets (not just this one) """
         ModelSet.all_sets().pprint_all(align="<")
 
+    @staticmethod
+    def query(code=None,name=None,version=None,medium=None,z=None,mass=None):
+        """Select the available ModelSets matching all of the given criteria.  Each criterion can be a single value, a list of values any of which may match, or a function that takes the catalog column and returns a boolean array, e.g. `ModelSet.query(code="KOSMA-tau",mass=lambda m: m >= 10)`.  Criteria that are None are not applied.  The ModelSets share one parsed catalog and the process-wide model cache, and read their models only when they are used.
+
+        :param code: the PDR code, e.g. 'KOSMA-tau'
+        :param name: the ModelSet name, e.g. 'wk2020'
+        :param version: the code version
+        :param medium: the medium type, e.g. 'constant density', 'clumpy', 'non-clumpy'
+        :param z: the metallicity in solar units
+        :param mass: the maximum clump mass (KOSMA-tau models only)
+        :returns: the matching ModelSets, in catalog order
+        :rtype: list of :class:`ModelSet`
+        """
+        t = _catalog("all_models.tab")
+        criteria = {"PDR code":code,"name":name,"version":version,"medium":medium,"z":z,"mass":mass}
+        select = np.ones(len(t),dtype=bool)
+        for column,value in criteria.items():
+            if value is None:
+                continue
+            c = t[column]
+            if callable(value):
+                match = value(c)
+            elif isinstance(value,(list,tuple,set,np.ndarray)):
+                match = np.isin(np.asarray(c),list(value))
+            else:
+                match = c == value
+            # rows with no value (e.g. mass of Wolfire/Kaufman models) never match
+            select &= np.ma.filled(np.ma.asarray(match),False).astype(bool) & ~np.ma.getmaskarray(c)
+        sets = list()
+        for row in t[select]:
+            m = None if np.ma.is_masked(row["mass"]) else float(row["mass"])
+            sets.append(ModelSet(str(row["name"]),z=float(row["z"]),medium=str(row["medium"]),mass=m))
+        return sets
+
+    @staticmethod
+    def model_cache():
+        """The process-wide cache of models read from all ModelSets.  Use it to inspect hit and miss counts, change the memory budget, or clear the cache, e.g., `ModelSet.model_cache().budget = 64*1024**2`
+
+        :rtype: :class:`~pdrtpy.modelcache.ModelCache`
+        """
+        return model_cache()
+
     @staticmethod
     def all_sets():
         """Return a table of the names and descriptions of available ModelSets (not just this one)
 
         :rtype: :class:`~astropy.table.Table`
         """
-        t = get_table("all_models.tab")
+        t = Table(_catalog("all_models.tab"),copy=True)
+        t.remove_indices("name")
         t.remove_column("path")
         t.remove_column("filename")
         return t
+
+def model_gradient(model):
+    """The derivatives of a model grid with respect to its world axes, as they appear in the WCS, which is log space for the models distributed with the toolbox.  The derivatives are the slopes between neighboring grid points, so that together they give the exact derivative of the bilinear interpolation of the model anywhere in the grid.  They are computed once per model and kept with it.  Non-finite derivatives are set to zero.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :returns: The derivative grids along the first (e.g., density) and second (e.g., radiation field) world axes. The first has one less element along the last axis of the model data, the second one less along the second to last axis.
+    :rtype: tuple of :class:`numpy.ndarray`
+    """
+    return memoize(model,"gradient",_gradient)
+
+def _gradient(model):
+    """The derivatives of a model grid, see :func:`model_gradient`"""
+    x,y = model._world_axis
+    data = np.asarray(model.data,dtype=float)
+    dx = np.diff(data,axis=-1)/np.diff(np.asarray(x,dtype=float))
+    dy = np.diff(data,axis=-2)/np.diff(np.asarray(y,dtype=float))[:,np.newaxis]
+    return (np.nan_to_num(dx,nan=0.0,posinf=0.0,neginf=0.0),
+            np.nan_to_num(dy,nan=0.0,posinf=0.0,neginf=0.0))
+
+def align_models(models):
+    """Align model grids with different axes, e.g., the wk2006 H2 models, which cover a smaller range of density and radiation field than the other wk2006 models.  The intersection of the world axes of all the models is computed once, and each model that extends beyond it is replaced by a view onto the part of its grid inside the intersection.  The data of the views are not copied, so they must not be modified in place.  Models already on the common grid are returned unchanged.
+
+    The models may come from any mix of ModelSets, including models added with :meth:`ModelSet.add_model`, as long as their grid points coincide inside the intersection.  Axis values are compared in the units of the first model.
+
+    :param models: the models to align
+    :type models: list or dict of :class:`~pdrtpy.measurement.Measurement`
+    :returns: the aligned models, in the same kind of container as the input
+    :rtype: list or dict of :class:`~pdrtpy.measurement.Measurement`
+    :raises ValueError: if the models have no axis values in common, or different grid points inside the intersection
+    """
+    if isinstance(models,dict):
+        return dict(zip(models.keys(),align_models(list(models.values()))))
+    models = list(models)
+    if len(models) < 2:
+        return models
+    first = models[0]
+    # models sharing one WCS (see ModelAxes) are on the same grid
+    if all(m.wcs is first.wcs and m.data.shape == first.data.shape for m in models):
+        return models
+    axes = list()
+    units = None
+    for m in models:
+        x,y = _linear_axes(m)
+        if units is None:
+            units = (x.unit,y.unit)
+        axes.append((np.log10(x.to_value(units[0])),np.log10(y.to_value(units[1]))))
+    slices = list()
+    common = list()
+    for i in range(2):
+        lo = max(np.min(a[i]) for a in axes)
+        hi = min(np.max(a[i]) for a in axes)
+        inside = [np.flatnonzero((a[i] >= lo-_ALIGN_TOL_) & (a[i] <= hi+_ALIGN_TOL_)) for a in axes]
+        if any(len(j) == 0 for j in inside):
+            raise ValueError(f"Models {[m.id for m in models]} have no values in common along axis {i+1}")
+        values = axes[0][i][inside[0]]
+        for m,a,j in zip(models[1:],axes[1:],inside[1:]):
+            if len(j) != len(values) or not np.allclose(a[i][j],values,rtol=0,atol=_ALIGN_TOL_):
+                raise ValueError(f"Model {m.id} and {first.id} have different grid points along axis {i+1}")
+        slices.append([slice(j[0],j[-1]+1) for j in inside])
+        common.append(values)
+    aligned = list()
+    for k,m in enumerate(models):
+        sx = slices[0][k]
+        sy = slices[1][k]
+        ny,nx = m.data.shape[-2:]
+        if (sx.stop-sx.start,sy.stop-sy.start) == (nx,ny):
+            aligned.append(m)
+        else:
+            aligned.append(_model_view(m,sy,sx))
+    return aligned
+
+def clip_models(models,nax1_clip=None,nax2_clip=None):
+    """Restrict models to ranges of their world coordinates, e.g., density and radiation field.  Each model that extends beyond the ranges is replaced by a view onto the part of its grid that covers them, which includes the nearest grid point at or beyond each end of a range so that the model can be interpolated anywhere in it.  The data of the views are not copied, so they must not be modified in place.  Models inside the ranges are returned unchanged.
+
+    :param models: the models to clip
+    :type models: list or dict of :class:`~pdrtpy.measurement.Measurement`
+    :param nax1_clip: The range of values on NAXIS1, e.g., hydrogen number density.  Values without units are in the units of the model axis. Default: None, meaning the whole axis
+    :type nax1_clip: array-like, may contain :class:`~astropy.units.Quantity`
+    :param nax2_clip: The range of values on NAXIS2, e.g., radiation field.  Values without units are in the units of the model axis. Default: None, meaning the whole axis
+    :type nax2_clip: array-like, may contain :class:`~astropy.units.Quantity`
+    :returns: the clipped models, in the same kind of container as the input
+    :rtype: list or dict of :class:`~pdrtpy.measurement.Measurement`
+    :raises ValueError: if a range does not overlap the axis of a model
+    """
+    if isinstance(models,dict):
+        return dict(zip(models.keys(),clip_models(list(models.values()),nax1_clip,nax2_clip)))
+    clipped = list()
+    for m in models:
+        x,y = _linear_axes(m)
+        sx = _clip_slice(x,nax1_clip,m,1)
+        sy = _clip_slice(y,nax2_clip,m,2)
+        if (sx.stop-sx.start,sy.stop-sy.start) == (len(x),len(y)):
+            clipped.append(m)
+        else:
+            clipped.append(_model_view(m,sy,sx))
+    return clipped
+
+def _clip_slice(axis,clip,model,n):
+    """The slice of an increasing axis that covers a range of its values"""
+    if clip is None:
+        return slice(0,len(axis))
+    try:
+        lo,hi = sorted(u.Quantity(clip,axis.unit).value)
+    except u.UnitConversionError as e:
+        raise ValueError(f"The range for NAXIS{n} is not compatible with the axis of model {model.id}: {e}")
+    v = axis.value
+    if lo > v[-1]*(1+_CLIP_TOL_) or hi < v[0]*(1-_CLIP_TOL_):
+        raise ValueError(f"The range {lo:.3g}-{hi:.3g} {axis.unit} does not overlap NAXIS{n} of model {model.id}: {v[0]:.3g}-{v[-1]:.3g} {axis.unit}")
+    # the last grid point at or below lo and the first at or above hi
+    i0 = max(np.searchsorted(v,lo*(1+_CLIP_TOL_),side="right")-1,0)
+    i1 = min(np.searchsorted(v,hi*(1-_CLIP_TOL_),side="left"),len(v)-1)
+    # keep at least two grid points to interpolate between
+    if i1 == i0:
+        if i1 < len(v)-1:
+            i1 += 1
+        else:
+            i0 -= 1
+    return slice(i0,i1+1)
+
+_CLIP_TOL_ = 1E-9
+"""Relative tolerance for a range to end on a grid point"""
+
+def _linear_axes(model):
+    """The linear world axis values of a model as Quantities.  Like :func:`~pdrtpy.pdrutils.get_xy_from_wcs` with `quantity=True, linear=True`, but using the world axis values computed when the model was set up."""
+    x,y = getattr(model,"_world_axis_lin",None) or get_xy_from_wcs(model,linear=True)
+    xunit = u.Unit(model.wcs.wcs.cunit[0])
+    yunit = u.Unit(model.wcs.wcs.cunit[1])
+    # Habing and Draine units are not FITS units, so they are only in the header.
+    cunit = model.header.get("CUNIT2",None)
+    if cunit == "Habing":
+        yunit = habing_unit
+    elif cunit == "Draine":
+        yunit = draine_unit
+    return np.asarray(x,dtype=float)*xunit,np.asarray(y,dtype=float)*yunit
+
+_ALIGN_TOL_ = 1E-6
+"""Tolerance in dex for grid points of different models to be considered the same"""
+
+def _model_view(model,sy,sx):
+    """A Measurement holding the part of a model inside the given slices of its last two axes, without copying the data"""
+    naxis = model.wcs.naxis
+    # WCS slices are in numpy order
+    wcs = model.wcs.slice((slice(None),)*(naxis-2)+(sy,sx))
+    data = model.data[...,sy,sx]
+    header = model.header.copy()
+    header["NAXIS1"] = data.shape[-1]
+    header["NAXIS2"] = data.shape[-2]
+    view = Measurement(data,unit=model.unit,wcs=wcs,header=header,title=model.title,identifier=model.id)
+    if hasattr(model,"modeltype"):
+        view.modeltype = model.modeltype
+    view._filename = model._filename
+    comment("Trimmed model",view)
+    return view
+
+# FITS header keywords that describe the axes of a model grid
+_AXIS_KEYWORDS_ = ["NAXIS1","NAXIS2","CTYPE1","CTYPE2","CRVAL1","CRVAL2","CDELT1","CDELT2","CRPIX1","CRPIX2","CUNIT1","CUNIT2"]
+
+# Parsed tables shared by all ModelSets in this process, keyed by (path,filename,format).
+# Each value is (modification time and size of the file, table); a table is parsed again when its file changes.
+_catalogs = dict()
+# Rows of the package default all_models.tab, keyed by ModelSet parameters.
+# Each value is (the parsed all_models.tab it was found in, row).
+_tabrows = dict()
+# Ratio label indexes of the shared model tables, keyed like _catalogs.
+# Each value is (the parsed model table it indexes, index).
+_ratio_indexes = dict()
+# Packs built in model directories, keyed by pack file name.  Each value is
+# (sizes and modification times of the pack, model table and model files, pack or None).
+_prebuilt_packs = dict()
+
+def _open_prebuilt(directory,tablefile):
+    """Open the pack built in a model directory if it was built from the current model table and model files"""
+    packfile = directory+PACK_FILENAME
+    tablefile = directory+tablefile
+    try:
+        ps = os.stat(packfile)
+        ts = os.stat(tablefile)
+        files = sorted((e.name,e.stat().st_size,e.stat().st_mtime_ns) for e in os.scandir(directory) if e.is_file())
+    except OSError:
+        return None
+    stamp = (ps.st_mtime_ns,ps.st_size,tablefile,ts.st_mtime_ns,ts.st_size,tuple(files))
+    entry = _prebuilt_packs.get(packfile,None)
+    if entry is None or entry[0] != stamp:
+        pack = None
+        try:
+            p = ModelPack(packfile)
+            if p.source.get("table_sha256",None) == file_checksum(tablefile) and _files_unchanged(directory,p.source):
+                pack = p
+        except (OSError,ValueError):
+            pass
+        entry = _prebuilt_packs[packfile] = (stamp,pack)
+    return entry[1]
+
+def _files_unchanged(directory,source):
+    """Whether the model files in a directory are the ones recorded when a pack was built.  A file whose size and modification time differ from the recorded ones is compared by checksum, so a copied model directory still uses its pack.  Files that do not exist, e.g., in a pack distributed without them, can not disagree with it.
+
+    :rtype: bool
+    """
+    files = source.get("files",None)
+    if files is None:
+        return False
+    ext = source.get("ext","fits")
+    current = _file_stats(directory,files.keys(),ext=ext)
+    for fname,(size,mtime,sha256) in files.items():
+        if fname not in current or current[fname] == [size,mtime]:
+            continue
+        if current[fname][0] != size or file_checksum(f"{directory}{fname}.{ext}") != sha256:
+            return False
+    return True
+
+def _file_stats(directory,filenames,ext="fits"):
+    """The size and modification time of each model file in a directory, keyed by file name.  Files that do not exist are left out.
+
+    :rtype: dict
+    """
+    stats = dict()
+    for fname in filenames:
+        try:
+            st = os.stat(directory+str(fname)+"."+ext)
+        except OSError:
+            continue
+        stats[str(fname)] = [st.st_size,st.st_mtime_ns]
+    return stats
+
+def _replace_rows(table,key,rows):
+    """A copy of a table with the rows whose `key` column matches any of the new rows removed and the new rows appended.  The table is copied once, rather than once per added row."""
+    if len(rows) == 0:
+        return table
+    keys = set(r[table.colnames.index(key)] for r in rows)
+    keep = [str(v) not in keys for v in table[key]]
+    new = Table(rows=rows,names=table.colnames)
+    for name in table.colnames:
+        new[name].unit = table[name].unit
+    result = vstack([table[keep],new],metadata_conflicts="silent")
+    for index in table.indices:
+        result.add_index([c.info.name for c in index.columns])
+    return result
+
+def make_supported_tables(table):
+    """The tables of ratios and of intensities covered by a model table, as given by :attr:`ModelSet.supported_ratios` and :attr:`ModelSet.supported_intensities`.  :mod:`~pdrtpy.packbuilder` stores them in model packs.
+
+    :param table: a model table, see :attr:`ModelSet.table`
+    :type table: :class:`astropy.table.Table`
+    :returns: the table of ratios and the table of intensities
+    :rtype: tuple of :class:`astropy.table.Table`
+    """
+    ratios = Table( [ table["title"], table["denominator"], table["ratio"] ],copy=True)
+    matching_rows = np.where(ratios["denominator"]=="1")[0]
+    lines = Table(ratios[matching_rows],copy=True)
+    lines.remove_column("denominator")
+    ratios.remove_rows(matching_rows)
+    ratios['title'].unit = None
+    ratios['ratio'].unit = None
+    ratios.remove_column("denominator")
+    ratios.rename_column("ratio","ratio label")
+    lines.rename_column("ratio","intensity label")
+    return ratios,lines
+
+def make_identifiers(table):
+    """The table of identifiers of lines covered by ratios in a model table, as given by :attr:`ModelSet.identifiers`.  :mod:`~pdrtpy.packbuilder` stores it in model packs.
+
+    :param table: a model table, see :attr:`ModelSet.table`
+    :type table: :class:`astropy.table.Table`
+    :rtype: :class:`astropy.table.Table`
+    """
+    # remove the single line intensity models from the list.
+    matching_rows = np.where((table['denominator'] != "1"))[0]
+    n=deepcopy(table['numerator'][matching_rows])
+    n.name = 'ID'
+    d=deepcopy(table['denominator'][matching_rows])
+    d.name='ID'
+
+    t1 = Table([table['title'][matching_rows],n],copy=True)
+    # discard the summed fluxes as user would input them individually
+    for id in ['OI_145+CII_158','OI_63+CII_158']:
+        a = np.where(t1['ID']==id)[0]
+        for z in a:
+            t1.remove_row(z)
+    # now remove denominator from title (everything from / onwards)
+    for i in range(len(t1['title'])):
+        if '/' in t1['title'][i]:
+            t1['title'][i] = t1['title'][i][0:t1['title'][i].index('/')]
+
+    t2 = Table([table['title'][matching_rows],d],copy=True)
+    # remove numerator from title (everything before and including /)
+    for i in range(len(t2['title'])):
+        if '/' in t2['title'][i]:
+            t2['title'][i] = t2['title'][i][t2['title'][i].index('/')+1:]
+    t = vstack([t1,t2])
+    t = unique(t,keys=['ID'],keep='first',silent=True)
+    t['title'].unit = None
+    t['ID'].unit = None
+    t.rename_column('title','canonical name')
+    return t
+
+def _index_entry(numerator,denominator,filename,title):
+    return {"numerator": numerator, "denominator": denominator,
+            "filename": filename, "title": title}
+
+def _make_ratio_index(table):
+    """Build a dictionary of model table rows keyed by ratio label"""
+    index = dict()
+    for row in zip(list(table["ratio"]),list(table["numerator"]),list(table["denominator"]),
+                   list(table["filename"]),list(table["title"])):
+        index[str(row[0])] = _index_entry(str(row[1]),str(row[2]),str(row[3]),str(row[4]))
+    return index
+
+def _catalog(filename,path=None,format='ipac',pack=None):
+    """Parse a table of models once per process, and again whenever its file changes.  The returned table is shared and must not be modified.
+
+    :param filename: input filename, no path
+    :type filename: str
+    :param  path: path to filename relative to models directory.  Default of None means look in "tables" directory
+    :type path: str
+    :param format:  file format, Default: "ipac"
+    :type format: str
+    :param pack: a pack built from the table, which holds it already parsed. Default: None
+    :type pack: :class:`~pdrtpy.modelpack.ModelPack`
+    :rtype: :class:`astropy.table.Table`
+    """
+    key = (path,filename,format)
+    stamp = _catalog_stamp(filename,path)
+    entry = _catalogs.get(key,None)
+    if entry is None or entry[0] != stamp:
+        if pack is not None and "models" in pack.tablenames:
+            t = pack.table("models").copy()
+        else:
+            t = get_table(filename,path=path,format=format)
+        t.add_index("ratio" if path is not None else "name")
+        entry = _catalogs[key] = (stamp,t)
+    return entry[1]
+
+def _catalog_stamp(filename,path=None):
+    """The modification time and size of the file a table of models is read from, or None if it does not exist.  See :func:`_catalog`."""
+    if path is None:
+        thefile = _tablename(filename)
+    else:
+        thefile = model_archive(path) or model_dir()+path+filename
+    try:
+        st = os.stat(thefile)
+    except OSError:
+        return None
+    return (st.st_mtime_ns,st.st_size)
+
+def _find_tabrow(all_models,name,z,medium,mass):
+    """Find the row of the table of all ModelSets that matches the input parameters.
+
+    :param all_models: table of all ModelSets, indexed by name
+    :type all_models: :class:`astropy.table.Table`
+    :raises ValueError: If model set not recognized/found.
+    :rtype: :class:`astropy.table.Row`
+    """
+    possible = dict()
+    if name not in all_models["name"]:
+        raise ValueError(f'Unrecognized model {name:s}. Choices  are: {list(all_models["name"])}')
+    if np.all(all_models.loc[name]["mass"].mask):
+        matching_rows = np.where((all_models["z"]==z) &
+                             (all_models["medium"]==medium))
+        possible["mass"] = None
+    else:
+        matching_rows = np.where((all_models["z"]==z) &
+                 (all_models["medium"]==medium) &
+                 (all_models["mass"] == mass))
+        possible["mass"] = all_models.loc[name]["mass"]
+    for key in ["z", "medium"]:
+        possible[key]=  all_models.loc[name][key]
+    # ugh, possible[] resulting from above can be a Python native or a Column.
+    # If only one row matches it will be a native, otherwise it will be a Column,
+    # so we have to check if it is a Column or not, so that we can successfully
+    # import numberscreate a numpy array.
+    for i in possible:
+        if possible[i] is None:
+            continue
+        if isinstance(possible[i],Column):
+            # convert Column to np.array
+            possible[i] = sorted(set(np.array(possible[i])))
+        else:
+            # convert native to np.array
+            possible[i] = sorted(set(np.array([possible[i]])))
+
+    #print("possible:",possible)
+    if mass is None and possible['mass'] is not None:
+        raise ValueError(f'mass value is required for model {name:s}. Allowed values are {possible["mass"]}')
+    if matching_rows[0].size == 0:
+        msg = f"Requested ModelSet not found in {name:s}. Check your input values.  Allowed z are {possible['z']}.  Allowed medium are {possible['medium']}."
+        if possible['mass'] is not None:
+            msg = msg + f" Allowed mass are {possible['mass']}."
+        raise ValueError(msg)
+    return all_models[matching_rows].loc[name]
@@ -0,0 +1,256 @@
+"""Smooth, vectorized evaluation of model grids"""
+
+import hashlib
+import os
+import tempfile
+from copy import deepcopy
+
+import numpy as np
+from scipy.interpolate import BSpline, RectBivariateSpline
+from scipy.ndimage import distance_transform_edt
+
+from .measurement import Measurement
+from .modelcache import memoize
+from .modelpack import model_data_checksum
+from .pdrutils import cache_dir,_default_permissions
+
+_LN10 = np.log(10.0)
+
+class ModelSurrogate(object):
+    r"""A bicubic spline surrogate of :math:`\log_{10}` of a set of models as a function of :math:`\log_{10}` of the world coordinates, e.g., density and radiation field.  Because model ratios span many orders of magnitude, they are much better represented as smooth functions in log space than by linear interpolation.
+
+    The spline of each model is computed once and kept with the model. All models must share the same axes, so they share the spline knots and all of them can be evaluated at any number of points with one vectorized call.  Points outside the model grid evaluate to NaN, as do points closest to grid points where the model is not positive or not finite.
+
+    :param models: the models, keyed by identifier, e.g., the result of :meth:`~pdrtpy.modelset.ModelSet.get_models`
+    :type models: dict of :class:`~pdrtpy.measurement.Measurement`
+    :raises ValueError: if the models do not have the same axes
+    """
+    def __init__(self,models):
+        if len(models) == 0:
+            raise ValueError("At least one model is required")
+        self._identifiers = list(models.keys())
+        splines = [model_spline(m) for m in models.values()]
+        tx,ty = splines[0][0],splines[0][1]
+        for s in splines[1:]:
+            if not (np.array_equal(s[0],tx) and np.array_equal(s[1],ty)):
+                raise ValueError("All models must have the same axes")
+        self._tx = tx
+        self._ty = ty
+        self._bx = _basis(tx)
+        self._by = _basis(ty)
+        self._coeffs = np.array([s[2] for s in splines])
+        self._valid = np.array([s[3] for s in splines])
+        self._axes = splines[0][4]
+
+    @property
+    def identifiers(self):
+        """The identifiers of the models, in the order of the first axis of evaluated values
+
+        :rtype: list
+        """
+        return self._identifiers
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def __call__(self,x,y,log=False):
+        """Evaluate all models at the given points.
+
+        :param x: the first world coordinate, e.g. density, of the points
+        :type x: float or array-like
+        :param y: the second world coordinate, e.g. radiation field, of the points
+        :type y: float or array-like
+        :param log: True if the input coordinates are logarithmic. Default: False
+        :type log: bool
+        :returns: the model values, with shape (number of models,)+shape of the points
+        :rtype: :class:`numpy.ndarray`
+        """
+        return np.power(10.0,self.log10(x,y,log))
+
+    def log10(self,x,y,log=False):
+        """Evaluate :math:`\\log_{10}` of all models at the given points. See :meth:`__call__`.
+
+        :rtype: :class:`numpy.ndarray`
+        """
+        return self._evaluate(x,y,log,(0,0))[0]
+
+    def derivatives(self,x,y,log=False):
+        r"""Evaluate all models and their derivatives with respect to the log world coordinates at the given points, e.g., :math:`R`, :math:`\partial R/\partial\log_{10} n`, and :math:`\partial R/\partial\log_{10} G_0`.
+
+        :param x: the first world coordinate, e.g. density, of the points
+        :type x: float or array-like
+        :param y: the second world coordinate, e.g. radiation field, of the points
+        :type y: float or array-like
+        :param log: True if the input coordinates are logarithmic. Default: False
+        :type log: bool
+        :returns: the model values and the derivatives along the first and second axes, each with shape (number of models,)+shape of the points
+        :rtype: tuple of :class:`numpy.ndarray`
+        """
+        logv,dlx,dly = self._evaluate(x,y,log,(0,0),(1,0),(0,1))
+        v = np.power(10.0,logv)
+        return v,_LN10*v*dlx,_LN10*v*dly
+
+    def _evaluate(self,x,y,log,*orders):
+        """Evaluate the log of the models, or its derivatives of the given (x,y) orders, at the given points"""
+        x = np.asarray(x,dtype=float)
+        y = np.asarray(y,dtype=float)
+        x,y = np.broadcast_arrays(x,y)
+        shape = x.shape
+        lx = x.ravel() if log else np.log10(x.ravel())
+        ly = y.ravel() if log else np.log10(y.ravel())
+        invalid = self._invalid(lx,ly)
+        bases = dict()
+        results = list()
+        for ox,oy in orders:
+            # clip so points on the grid edges are evaluated; off-grid points are masked separately
+            if ("x",ox) not in bases:
+                bases[("x",ox)] = self._bx(np.clip(lx,self._tx[0],self._tx[-1]),nu=ox)
+            if ("y",oy) not in bases:
+                bases[("y",oy)] = self._by(np.clip(ly,self._ty[0],self._ty[-1]),nu=oy)
+            bx = bases[("x",ox)]
+            by = bases[("y",oy)]
+            # sum over the coefficients of each model: by[p,i] c[r,i,j] bx[p,j]
+            v = np.sum(np.matmul(by,self._coeffs)*bx,axis=-1)
+            v[invalid] = np.nan
+            results.append(v.reshape((len(self),)+shape))
+        return results
+
+    def _invalid(self,lx,ly):
+        """Mask of points, per model, that are off the grid or nearest to an invalid grid point"""
+        ax,ay = self._axes
+        outside = (lx < ax[0]) | (lx > ax[-1]) | (ly < ay[0]) | (ly > ay[-1]) | ~np.isfinite(lx) | ~np.isfinite(ly)
+        ix = np.clip(np.searchsorted(ax,lx),1,len(ax)-1)
+        ix = ix - ((lx - ax[ix-1]) < (ax[ix] - lx))
+        iy = np.clip(np.searchsorted(ay,ly),1,len(ay)-1)
+        iy = iy - ((ly - ay[iy-1]) < (ay[iy] - ly))
+        return ~self._valid[:,iy,ix] | outside[np.newaxis,:]
+
+def model_spline(model):
+    r"""The bicubic interpolating spline of :math:`\log_{10}` of a model as a function of :math:`\log_{10}` of its world coordinates.  Grid points where the model is not positive or not finite are filled from their nearest valid neighbor before fitting.  The spline is computed once per model and kept with it.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :returns: the knots along the first and second axes, the spline coefficients with shape (second axis,first axis), the mask of valid grid points, and the log world coordinates of the grid
+    :rtype: tuple
+    """
+    return memoize(model,"spline",_spline)
+
+def _spline(model):
+    """The bicubic spline of a model, see :func:`model_spline`"""
+    x = np.log10(np.asarray(model._world_axis_lin[0],dtype=float))
+    y = np.log10(np.asarray(model._world_axis_lin[1],dtype=float))
+    data = np.asarray(model.data,dtype=float)
+    data = data.reshape(data.shape[-2:])
+    valid = np.isfinite(data) & (data > 0)
+    if not np.any(valid):
+        raise ValueError(f"Model {model.id} has no positive values")
+    z = np.log10(np.where(valid,data,1.0))
+    if not np.all(valid):
+        indices = distance_transform_edt(~valid,return_distances=False,return_indices=True)
+        z = z[tuple(indices)]
+    spline = RectBivariateSpline(y,x,z,kx=3,ky=3,s=0)
+    ty,tx = spline.get_knots()
+    coeffs = spline.get_coeffs().reshape(len(ty)-4,len(tx)-4)
+    return (tx,ty,coeffs,valid,(x,y))
+
+def upsample_model(model,oversample,directory=None):
+    r"""A model on a grid `oversample` times finer along each axis, interpolated with the bicubic spline of :math:`\log_{10}` of the model (see :func:`model_spline`).  The original grid points are kept, so every `oversample`-th point of the result is a point of the model.  New points closest to a grid point where the model is not positive or not finite are NaN.
+
+    The upsampled data are computed once per model and oversampling factor and kept in memory with the model.  They are also saved in `directory`, keyed by a checksum of the model and the oversampling factor, and read back instead of being recomputed in later sessions.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :param oversample: the number of new grid cells per original grid cell along each axis
+    :type oversample: int
+    :param directory: the directory in which to save and look up the upsampled data, or False to keep them in memory only. Default: None, meaning `upsampled` in the user cache directory (see :func:`~pdrtpy.pdrutils.cache_dir`)
+    :type directory: str or bool
+    :returns: the upsampled model, whose data must not be modified in place
+    :rtype: :class:`~pdrtpy.measurement.Measurement`
+    :raises ValueError: if oversample is not a positive integer
+    """
+    if int(oversample) != oversample or oversample < 1:
+        raise ValueError(f"oversample must be a positive integer, got {oversample}")
+    oversample = int(oversample)
+    if oversample == 1:
+        return model
+    return memoize(model,("upsampled",oversample),lambda m: _upsampled_model(m,_upsampled_data(m,oversample,directory),oversample))
+
+def _upsampled_data(model,oversample,directory):
+    """The upsampled data of a model, read from or saved in directory unless it is False"""
+    if directory is False:
+        return _upsample(model,oversample)
+    if directory is None:
+        directory = os.path.join(cache_dir(),"upsampled")
+    filename = os.path.join(directory,f"{model_checksum(model)}_x{oversample}.npy")
+    try:
+        return np.load(filename,mmap_mode="r")
+    except (OSError,ValueError):
+        pass
+    data = _upsample(model,oversample)
+    _save(filename,data)
+    return data
+
+def model_checksum(model):
+    """A checksum of the data and axes of a model.  It uses the checksum of the model data recorded in the model pack, if the model was loaded from one, see :func:`~pdrtpy.modelpack.model_data_checksum`.
+
+    :param model: the model
+    :type model: :class:`~pdrtpy.measurement.Measurement`
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    h.update(str(np.shape(model.data)).encode("utf-8"))
+    h.update(model_data_checksum(model).encode("utf-8"))
+    for axis in model._world_axis_lin:
+        h.update(np.ascontiguousarray(axis,dtype="<f8").tobytes())
+    return h.hexdigest()
+
+def _upsample(model,oversample):
+    """The upsampled data of a model, with the same number of dimensions as the model data"""
+    tx,ty,coeffs,valid,(x,y) = model_spline(model)
+    fx = np.arange((len(x)-1)*oversample+1)/oversample
+    fy = np.arange((len(y)-1)*oversample+1)/oversample
+    lx = np.clip(np.interp(fx,np.arange(len(x)),x),tx[0],tx[-1])
+    ly = np.clip(np.interp(fy,np.arange(len(y)),y),ty[0],ty[-1])
+    # the new points are a tensor grid, so evaluate the spline as by c bx^T
+    z = _basis(ty)(ly) @ coeffs @ _basis(tx)(lx).T
+    z[~valid[np.ix_(np.rint(fy).astype(int),np.rint(fx).astype(int))]] = np.nan
+    data = np.power(10.0,z)
+    return data.reshape(np.shape(model.data)[:-2]+data.shape)
+
+def _upsampled_model(model,data,oversample):
+    """A Measurement holding upsampled data with the axes of the model refined by oversample"""
+    wcs = model.wcs.deepcopy()
+    header = deepcopy(model.header)
+    for i in range(2):
+        wcs.wcs.cdelt[i] = wcs.wcs.cdelt[i]/oversample
+        wcs.wcs.crpix[i] = (wcs.wcs.crpix[i]-1)*oversample+1
+        header[f"CDELT{i+1}"] = wcs.wcs.cdelt[i]
+        header[f"CRPIX{i+1}"] = wcs.wcs.crpix[i]
+        header[f"NAXIS{i+1}"] = data.shape[-1-i]
+    wcs.array_shape = data.shape
+    m = Measurement(data,unit=model.unit,wcs=wcs,header=header,title=model.title,identifier=model.id)
+    if hasattr(model,"modeltype"):
+        m.modeltype = model.modeltype
+    return m
+
+def _save(filename,data):
+    """Save an array atomically, so concurrent readers never see a partial file.  Failure to save is not an error."""
+    try:
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname,exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=dirname,suffix=".tmp")
+        try:
+            with os.fdopen(fd,"wb") as f:
+                np.save(f,data)
+            _default_permissions(tmp)
+            os.replace(tmp,filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    except OSError:
+        pass
+
+def _basis(t):
+    """All the cubic B-spline basis functions with knots t. Evaluating it at points x gives an array of shape (points, basis functions)"""
+    return BSpline(t,np.eye(len(t)-4),3,extrapolate=False)
@@ -0,0 +1,109 @@
+"""Build packs of the model grids in model directories, so that ModelSets load them without reading any FITS files.
+
+From the command line::
+
+    pdrtpy-pack /path/to/models/wk2020_models/z=1/
+    pdrtpy-pack --modelsetinfo my_models.tab
+"""
+
+import argparse
+import os
+import sys
+
+from astropy.table import Table
+
+from . import version
+from .modelpack import ModelPack, PACK_FILENAME, file_checksum
+from .modelset import make_identifiers, make_supported_tables
+from .pdrutils import model_dir
+
+def build_pack(directory,table="models.tab",format="ipac",ext="fits",filename=None):
+    """Build a pack of the model grids in a model directory.  The pack holds the grids and the checksum of each one, the model table, and the tables of identifiers, ratios, and intensities of the :class:`~pdrtpy.modelset.ModelSet`.  A pack built in the model directory with the default filename is used by every ModelSet of that directory for as long as the model table and the model files are unchanged.
+
+    :param directory: the directory containing the model FITS files and the model table
+    :type directory: str
+    :param table: the file name of the model table in `directory`. Default: "models.tab"
+    :type table: str
+    :param format: the format of the model table. Default: "ipac"
+    :type format: str
+    :param ext: file extension of the model files. Default: "fits"
+    :type ext: str
+    :param filename: the output pack file. Default: `models.pack` in `directory`
+    :type filename: str
+    :returns: the opened pack
+    :rtype: :class:`~pdrtpy.modelpack.ModelPack`
+    """
+    directory = os.path.join(directory,"")
+    tablefile = directory+table
+    t = Table.read(tablefile,format=format)
+    ratios,intensities = make_supported_tables(t)
+    tables = {"models": t,
+              "ratios": ratios,
+              "intensities": intensities,
+              "identifiers": make_identifiers(t)}
+    # the size, modification time, and checksum of every model file, to tell when one changes
+    files = dict()
+    for fname in t["filename"]:
+        thefile = f"{directory}{fname}.{ext}"
+        if os.path.exists(thefile):
+            st = os.stat(thefile)
+            files[str(fname)] = [st.st_size,st.st_mtime_ns,file_checksum(thefile)]
+    source = {"table": table,
+              "table_sha256": file_checksum(tablefile),
+              "ext": ext,
+              "files": files,
+              "builder": f"pdrtpy {version()}"}
+    if filename is None:
+        filename = directory+PACK_FILENAME
+    return ModelPack.build(filename,directory,t,ext=ext,source=source,tables=tables)
+
+def build_packs(modelsetinfo,format="ipac",ext="fits"):
+    """Build a pack for each model directory described in a table of ModelSets, see :class:`~pdrtpy.modelset.ModelSet`.  Relative paths are relative to the models directory (see :func:`~pdrtpy.pdrutils.model_dir`).
+
+    :param modelsetinfo: the table of ModelSets or its file name
+    :type modelsetinfo: str or :class:`astropy.table.Table`
+    :param format: the format of the table of ModelSets and the model tables. Default: "ipac"
+    :type format: str
+    :param ext: file extension of the model files. Default: "fits"
+    :type ext: str
+    :returns: the opened packs
+    :rtype: list of :class:`~pdrtpy.modelpack.ModelPack`
+    """
+    if type(modelsetinfo) is str:
+        modelsetinfo = Table.read(modelsetinfo,format=format)
+    packs = list()
+    done = set()
+    for row in modelsetinfo:
+        directory = os.path.join(model_dir(),str(row["path"]))
+        key = (directory,str(row["filename"]))
+        if key in done:
+            continue
+        done.add(key)
+        packs.append(build_pack(directory,table=str(row["filename"]),format=format,ext=ext))
+    return packs
+
+def main(argv=None):
+    """Command line interface to :func:`build_pack` and :func:`build_packs`"""
+    parser = argparse.ArgumentParser(prog="pdrtpy-pack",
+                                     description="Build packs of PDR model grids that ModelSets load without reading the FITS files.")
+    parser.add_argument("directory",nargs="?",help="directory containing the model FITS files and the model table")
+    parser.add_argument("--table",default="models.tab",help="file name of the model table in the directory. Default: %(default)s")
+    parser.add_argument("--modelsetinfo",help="table of ModelSets; build a pack for each of their model directories")
+    parser.add_argument("--format",default="ipac",help="format of the tables. Default: %(default)s")
+    parser.add_argument("--ext",default="fits",help="file extension of the model files. Default: %(default)s")
+    parser.add_argument("--output",help=f"output pack file. Default: {PACK_FILENAME} in the directory")
+    args = parser.parse_args(argv)
+    if (args.directory is None) == (args.modelsetinfo is None):
+        parser.error("give either a directory or --modelsetinfo")
+    if args.modelsetinfo is not None:
+        if args.output is not None:
+            parser.error("--output can not be used with --modelsetinfo")
+        packs = build_packs(args.modelsetinfo,format=args.format,ext=args.ext)
+    else:
+        packs = [build_pack(args.directory,table=args.table,format=args.format,ext=args.ext,filename=args.output)]
+    for p in packs:
+        print(f"Wrote {len(p)} models to {p.filename}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
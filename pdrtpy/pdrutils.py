@@ -1,8 +1,14 @@
 ### Utility code for PDR Toolbox.
 
 import datetime
+import io
+import time
 import os.path
+import tempfile
+import threading
 import warnings
+import zipfile
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 import numpy as np
@@ -21,6 +27,10 @@ _CM = u.Unit("cm")
 _CM2 = u.Unit("cm-2")
 _K = u.Unit("K")
 _KKMS = u.Unit("K km s-1")
+# the units of models whose FITS files do not give one
+_MODEL_UNIT_ = {"ratio": u.dimensionless_unscaled,
+                "intensity": _OBS_UNIT_,
+                "emissivity": "erg / (cm3 ion s)"}
 LOGE = np.log10(np.e)
 LN10 = np.log(10)
 
@@ -175,6 +185,164 @@ def table_dir():
     """
     return os.path.join(root_dir(),'tables/')
 
+def cache_dir():
+    """User-level cache directory for products derived from the models, including trailing slash.
+    This is the value of the environment variable PDRTPY_CACHE if set, otherwise
+    `pdrtpy` under XDG_CACHE_HOME (default ~/.cache).  The directory is not created by this method.
+
+    :rtype: str
+    """
+    d = os.environ.get("PDRTPY_CACHE",None)
+    if d is None:
+        base = os.environ.get("XDG_CACHE_HOME",os.path.join(os.path.expanduser("~"),".cache"))
+        d = os.path.join(base,"pdrtpy")
+    return os.path.join(d,'')
+
+_EXTRACT_BUDGET_ = 512*1024*1024
+"""Default maximum number of bytes of model files extracted from model archives into the cache directory"""
+
+def extract_budget():
+    """Maximum number of bytes of model files extracted from model archives that are kept in the cache directory. This is the value of the environment variable PDRTPY_CACHE_SIZE if set, otherwise 512 MB.
+
+    :rtype: int
+    """
+    return int(os.environ.get("PDRTPY_CACHE_SIZE",_EXTRACT_BUDGET_))
+
+def model_archive(path):
+    """The compressed archive holding the model set in the given path, if that model set is distributed as an archive.
+    A model set in `path` may be shipped as a zip file named after its directory, e.g. `wolfirekaufman/version2006/constant_density/z=1.zip`, containing its `models.tab` and FITS files.  If the directory itself exists it is used instead.
+
+    :param path: path to the model set relative to the models directory, including trailing slash
+    :type path: str
+    :returns: fully qualified archive file name or None if there is no archive or the model set directory exists
+    :rtype: str
+    """
+    if os.path.isdir(model_dir()+path):
+        return None
+    archive = model_dir()+path.rstrip("/")+".zip"
+    if os.path.exists(archive):
+        return archive
+    return None
+
+def model_file(path,filename):
+    """Fully qualified name of a file in a model set that can be opened for reading.  If the model set is distributed as an archive (see :func:`model_archive`), the file is extracted into the cache directory (see :func:`cache_dir`) on first use, and again if the archive changes. The least recently used extracted files are removed when they use more than :func:`extract_budget` bytes.
+
+    :param path: path to the model set relative to the models directory, including trailing slash
+    :type path: str
+    :param filename: the file name, no path
+    :type filename: str
+    :rtype: str
+    """
+    archive = model_archive(path)
+    if archive is None:
+        return model_dir()+path+filename
+    target = os.path.join(_extract_dir(),_safe_path(path),filename)
+    # extracted files keep the modification time of the archive they came from,
+    # and their access time marks when they were last used.
+    mtime = os.stat(archive).st_mtime_ns
+    try:
+        st = os.stat(target)
+    except OSError:
+        st = None
+    if st is not None and st.st_mtime_ns == mtime:
+        os.utime(target,ns=(time.time_ns(),mtime))
+        _use_extracted(target,st.st_size)
+        return target
+    with zipfile.ZipFile(archive) as z:
+        try:
+            info = z.getinfo(filename)
+        except KeyError:
+            # return the name the file would have so that the reader raises the usual error
+            return model_dir()+path+filename
+        os.makedirs(os.path.dirname(target),exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=os.path.dirname(target),suffix=".tmp")
+        try:
+            with os.fdopen(fd,"wb") as f, z.open(info) as member:
+                while True:
+                    chunk = member.read(1024*1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.utime(tmp,ns=(time.time_ns(),mtime))
+            _default_permissions(tmp)
+            os.replace(tmp,target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    _use_extracted(target,info.file_size)
+    return target
+
+def make_model_archive(path,compression=zipfile.ZIP_DEFLATED):
+    """Write the model set in the given path to a single compressed archive next to its directory. See :func:`model_archive`.  The directory may be removed afterwards to distribute only the archive.
+
+    :param path: path to the model set relative to the models directory, including trailing slash
+    :type path: str
+    :param compression: zip compression method. Default: :data:`zipfile.ZIP_DEFLATED`
+    :type compression: int
+    :returns: fully qualified archive file name
+    :rtype: str
+    """
+    directory = model_dir()+path
+    archive = directory.rstrip("/")+".zip"
+    with zipfile.ZipFile(archive,"w",compression=compression) as z:
+        for f in sorted(os.listdir(directory)):
+            if f.endswith(".tab") or f.endswith(".fits"):
+                z.write(os.path.join(directory,f),arcname=f)
+    return archive
+
+def _default_permissions(filename):
+    """Give a file made by :func:`tempfile.mkstemp`, which only its owner can read, the permissions a file made by open() would have, so that files in a shared cache or model directory can be read by other users"""
+    # the umask can only be read by setting it.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(filename,0o666 & ~umask)
+
+def _extract_dir():
+    return os.path.join(cache_dir(),"models")
+
+def _safe_path(path):
+    """Model set path with empty, current, and parent directory components removed, for use under the cache directory"""
+    return os.path.join(*[p for p in path.split("/") if p not in ("",".","..")] or ["."])
+
+# Files extracted from model archives, from least to most recently used, with their sizes and
+# total size, keyed by extraction directory.  Each directory is scanned once, on first use.
+_extracted = dict()
+_extracted_lock = threading.Lock()
+
+def _use_extracted(target,size):
+    """Record that a file extracted from a model archive was used, and remove least recently used extracted files until they fit in :func:`extract_budget` bytes"""
+    with _extracted_lock:
+        directory = _extract_dir()
+        if directory not in _extracted:
+            _extracted[directory] = _scan_extracted(directory)
+        files,total = _extracted[directory]
+        total += size - files.pop(target,0)
+        files[target] = size
+        budget = extract_budget()
+        while total > budget and len(files) > 1:
+            f,fsize = files.popitem(last=False)
+            total -= fsize
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        _extracted[directory] = (files,total)
+
+def _scan_extracted(directory):
+    """The files in the extraction directory, from least to most recently used, with their sizes, and their total size"""
+    found = list()
+    for root,dirs,names in os.walk(directory):
+        for n in names:
+            f = os.path.join(root,n)
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            found.append((st.st_atime_ns,f,st.st_size))
+    files = OrderedDict((f,size) for atime,f,size in sorted(found))
+    return files,sum(files.values())
+
 def _tablename(filename):
     """Return fully qualified path of the input table.
 
@@ -192,14 +360,17 @@ def get_table(filename,format='ipac',path=None):
     :type filename: str
     :param format:  file format, Default: "ipac"
     :type format: str
-    :param  path: path to filename relative to models directory.  Default of None means look in "tables" directory
+    :param  path: path to filename relative to models directory.  Default of None means look in "tables" directory. If the model set in `path` is distributed as an archive (see :func:`model_archive`), the table is read directly from the archive.
     :type path: str
     :rtype: :class:`astropy.table.Table`
     """
     if path is None:
         return Table.read(_tablename(filename),format=format)
-    else:
+    archive = model_archive(path)
+    if archive is None:
         return Table.read(model_dir()+path+filename,format=format)
+    with zipfile.ZipFile(archive) as z:
+        return Table.read(io.BytesIO(z.read(filename)),format=format)
 
 #########################
 # FITS KEYWORD utilities
@@ -604,6 +775,24 @@ def is_ratio(identifier):
     # in our case, also rule out that the / is in the zeroth position.
     return identifier.find('/') > 0
 
+def _model_unit(identifier,default_unit=_MODEL_UNIT_):
+    """The unit and model type of a model that is read without a unit, guessed from its identifier as :meth:`~pdrtpy.modelset.ModelSet.get_model` does
+
+    :param identifier: the model identifier, e.g. "CII_158" or "OI_63/CII_158"
+    :type identifier: str
+    :param default_unit: the units of ratio and intensity models. Default: the units of the shipped models
+    :type default_unit: dict
+    :returns: the unit and the model type
+    :rtype: tuple
+    """
+    # @TODO Fix this: see issues 66 & 67
+    if identifier == "TS":
+        return "K","intensity" #??'temperature'
+    elif '/' in identifier:
+        return default_unit["ratio"],"ratio"
+    else:
+        return default_unit["intensity"],"intensity" #this is wrong for emissivity modeltypes
+
 def is_even(number):
     """ Check if number is even
 
@@ -631,41 +820,30 @@ def _has_H2(ids):
     return _has_substring('H2',ids)
 
 def _trim_to_H2(image):
-    '''H2 models in wk2006 are a smaller grid 17x17 vs 25x29. So when performing operations
-    involving other models, we have to trim the other models to 17x17;  log(n,G0) from 1 to 5
+    '''Deprecated, use :func:`~pdrtpy.modelset.align_models`.  Trim a model to the grid of the wk2006 H2 models, log(n,G0) from 1 to 5.
 
     :param image: the model to trim
     :type image: :class:`~pdrtpy.measurement.Measurement`
-    :returns: the trimmed model
+    :returns: a view onto the trimmed model
     :rtype: :class:`~pdrtpy.measurement.Measurement`
     '''
-    f = deepcopy(image)
-    #Slice the WCS. Note this is in numpy array order, not WCS axis order
-    f.wcs = f.wcs[6:23,0:17]
-    f.data = f.data[6:23,0:17]
-    f.meta['NAXIS1'] = 17
-    f.meta['NAXIS2'] = 17
-    comment("Trimmed model",f)
-    return f
+    warnings.warn("_trim_to_H2 is deprecated, use pdrtpy.modelset.align_models instead",DeprecationWarning,stacklevel=2)
+    from .modelset import ModelSet, align_models
+    h2 = ModelSet("wk2006",z=1).get_model("H200S1/H200S0")
+    return align_models([h2,image])[1]
 
 def _trim_all_to_H2(models):
-    '''H2 models in wk2006 are a smaller grid 17x17 vs 25x29. So when performing operations
-    involving other models, we have to trim the other models to 17x17;  log(n,G0) from 1 to 5
+    '''Deprecated, use :func:`~pdrtpy.modelset.align_models`.  Trim models in place to the grid of the H2 models among them.
 
     :param models: models to trim
     :type models: :list or dict of class:`~pdrtpy.measurement.Measurement`
     '''
+    warnings.warn("_trim_all_to_H2 is deprecated, use pdrtpy.modelset.align_models instead",DeprecationWarning,stacklevel=2)
+    from .modelset import align_models
     if type(models) is dict:
-        for id in models:
-            if "H2" not in id:
-                models[id] = _trim_to_H2(models[id])
+        models.update(align_models(models))
     else:
-        # have to iterate over index to ensure "pass by reference"
-        # if we did for m in models: m = ..., then models
-        # remains unchanged at end of function.  Wheee, python!
-        for j in range(len(models)):
-            if "H2" not in models[j].id:
-                models[j] = _trim_to_H2(models[j])
+        models[:] = align_models(models)
 
 def get_xy_from_wcs(data,quantity=False,linear=False):
     """Get the x,y axis vectors from the WCS of the input image.
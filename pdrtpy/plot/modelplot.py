@@ -12,6 +12,7 @@ from matplotlib.cm import ScalarMappable
 
 from .plotbase import PlotBase
 from ..measurement import Measurement
+from ..modelset import align_models
 from .. import pdrutils as utils
 
 class ModelPlot(PlotBase):
@@ -173,10 +174,11 @@ class ModelPlot(PlotBase):
         ids = [m.id for m in measurements]
         meas = dict(zip(ids,measurements))
         models = [self._modelset.get_model(i) for i in ids]
-        # need to trim model grids if H2 is present
-        if utils._has_H2(ids) and self._modelset.is_wk2006:
-            warnings.warn("Trimming all model grids to match H2 grid: log(n) = 1-5, log(G0) = 1-5")
-            utils._trim_all_to_H2(models)
+        # need to trim model grids if they have different axes, e.g. wk2006 H2
+        aligned = align_models(models)
+        if any(a is not m for a,m in zip(aligned,models)):
+            warnings.warn("Trimming all model grids to their common axes")
+        models = aligned
         i =0
         nratio = 0
         nintensity = 0
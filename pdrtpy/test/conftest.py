@@ -0,0 +1,19 @@
+# Keep model packs and other products derived from the models that the
+# tests build out of the user cache directory.
+import os
+import shutil
+import tempfile
+
+import pytest
+
+@pytest.fixture(scope="session",autouse=True)
+def pdrtpy_cache():
+    tmp = tempfile.mkdtemp()
+    cache = os.environ.get("PDRTPY_CACHE",None)
+    os.environ["PDRTPY_CACHE"] = tmp
+    yield tmp
+    if cache is None:
+        del os.environ["PDRTPY_CACHE"]
+    else:
+        os.environ["PDRTPY_CACHE"] = cache
+    shutil.rmtree(tmp,ignore_errors=True)
@@ -0,0 +1,33 @@
+import unittest
+import subprocess
+import sys
+import pdrtpy.pdrutils as utils
+
+# Imports every pdrtpy module with an audit hook that records any file
+# opened under the model and table directories.
+_SCRIPT = """
+import os, pkgutil, importlib, sys
+import pdrtpy
+watched = [os.path.realpath(d) for d in sys.argv[1:]]
+touched = []
+def hook(event, args):
+    if event == "open" and args and isinstance(args[0], (str, bytes, os.PathLike)):
+        path = os.path.realpath(os.fsdecode(args[0]))
+        if any(path.startswith(w + os.sep) for w in watched):
+            touched.append(path)
+sys.addaudithook(hook)
+for m in pkgutil.walk_packages(pdrtpy.__path__, "pdrtpy."):
+    if not m.name.startswith("pdrtpy.test"):
+        importlib.import_module(m.name)
+print("\\n".join(touched))
+"""
+
+class TestImport(unittest.TestCase):
+    def test_import_does_not_read_models(self):
+        print("Import Unit Test")
+        out = subprocess.run([sys.executable, "-c", _SCRIPT, utils.model_dir(), utils.table_dir()],
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "", msg=f"Importing pdrtpy read {out.stdout}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from pdrtpy.modelset import ModelSet
+from pdrtpy.measurement import Measurement
+from pdrtpy.tool.intensityfit import IntensityFit
+
+class TestIntensityFit(unittest.TestCase):
+    def test_filling_factor(self):
+        print("IntensityFit Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        # a 2x3 map of the model intensities at six grid points, scaled by 0.3
+        iy = np.array([[20,25,30],[35,40,45]])
+        ix = np.array([[10,15,20],[25,30,35]])
+        observations = list()
+        for line in ["CII_158","OI_63","CO_10","CI_609"]:
+            m = ms.get_model(line)
+            data = 0.3*np.squeeze(m.data)[iy,ix]
+            observations.append(Measurement(data=data,uncertainty=StdDevUncertainty(0.1*data),
+                                            identifier=line,unit=m.unit))
+        f = IntensityFit(ms,measurements=observations)
+        f.run()
+        self.assertEqual(f.observed_intensities,["CII_158","OI_63","CO_10","CI_609"])
+        x,y = ms.get_model("CII_158")._world_axis_lin
+        self.assertTrue(np.allclose(f.density.data,np.asarray(x)[ix]))
+        self.assertTrue(np.allclose(f.radiation_field.data,np.asarray(y)[iy]))
+        self.assertTrue(np.allclose(f.filling_factor.data,0.3))
+        self.assertTrue(np.allclose(f.chisq(min=True).data,0,atol=1E-12))
+        # 4 intensities and 3 fitted parameters
+        self.assertEqual(f._dof,1)
+        # masked pixels are not fit
+        mask = np.array([[False,False,True],[False,False,False]])
+        observations[1].mask = mask
+        f = IntensityFit(ms,measurements=observations)
+        f.run()
+        observations[1].mask = None
+        for image in [f.density,f.filling_factor,f.chisq(min=True)]:
+            self.assertTrue(np.isnan(image.data[0,2]))
+            self.assertTrue(np.array_equal(image.mask,mask))
+        self.assertTrue(np.allclose(f.density.data[~mask],np.asarray(x)[ix][~mask]))
+        # 3 intensities leave no degrees of freedom
+        f = IntensityFit(ms,measurements=observations[0:3])
+        with self.assertWarnsRegex(UserWarning,"no degrees of freedom"):
+            f.run()
+        self.assertEqual(f._dof,0)
+        self.assertTrue(np.all(np.isnan(f.reduced_chisq(min=True).data)))
+        # an upper limit on the filling factor
+        f = IntensityFit(ms,measurements=observations,max_filling_factor=0.2)
+        f.run()
+        self.assertTrue(np.all(f.filling_factor.data <= 0.2))
+        self.assertTrue(np.all(f.chisq(min=True).data > 0))
+        # too few intensities
+        f = IntensityFit(ms,measurements=observations[0:2])
+        self.assertRaises(Exception,f.run)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import astropy.units as u
+from astropy.nddata import StdDevUncertainty
+from pdrtpy.modelset import ModelSet
+from pdrtpy.measurement import Measurement, MeasurementBatch
+from pdrtpy.tool.lineratiofit import LineRatioFit
+
+class TestLineRatioFit(unittest.TestCase):
+    def test_clip(self):
+        print("LineRatioFit clip Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        # the model intensities at n = 316 cm-3
+        observations = list()
+        for line in ["CII_158","OI_63","CO_10","OI_145"]:
+            m = ms.get_model(line)
+            data = np.squeeze(m.data)[10,12]
+            observations.append(Measurement(data=data,uncertainty=StdDevUncertainty(0.1*data),
+                                            identifier=line,unit=m.unit))
+        p = LineRatioFit(ms,measurements=observations)
+        p.run()
+        full = p._modelratios["OI_63/CII_158"].data.shape
+        self.assertTrue(200 < p.density.value < 500)
+        # a density range that excludes the solution bounds it
+        nclip = [1E3,5E4]*u.Unit("cm-3")
+        p.run(nax1_clip=nclip)
+        self.assertLess(p._modelratios["OI_63/CII_158"].data.shape[-1],full[-1])
+        self.assertTrue(1E3 <= p.density.value <= 5E4)
+        self.assertRaises(ValueError,p.run,nax1_clip=[1E9,1E10])
+        # the analytic Jacobian gives the same fit
+        p.run(nax1_clip=nclip)
+        density = p.density.value
+        p.run(nax1_clip=nclip,jacobian=True)
+        self.assertTrue(np.isclose(p.density.value,density,rtol=1E-3))
+        # a first guess at the bound of the range is fit with finite differences
+        nclip = [2E3,5E4]*u.Unit("cm-3")
+        p.run(nax1_clip=nclip)
+        density = p.density.value
+        with self.assertWarnsRegex(UserWarning,"finite differences"):
+            p.run(nax1_clip=nclip,jacobian=True)
+        self.assertTrue(np.isclose(p.density.value,density,rtol=1E-3))
+
+    def test_batch(self):
+        print("LineRatioFit MeasurementBatch Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        # a catalog of the model intensities at five grid points
+        iy = np.array([10,15,20,25,30])
+        ix = np.array([10,20,30,15,25])
+        lines = ["CII_158","OI_63","CO_10","OI_145"]
+        data = np.concatenate([np.squeeze(ms.get_model(k).data)[iy,ix] for k in lines])
+        batch = MeasurementBatch(np.repeat(lines,len(iy)),data,0.1*data,
+                                 unit=ms.get_model("CII_158").unit)
+        p = LineRatioFit(ms,measurements=batch)
+        p.run(refine=False)
+        self.assertTrue(p.has_vectors)
+        self.assertEqual(p.density.data.shape,(len(iy),))
+        x,y = ms.get_model("CII_158")._world_axis_lin
+        # the ratio grids are close to but not exactly ratios of the intensity grids
+        self.assertTrue(np.allclose(np.log10(p.density.data),np.log10(np.asarray(x)[ix]),atol=0.3))
+        # first guesses from the KD-tree index
+        p.run(refine=False,coarse='index')
+        self.assertTrue(np.allclose(np.log10(p.density.data),np.log10(np.asarray(x)[ix]),atol=0.3))
+        self.assertEqual(p.chisq(min=True).data.shape,(len(iy),))
+        self.assertRaises(Exception,p.chisq)
+        self.assertRaises(Exception,p.reduced_chisq)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 import unittest
-from pdrtpy.measurement import Measurement
+from pdrtpy.measurement import Measurement, MeasurementBatch
+from pdrtpy.modelset import ModelSet
 import pdrtpy.pdrutils as utils
 from astropy.nddata import StdDevUncertainty
 import astropy.units as u
 import numpy as np
 import os
+from astropy.table import Table
 
 class TestMeasurement(unittest.TestCase):
     def test_arithmetic(self):
@@ -51,6 +53,98 @@ class TestMeasurement(unittest.TestCase):
             self.assertTrue(m[q].unit == u.adu)
     #@todo add operations with numerics (e.g. m*3.14)
 
+    def test_inplace(self):
+        print("Measurement in-place arithmetic Unit Test")
+        d = np.array([[1.0,2.0],[3.0,4.0]])
+        a = Measurement(d.copy(),uncertainty=StdDevUncertainty(0.1*d),identifier="CII_158",unit="erg s-1 cm-2 sr-1")
+        b = Measurement(2*d,uncertainty=StdDevUncertainty(0.2*d),identifier="OI_63",unit="W m-2 sr-1")
+        b.mask = d > 3
+        r = a/b
+        # the result has its own header
+        self.assertIsNot(r.header,a.header)
+        self.assertEqual(r.header["BUNIT"],str(r.unit))
+        # units are combined, not converted
+        self.assertTrue(np.allclose(r.data,0.5))
+        self.assertTrue(np.allclose(r.error,0.5*np.sqrt(0.1**2+0.1**2)))
+        self.assertAlmostEqual(r.unit.to(""),1E-3)
+        self.assertTrue(np.array_equal(r.mask,b.mask))
+        data = a.data
+        a /= b
+        self.assertIs(a.data,data)
+        self.assertEqual(a.id,"CII_158/OI_63")
+        self.assertEqual(a.unit,r.unit)
+        self.assertTrue(np.allclose(a.data,r.data))
+        self.assertTrue(np.allclose(a.error,r.error))
+        a = Measurement(d.copy(),uncertainty=StdDevUncertainty(0.1*d),identifier="CII_158",unit="erg s-1 cm-2 sr-1")
+        a += b
+        self.assertEqual(a.unit,u.Unit("erg s-1 cm-2 sr-1"))
+        self.assertTrue(np.allclose(a.data,2001*d))
+        self.assertTrue(np.allclose(a.error,np.sqrt((0.1*d)**2+(200*d)**2)))
+        a *= 2.0
+        self.assertTrue(np.allclose(a.data,4002*d))
+        self.assertEqual(a.id,"CII_158+OI_63")
+
+    def test_batch(self):
+        print("MeasurementBatch Unit Test")
+        files = [utils.get_testdata(f) for f in ["rcw49_nc_cii158.tab","rcw49_nc_co32.tab","rcw49_nc_fir.tab"]]
+        b = MeasurementBatch.from_table(files)
+        self.assertEqual(b.identifiers,["CII_158","CO_32","FIR"])
+        for f,k in zip(files,b.identifiers):
+            m = Measurement.from_table(f)
+            self.assertEqual(b.size,m.data.size)
+            self.assertTrue(np.allclose(b.data(k),m.data))
+            self.assertTrue(np.allclose(b.error(k),m.error))
+            v = b.measurement(k)
+            self.assertTrue(np.shares_memory(v.data,b.data(k)))
+            self.assertEqual(v.unit,m.unit)
+        # rows aligned by source; a missing measurement is masked
+        t = Table([[1.0,2.0,3.0],[0.1,0.2,0.3],["CII_158","OI_63","CII_158"],["a","b","b"]],
+                  names=["data","uncertainty","identifier","source"])
+        b = MeasurementBatch.from_table(t)
+        self.assertEqual(list(b.sources),["a","b"])
+        # unitless data are in adu, as for the constructor
+        self.assertEqual(b.units,MeasurementBatch(t["identifier"],t["data"],t["uncertainty"],sources=t["source"]).units)
+        self.assertEqual(b.units["CII_158"],u.adu)
+        self.assertRaises(KeyError,b.data,"CO_10")
+        self.assertNotIn("CO_10",b)
+        self.assertTrue(np.array_equal(b.data("CII_158"),[1.0,3.0]))
+        m = b.measurement("OI_63")
+        self.assertTrue(np.isnan(m.data[0]) and m.data[1] == 2.0)
+        self.assertTrue(np.array_equal(m.mask,[True,False]))
+        # without sources every identifier needs the same number of rows
+        t.remove_column("source")
+        self.assertRaises(ValueError,MeasurementBatch.from_table,t)
+
+    def test_interpolation(self):
+        print("Measurement interpolation Unit Test")
+        m = ModelSet("wk2006",z=1).get_model("OI_63/CII_158")
+        x,y = m._world_axis_lin
+        # interpolators are built on first use
+        r = m / 2.0
+        self.assertIsNone(r._interp)
+        self.assertTrue(np.allclose(r.get(x[3],y[5]),m.data[5,3]/2))
+        self.assertIsNotNone(r._interp)
+        # all combinations, or points, in one call
+        self.assertEqual(m.get(x[3:5],y[5:8]).shape,(3,2))
+        self.assertTrue(np.allclose(m.get(x[3:7],y[5:9],grid=False),m.data[[5,6,7,8],[3,4,5,6]]))
+        self.assertTrue(np.allclose(m.get(np.log10(x[3]),np.log10(y[5]),log=True),m.data[5,3]))
+        # halfway between grid points
+        self.assertTrue(np.allclose(m.get((x[3]+x[4])/2,y[5]),(m.data[5,3]+m.data[5,4])/2))
+        self.assertRaises(ValueError,m.get,1E12,y[5])
+        # new data are interpolated
+        r.data = 2*m.data
+        self.assertTrue(np.allclose(r.get(x[3],y[5]),2*m.data[5,3]))
+        # an axis with a negative CDELT1 is interpolated too
+        wcs = m.wcs.deepcopy()
+        wcs.wcs.cdelt[0] = -wcs.wcs.cdelt[0]
+        wcs.wcs.crpix[0] = m.data.shape[-1]+1-wcs.wcs.crpix[0]
+        f = Measurement(data=m.data[:,::-1],unit=m.unit,wcs=wcs,identifier=m.id)
+        fx = f._world_axis_lin[0]
+        self.assertTrue(fx[0] > fx[-1])
+        self.assertTrue(np.allclose(fx[::-1],x))
+        self.assertTrue(np.allclose(f.get(x[3:7],y[5:9],grid=False),m.data[[5,6,7,8],[3,4,5,6]]))
+        self.assertTrue(np.allclose(f.get((x[3]+x[4])/2,y[5]),(m.data[5,3]+m.data[5,4])/2))
+
     def test_read_write(self):
         # Get the input filenames of the FITS files in the testdata directory
         # These are maps from Jameson et al 2018.
@@ -83,12 +177,52 @@ class TestMeasurement(unittest.TestCase):
         self.assertTrue(oi_meas.wcs._naxis == [81, 139])
         self.assertTrue(np.all(oi_meas.wcs.wcs.crval== np.array([ 12.10878606, -73.33488267])))
         self.assertTrue((np.round(1E7*np.nanmax(oi_meas.data),3)) == 2.481)
+        # the mask covers the pixels without a finite value or error
+        for m in [cii_meas,FIR_meas,oi_meas]:
+            self.assertTrue(np.array_equal(m.mask,~np.isfinite(m.data) | ~np.isfinite(m.error)))
+
+        # memory-mapped planes give the same Measurement
+        oi_mmap = Measurement.read(oi_combined, identifier="OI_63", memmap=True)
+        self.assertTrue(oi_mmap.is_memmap())
+        self.assertFalse(Measurement.read(oi_combined, identifier="OI_63", memmap=False).is_memmap())
+        self.assertTrue(np.array_equal(oi_mmap.data,oi_meas.data,equal_nan=True))
+        self.assertTrue(np.array_equal(oi_mmap.error,oi_meas.error,equal_nan=True))
+        self.assertTrue(np.array_equal(oi_mmap.mask,oi_meas.mask))
+        self.assertTrue(oi_mmap.unit == oi_meas.unit)
+        r = oi_mmap/cii_meas
+        self.assertTrue(np.allclose(r.data,(oi_meas/cii_meas).data,equal_nan=True))
+        # memory-mapped planes take the same parameters
+        unit = u.Unit("erg s-1 cm-2 sr-1")
+        for memmap in [True,False]:
+            m = Measurement.read(oi_combined, identifier="OI_63", memmap=memmap, unit=unit)
+            self.assertEqual(m.unit,unit)
+            self.assertEqual(m.uncertainty.unit,unit)
+            self.assertIsNone(Measurement.read(oi_combined, identifier="OI_63", memmap=memmap, hdu_uncertainty=None).uncertainty)
+            self.assertIsNone(Measurement.read(oi_combined, identifier="OI_63", memmap=memmap, hdu_mask=None).mask)
+
+        # lists of files written in many small sections give the same Measurements
+        import pdrtpy.measurement as pm
+        section_size = pm._SECTION_SIZE_
+        pm._SECTION_SIZE_ = 1000
+        try:
+            Measurement.make_measurement([cii_flux,oi_flux],[cii_err,oi_err],
+                                         [cii_combined+".2",oi_combined+".2"],overwrite=True)
+        finally:
+            pm._SECTION_SIZE_ = section_size
+        for f,m in [(cii_combined,cii_meas),(oi_combined,oi_meas)]:
+            s = Measurement.read(f+".2")
+            self.assertTrue(np.array_equal(s.data,m.data,equal_nan=True))
+            self.assertTrue(np.array_equal(s.error,m.error,equal_nan=True))
+            self.assertTrue(np.array_equal(s.mask,m.mask))
+            self.assertTrue(s.unit == m.unit)
 
     def tearDown(self):
         print('cleaning up '+utils.testdata_dir())
         files = ["n22_cii_flux_error.fits",
                  "n22_oi_flux_error.fits",
-                 "n22_FIR_flux_error.fits"
+                 "n22_FIR_flux_error.fits",
+                 "n22_cii_flux_error.fits.2",
+                 "n22_oi_flux_error.fits.2"
                 ]
         for f in files:
             try:
@@ -1,6 +1,19 @@
 # test modelset.ModelSet
 import unittest
-from pdrtpy.modelset import ModelSet
+import os
+import shutil
+import stat
+import tempfile
+import numpy as np
+import pdrtpy.pdrutils as utils
+from astropy.table import Table
+from astropy.io import fits
+from pdrtpy.modelset import ModelSet, model_gradient, align_models, clip_models
+import astropy.units as u
+from pdrtpy.modelsurrogate import upsample_model, model_checksum, model_spline
+from pdrtpy.measurement import Measurement
+from pdrtpy.modelpack import PACK_FILENAME, data_checksum
+from pdrtpy.packbuilder import build_packs
 
 class TestModelSet(unittest.TestCase):
     def test_existence(self):
@@ -23,5 +36,495 @@ class TestModelSet(unittest.TestCase):
                 print("Couldn't open these models:",failed)
             self.assertTrue(success)
 
+    def test_pack(self):
+        print("ModelSet pack Unit Test")
+        ms = ModelSet("wk2006",z=1)
+        self.assertIsNotNone(ms.pack)
+        for r in ["CII_158/CO_10","H200S1/H200S0","FIR"]:
+            packed = ms.get_model(r)
+            direct = Measurement.read(packed.filename,identifier=r)
+            self.assertTrue(np.array_equal(packed.data,direct.data,equal_nan=True))
+            self.assertEqual(packed.wcs._naxis,direct.wcs._naxis)
+            self.assertTrue(np.all(packed.wcs.wcs.crval == direct.wcs.wcs.crval))
+            self.assertTrue(np.all(packed.wcs.wcs.cdelt == direct.wcs.wcs.cdelt))
+            self.assertEqual(list(packed.wcs.wcs.ctype),list(direct.wcs.wcs.ctype))
+            self.assertEqual(packed.header["CUNIT2"],"Habing")
+        self.assertTrue(ms.pack.filename.startswith(utils.cache_dir()))
+        # models whose files have no BUNIT are in the pack too
+        ms3 = ModelSet("wk2006",z=3)
+        self.assertEqual(len(ms3.pack),len(ms3.table))
+        self.assertTrue(np.shares_memory(ms3.get_model("H200S1/H200S0").data,ms3.pack.array("H200S1/H200S0")))
+        # a model file rewritten in place gets a new pack
+        tmp = tempfile.mkdtemp()
+        try:
+            shutil.copytree(utils.model_dir()+ms._tabrow["path"],os.path.join(tmp,"set"))
+            path = os.path.relpath(os.path.join(tmp,"set"),utils.model_dir())+"/"
+            info = Table(ms._tabrow.table,copy=True)
+            info["path"] = [path]
+            copied = ModelSet("wk2006",z=1,modelsetinfo=info)
+            m = copied.get_model("CII_158/CO_10")
+            thefile = m.filename
+            st = os.stat(os.path.dirname(thefile))
+            with fits.open(thefile,mode="update") as f:
+                f[0].data = 2*f[0].data
+            # as if only the file had changed
+            os.utime(os.path.dirname(thefile),ns=(st.st_atime_ns,st.st_mtime_ns))
+            ModelSet.model_cache().clear()
+            rewritten = ModelSet("wk2006",z=1,modelsetinfo=info)
+            self.assertNotEqual(rewritten.pack.checksum("CII_158/CO_10"),copied.pack.checksum("CII_158/CO_10"))
+            self.assertTrue(np.allclose(rewritten.get_model("CII_158/CO_10").data,2*m.data,equal_nan=True))
+        finally:
+            ModelSet.model_cache().clear()
+            shutil.rmtree(tmp)
+
+    def test_model_cache(self):
+        print("ModelSet cache Unit Test")
+        cache = ModelSet.model_cache()
+        cache.clear()
+        ms = ModelSet("wk2020",z=1)
+        m1 = ms.get_model("CII_158/FIR")
+        self.assertEqual(cache.misses,1)
+        # a second ModelSet for the same models shares the cached data
+        m2 = ModelSet("wk2020",z=1).get_model("CII_158/FIR")
+        self.assertIsNot(m1,m2)
+        self.assertIs(m1.data,m2.data)
+        self.assertEqual(cache.hits,1)
+        # the pack is memory-mapped, so it does not use the budget
+        self.assertEqual(cache.nbytes,0)
+        # changing a model does not change the cache
+        data = np.array(m1.data)
+        self.assertRaises(ValueError,m1.data.__setitem__,0,1.0)
+        m1 /= 2.0
+        m1.header["BUNIT"] = "K"
+        m2 = ms.get_model("CII_158/FIR")
+        self.assertTrue(np.array_equal(m2.data,data,equal_nan=True))
+        self.assertNotEqual(m2.header["BUNIT"],"K")
+        user = Measurement(data=data*2,unit=m2.unit,wcs=m2.wcs,identifier="CII_158/FIR")
+        ms.add_model("CII_158/FIR",user,title="doubled",overwrite=True)
+        self.assertIs(ms.get_model("CII_158/FIR"),user)
+        # other ModelSets still use the cached model
+        self.assertIn(ms._cache_key("CII_158/FIR",m2.unit,"fits"),cache)
+        self.assertTrue(np.array_equal(ModelSet("wk2020",z=1).get_model("CII_158/FIR").data,data,equal_nan=True))
+        # models read from a FITS file are memory-mapped too; only data held in memory count
+        m = Measurement(data,unit=m2.unit,wcs=m2.wcs,identifier="CII_158/FIR")
+        cache.put(("test",),m)
+        self.assertEqual(cache.nbytes,data.nbytes)
+        cache.invalidate(path="test")
+        cache.budget = 0
+        ModelSet("wk2020",z=1).get_model("OI_63/CII_158")
+        self.assertEqual(len(cache),0)
+        cache.budget = 128*1024*1024
+
+    def test_shared_catalog(self):
+        print("ModelSet shared catalog Unit Test")
+        a = ModelSet("wk2006",z=1)
+        b = ModelSet("wk2006",z=1)
+        self.assertIs(a.table,b.table)
+        self.assertIsNone(a._supported_ratios)
+        self.assertIn("CII_158/CO_10",a.supported_ratios["ratio label"])
+        self.assertIn("CII_158",a.identifiers["ID"])
+        m = a.get_model("CII_158/CO_10")
+        a.add_model("CII_158/XX",m,title="test")
+        # adding a model must not change the other ModelSet
+        self.assertIsNot(a.table,b.table)
+        self.assertNotIn("CII_158/XX",b.table["ratio"])
+        self.assertNotIn("CII_158/XX",b.supported_ratios["ratio label"])
+        self.assertIn("CII_158/XX",a.supported_ratios["ratio label"])
+        self.assertNotIn("CII_158/XX",ModelSet("wk2006",z=1).table["ratio"])
+
+    def test_ratio_index(self):
+        print("ModelSet ratio index Unit Test")
+        ms = ModelSet("wk2006",z=1)
+        m = ["CII_158","OI_63","FIR","CO_10"]
+        pairs = list(ms.find_pairs(m))
+        self.assertIn("OI_63+CII_158/FIR",pairs)
+        self.assertIn("CII_158/CO_10",pairs)
+        self.assertEqual(ms.ratiocount(m),len(pairs))
+        self.assertNotIn("CII_158/XX",list(ms.find_pairs(["CII_158","XX"])))
+        ms.add_model("CII_158/XX",ms.get_model("CII_158/CO_10"),title="test")
+        self.assertEqual(list(ms.find_pairs(["CII_158","XX"])),["CII_158/XX"])
+        self.assertEqual(ms._get_ratio_elements(["CII_158","XX"]),[{"numerator":"CII_158","denominator":"XX"}])
+
+    def test_get_models_parallel(self):
+        print("ModelSet parallel get_models Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        ids = ["CII_158","OI_145","OI_63","CO_10","CO_21","FIR"]
+        ModelSet.model_cache().clear()
+        serial = ms.get_models(ids,max_workers=1)
+        ModelSet.model_cache().clear()
+        parallel = ms.get_models(ids,max_workers=4)
+        self.assertEqual(list(serial.keys()),list(parallel.keys()))
+        self.assertEqual(set(ms.load_times.keys()),set(parallel.keys()))
+        for k in serial:
+            self.assertTrue(np.array_equal(serial[k].data,parallel[k].data,equal_nan=True))
+
+    def test_archive(self):
+        print("ModelSet archive Unit Test")
+        tmp = tempfile.mkdtemp()
+        cache = os.environ.get("PDRTPY_CACHE",None)
+        os.environ["PDRTPY_CACHE"] = os.path.join(tmp,"cache")
+        try:
+            ms = ModelSet("wk2006",z=1)
+            shutil.copytree(utils.model_dir()+ms._tabrow["path"],os.path.join(tmp,"set"))
+            path = os.path.relpath(os.path.join(tmp,"set"),utils.model_dir())+"/"
+            utils.make_model_archive(path)
+            shutil.rmtree(os.path.join(tmp,"set"))
+            info = Table(ms._tabrow.table,copy=True)
+            info["path"] = [path]
+            archived = ModelSet("wk2006",z=1,modelsetinfo=info)
+            # the pack is built from the archive
+            self.assertIsNotNone(archived.pack)
+            self.assertEqual(len(archived.pack),len(ms.pack))
+            self.assertEqual(len(archived.table),len(ms.table))
+            m = archived.get_model("CII_158/CO_10")
+            self.assertTrue(np.array_equal(m.data,ms.get_model("CII_158/CO_10").data,equal_nan=True))
+            # files are extracted one at a time, and only the model that was used is extracted
+            fnames = [f+".fits" for f in ms.table["filename"][:3]]
+            thefile = utils.model_file(path,fnames[0])
+            self.assertTrue(thefile.startswith(utils.cache_dir()))
+            self.assertEqual(os.listdir(os.path.dirname(thefile)),[fnames[0]])
+            # extracted files can be read by other users of a shared cache
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(stat.S_IMODE(os.stat(thefile).st_mode),0o666 & ~umask)
+            # a file extracted from an older archive is extracted again
+            archive = utils.model_archive(path)
+            st = os.stat(archive)
+            os.utime(archive,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+            os.truncate(thefile,0)
+            self.assertEqual(utils.model_file(path,fnames[0]),thefile)
+            self.assertGreater(os.path.getsize(thefile),0)
+            # the least recently used files are removed beyond the budget
+            os.environ["PDRTPY_CACHE_SIZE"] = str(2*os.path.getsize(thefile))
+            try:
+                for f in fnames:
+                    utils.model_file(path,f)
+            finally:
+                del os.environ["PDRTPY_CACHE_SIZE"]
+            self.assertEqual(sorted(os.listdir(os.path.dirname(thefile))),sorted(fnames[1:]))
+        finally:
+            if cache is None:
+                del os.environ["PDRTPY_CACHE"]
+            else:
+                os.environ["PDRTPY_CACHE"] = cache
+            ModelSet.model_cache().clear()
+            shutil.rmtree(tmp)
+
+    def test_packbuilder(self):
+        print("ModelSet pack builder Unit Test")
+        tmp = tempfile.mkdtemp()
+        try:
+            ms = ModelSet("wk2006",z=1)
+            shutil.copytree(utils.model_dir()+ms._tabrow["path"],os.path.join(tmp,"set"))
+            path = os.path.relpath(os.path.join(tmp,"set"),utils.model_dir())+"/"
+            info = Table(ms._tabrow.table,copy=True)
+            info["path"] = [path]
+            pack = build_packs(info)[0]
+            self.assertEqual(pack.filename,utils.model_dir()+path+PACK_FILENAME)
+            self.assertTrue(pack.verify())
+            # a pack in a shared install directory can be read by other users
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(stat.S_IMODE(os.stat(pack.filename).st_mode),0o666 & ~umask)
+            self.assertEqual(set(pack.tablenames),{"models","ratios","intensities","identifiers"})
+            packed = ModelSet("wk2006",z=1,modelsetinfo=info)
+            self.assertEqual(packed.pack.filename,pack.filename)
+            self.assertEqual(list(packed.table["ratio"]),list(ms.table["ratio"]))
+            self.assertEqual(list(packed.supported_ratios["ratio label"]),list(ms.supported_ratios["ratio label"]))
+            self.assertEqual(list(packed.supported_intensities["intensity label"]),list(ms.supported_intensities["intensity label"]))
+            self.assertEqual(list(packed.identifiers["ID"]),list(ms.identifiers["ID"]))
+            self.assertTrue(np.array_equal(packed.get_model("CII_158/CO_10").data,ms.get_model("CII_158/CO_10").data,equal_nan=True))
+            # a copy of the model directory uses its pack
+            shutil.copytree(os.path.join(tmp,"set"),os.path.join(tmp,"copy"),copy_function=shutil.copy)
+            info["path"] = [os.path.relpath(os.path.join(tmp,"copy"),utils.model_dir())+"/"]
+            self.assertIsNotNone(ModelSet("wk2006",z=1,modelsetinfo=info)._prebuilt_pack())
+            # a pack built from a different model file is not used
+            thefile = os.path.join(tmp,"copy",ms.table.loc["CII_158/CO_10"]["filename"]+".fits")
+            with fits.open(thefile,mode="update") as hdus:
+                hdus[0].data *= 2
+            self.assertIsNone(ModelSet("wk2006",z=1,modelsetinfo=info)._prebuilt_pack())
+            # a pack built from a different model table is not used
+            info["path"] = [path]
+            with open(os.path.join(tmp,"set",ms._tabrow["filename"]),"a") as f:
+                f.write("\n")
+            self.assertIsNone(ModelSet("wk2006",z=1,modelsetinfo=info)._prebuilt_pack())
+        finally:
+            ModelSet.model_cache().clear()
+            shutil.rmtree(tmp)
+
+    def test_table_changes(self):
+        print("ModelSet model table changes Unit Test")
+        tmp = tempfile.mkdtemp()
+        try:
+            ms = ModelSet("wk2006",z=1)
+            shutil.copytree(utils.model_dir()+ms._tabrow["path"],os.path.join(tmp,"set"))
+            info = Table(ms._tabrow.table,copy=True)
+            info["path"] = [os.path.relpath(os.path.join(tmp,"set"),utils.model_dir())+"/"]
+            copied = ModelSet("wk2006",z=1,modelsetinfo=info)
+            self.assertIn("CII_158/CO_10",copied._get_ratio_index())
+            # a changed model table is read again by new ModelSets
+            tablefile = os.path.join(tmp,"set",ms._tabrow["filename"])
+            t = Table.read(tablefile,format="ipac")
+            t.remove_rows(np.nonzero(t["ratio"] == "CII_158/CO_10")[0])
+            t.write(tablefile,format="ipac",overwrite=True)
+            st = os.stat(tablefile)
+            os.utime(tablefile,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+            changed = ModelSet("wk2006",z=1,modelsetinfo=info)
+            self.assertEqual(len(changed.table),len(copied.table)-1)
+            self.assertNotIn("CII_158/CO_10",changed._get_ratio_index())
+            self.assertIn("CII_158/CO_10",copied._get_ratio_index())
+        finally:
+            ModelSet.model_cache().clear()
+            shutil.rmtree(tmp)
+
+    def test_shared_axes(self):
+        print("ModelSet shared axes Unit Test")
+        ModelSet.model_cache().clear()
+        ms = ModelSet("wk2006",z=1)
+        a = ms.get_model("CII_158/CO_10")
+        b = ms.get_model("OI_63/CII_158")
+        self.assertIs(a.wcs,b.wcs)
+        self.assertIs(a._world_axis,b._world_axis)
+        self.assertEqual(a.header["CUNIT2"],"Habing")
+        self.assertEqual(a.header["CUNIT1"],b.header["CUNIT1"])
+        # H2 grids have different axes
+        h = ms.get_model("H200S1/H200S0")
+        self.assertIsNot(a.wcs,h.wcs)
+
+    def test_query(self):
+        print("ModelSet query Unit Test")
+        self.assertEqual(len(ModelSet.query()),len(ModelSet.all_sets()))
+        kt = ModelSet.query(code="KOSMA-tau",medium="clumpy",mass=lambda m: m >= 100)
+        self.assertTrue(len(kt) > 0)
+        for ms in kt:
+            self.assertEqual(ms.code,"KOSMA-tau")
+            self.assertEqual(ms.medium,"clumpy")
+            self.assertTrue(ms._tabrow["mass"] >= 100)
+        wk = ModelSet.query(name=["wk2006","wk2020"],z=1)
+        self.assertEqual(sorted(m.name for m in wk),["wk2006","wk2020"])
+        # Wolfire/Kaufman models have no mass
+        self.assertTrue(all(m.code == "KOSMA-tau" for m in ModelSet.query(mass=10)))
+        self.assertIs(wk[0].table,ModelSet(wk[0].name,z=1).table)
+
+    def test_gradient(self):
+        print("ModelSet gradient Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        m = ms.get_model("CII_158/CO_10")
+        dx,dy = ms.get_gradient("CII_158/CO_10")
+        ny,nx = m.data.shape
+        self.assertEqual(dx.shape,(ny,nx-1))
+        self.assertEqual(dy.shape,(ny-1,nx))
+        # computed once for the model data, and again for new data
+        self.assertIs(model_gradient(m)[0],dx)
+        c = Measurement(m.data,unit=m.unit,wcs=m.wcs,header=m.header,identifier=m.id)
+        self.assertIs(model_gradient(c)[0],dx)
+        c = m.copy()
+        self.assertIsNot(model_gradient(c)[0],dx)
+        self.assertTrue(np.array_equal(model_gradient(c)[0],dx))
+        x,y = m._world_axis
+        self.assertAlmostEqual(dx[10,20],(m.data[10,21]-m.data[10,20])/(x[21]-x[20]))
+        self.assertAlmostEqual(dy[10,20],(m.data[11,20]-m.data[10,20])/(y[11]-y[10]))
+
+    def test_surrogate(self):
+        print("ModelSet surrogate Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        ids = ["CII_158","OI_63","CO_10","FIR"]
+        s = ms.get_surrogate(ids)
+        self.assertIs(s,ms.get_surrogate(ids))
+        models = ms.get_models(ids)
+        self.assertEqual(s.identifiers,list(models.keys()))
+        # the splines are computed once for the model data
+        k = s.identifiers[0]
+        self.assertIs(model_spline(models[k]),model_spline(ms.get_model(k)))
+        x,y = models[s.identifiers[0]]._world_axis_lin
+        # the spline interpolates the grid points
+        v = s(x[5],y[7])
+        for i,k in enumerate(s.identifiers):
+            self.assertAlmostEqual(v[i]/models[k].data[7,5],1.0,places=10)
+        # batched evaluation and derivatives
+        n = np.logspace(2,5,20)
+        g = np.logspace(-2,1,20)
+        v,dn,dg = s.derivatives(n,g)
+        self.assertEqual(v.shape,(len(s),20))
+        e = 1e-6
+        v2 = s(np.log10(n)+e,np.log10(g),log=True)
+        self.assertTrue(np.allclose((v2-v)/e,dn,rtol=1e-4))
+        self.assertTrue(np.all(np.isnan(s(1E20,1.0))))
+
+    def test_index(self):
+        print("ModelSet index Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        ids = ["CII_158","OI_63","CO_10","FIR"]
+        index = ms.get_index(ids)
+        self.assertIs(index,ms.get_index(ids))
+        models = ms.get_models(ids)
+        self.assertEqual(index.identifiers,list(models.keys()))
+        x,y = models[index.identifiers[0]]._world_axis_lin
+        # model values at grid points find those grid points
+        iy = np.array([7,20,50])
+        ix = np.array([5,30,45])
+        values = np.array([models[k].data[iy,ix] for k in index.identifiers])
+        jy,jx,distance = index.nearest(values)
+        self.assertTrue(np.array_equal(jy,iy) and np.array_equal(jx,ix))
+        self.assertTrue(np.allclose(distance,0))
+        n,g = index.query(values*1.01)
+        self.assertTrue(np.allclose(n,x[ix]) and np.allclose(g,y[iy]))
+        # invalid values give no seed
+        values[0,1] = np.nan
+        n,g = index.query(values)
+        self.assertTrue(np.isnan(n[1]) and np.isnan(g[1]))
+
+    def test_upsample(self):
+        print("ModelSet upsample Unit Test")
+        tmp = tempfile.mkdtemp()
+        try:
+            ms = ModelSet("wk2006",z=1)
+            ids = ["CII_158","OI_63","CO_10"]
+            models = ms.get_models(ids)
+            up = ms.get_upsampled_models(ids,4)
+            self.assertEqual(list(up.keys()),list(models.keys()))
+            for k,m in models.items():
+                ny,nx = m.data.shape
+                self.assertEqual(up[k].data.shape,(4*ny-3,4*nx-3))
+                # the original grid points are kept
+                self.assertTrue(np.allclose(up[k].data[::4,::4],m.data,rtol=1e-10,equal_nan=True))
+                self.assertTrue(np.allclose(up[k]._world_axis_lin[0][::4],m._world_axis_lin[0]))
+                self.assertTrue(np.allclose(up[k]._world_axis_lin[1][::4],m._world_axis_lin[1]))
+                self.assertIs(upsample_model(m,4),up[k])
+            # saved in the cache directory by default
+            self.assertTrue(os.path.exists(os.path.join(utils.cache_dir(),"upsampled",f"{model_checksum(models[k])}_x4.npy")))
+            # or kept in memory only
+            upsample_model(models[k],3,False)
+            self.assertFalse(os.path.exists(os.path.join(utils.cache_dir(),"upsampled",f"{model_checksum(models[k])}_x3.npy")))
+            m = models[k].copy()
+            self.assertTrue(np.array_equal(upsample_model(m,4,tmp).data,up[k].data,equal_nan=True))
+            filename = os.path.join(tmp,f"{model_checksum(m)}_x4.npy")
+            self.assertTrue(os.path.exists(filename))
+            # read back from the directory
+            m = models[k].copy()
+            self.assertIsInstance(upsample_model(m,4,tmp).data,np.memmap)
+            self.assertIs(upsample_model(m,1),m)
+            self.assertRaises(ValueError,upsample_model,m,0)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_align(self):
+        print("ModelSet align Unit Test")
+        ms = ModelSet("wk2006",z=1)
+        ids = ["H200S1/H200S0","CII_158/CO_10","OI_63/CII_158"]
+        models = {i:ms.get_model(i) for i in ids}
+        aligned = align_models(models)
+        self.assertEqual(list(aligned.keys()),ids)
+        # the H2 grid is log(n) = 1-5, log(G0) = 1-5
+        self.assertIs(aligned["H200S1/H200S0"],models["H200S1/H200S0"])
+        for i in ids[1:]:
+            a = aligned[i]
+            self.assertEqual(a.data.shape,(17,17))
+            self.assertTrue(np.shares_memory(a.data,models[i].data))
+            self.assertTrue(np.array_equal(a.data,models[i].data[6:23,0:17]))
+            for j in range(2):
+                self.assertTrue(np.allclose(a._world_axis[j],aligned[ids[0]]._world_axis[j]))
+        # models on one grid are unchanged
+        same = [ms.get_model(i) for i in ids[1:]]
+        self.assertTrue(all(a is m for a,m in zip(align_models(same),same)))
+        # different grid spacing
+        self.assertRaises(ValueError,align_models,[models[ids[1]],ModelSet("wk2020",z=1).get_model("CII_158/CO_10")])
+        # the deprecated H2 helpers
+        with self.assertWarns(DeprecationWarning):
+            self.assertTrue(np.array_equal(utils._trim_to_H2(models[ids[1]]).data,aligned[ids[1]].data))
+        trimmed = dict(models)
+        with self.assertWarns(DeprecationWarning):
+            utils._trim_all_to_H2(trimmed)
+        self.assertTrue(all(np.array_equal(trimmed[i].data,aligned[i].data) for i in ids))
+
+    def test_clip(self):
+        print("ModelSet clip_models Unit Test")
+        ms = ModelSet("wk2006",z=1)
+        ids = ["CII_158","OI_63","CO_10"]
+        models = ms.get_models(ids)
+        # ends between grid points take the next grid point outward
+        clipped = ms.get_clipped_models(ids,nax1_clip=[1.2E3,9E4]*u.Unit("cm-3"),nax2_clip=[10,1000])
+        self.assertEqual(list(clipped.keys()),list(models.keys()))
+        for k,c in clipped.items():
+            self.assertTrue(np.shares_memory(c.data,models[k].data))
+            x,y = c._world_axis_lin
+            self.assertTrue(np.allclose([x[0],x[-1],y[0],y[-1]],[1E3,1E5,10,1000]))
+            self.assertEqual(c.data.shape,(9,9))
+            self.assertEqual(c.header["CUNIT2"],"Habing")
+        # a range inside one grid cell keeps the two points around it
+        c = clip_models([models["OI_63/CII_158"]],nax1_clip=[1.1E3,1.2E3])[0]
+        self.assertEqual(c.data.shape[-1],2)
+        # models inside the ranges are unchanged
+        m = models["OI_63/CII_158"]
+        self.assertIs(clip_models([m],nax1_clip=[1,1E8]*u.Unit("cm-3"))[0],m)
+        self.assertRaises(ValueError,clip_models,[m],nax1_clip=[1E8,1E9])
+        self.assertRaises(ValueError,clip_models,[m],nax1_clip=[1,10]*u.K)
+
+    def test_add_models(self):
+        print("ModelSet add_models Unit Test")
+        ms = ModelSet("wk2006",z=1)
+        m = ms.get_model("CII_158/CO_10")
+        h2 = ms.get_model("H200S1/H200S0")
+        ms.add_models([("CII_158/XX",m,"on grid"),("YY_1/ZZ_2",h2,"smaller grid"),("YY_1",m,"intensity")])
+        self.assertEqual(ms.user_added_models,["CII_158/XX","YY_1/ZZ_2","YY_1"])
+        self.assertIs(ms.get_model("CII_158/XX"),m)
+        # the smaller grid is resampled onto the ModelSet grid
+        r = ms.get_model("YY_1/ZZ_2")
+        self.assertEqual(r.data.shape,m.data.shape)
+        self.assertIs(r.wcs,m.wcs)
+        self.assertTrue(np.allclose(r.data[6:23,0:17],h2.data,equal_nan=True))
+        self.assertTrue(np.all(np.isnan(r.data[0:6,:])))
+        self.assertIn("YY_1/ZZ_2",ms.supported_ratios["ratio label"])
+        self.assertIn("YY_1",ms.supported_intensities["intensity label"])
+        self.assertEqual(ms.table.loc["YY_1/ZZ_2"]["title"],"smaller grid")
+        # overwriting replaces the table rows
+        ms.add_model("YY_1/ZZ_2",m,title="replaced",overwrite=True)
+        self.assertEqual(list(ms.table["ratio"]).count("YY_1/ZZ_2"),1)
+        self.assertEqual(list(ms.supported_ratios["ratio label"]).count("YY_1/ZZ_2"),1)
+        self.assertIs(ms.get_model("YY_1/ZZ_2"),m)
+        # models on incompatible axes are rejected and nothing is added
+        bad = Measurement(data=m.data,unit=m.unit,identifier="QQ_1/QQ_2")
+        self.assertRaises(ValueError,ms.add_models,[("QQ_1/QQ_3",m,"good"),("QQ_1/QQ_2",bad,"bad")])
+        self.assertNotIn("QQ_1/QQ_3",ms.user_added_models)
+        # the grid of the ModelSet is the one most of its models share, even if an H2 model is first
+        ms = ModelSet("wk2006",z=1)
+        ms._table = ms.table[np.argsort(["H2" not in r for r in ms.table["ratio"]],kind="stable")]
+        self.assertIn("H2",ms.table["ratio"][0])
+        self.assertEqual(ms._reference_model().data.shape,m.data.shape)
+        # also without a pack
+        ms._reference = None
+        ms._pack,ms._pack_checked = None,True
+        self.assertEqual(ms._reference_model().data.shape,m.data.shape)
+
+    def test_checksum(self):
+        print("ModelSet checksum Unit Test")
+        ms = ModelSet("wk2020",z=1)
+        m = ms.get_model("CII_158/CO_10")
+        version,checksum = ms.stamp("CII_158/CO_10")
+        self.assertEqual(version,"2020/2")
+        self.assertEqual(checksum,ms.pack.checksum("CII_158/CO_10"))
+        self.assertEqual(checksum,data_checksum(m.data))
+        self.assertEqual(ms.checksum("CII_158/CO_10"),checksum)
+        self.assertNotEqual(ms.checksum("OI_63/CII_158"),checksum)
+        # derived models are rebuilt exactly when a model they use changes
+        ids = ["CII_158","CO_10","OI_63"]
+        s = ms.get_surrogate(ids)
+        other = ms.get_surrogate(["OI_63","OI_145"])
+        ms.add_model("CII_158/CO_10",ms.get_model("CII_158/OI_145"),title="replaced",overwrite=True)
+        self.assertEqual(ms.stamp("CII_158/CO_10"),("user",ms.checksum("CII_158/OI_145")))
+        self.assertIsNot(ms.get_surrogate(ids),s)
+        self.assertIs(ms.get_surrogate(["OI_63","OI_145"]),other)
+        # values derived from a model are computed again after it is changed in place
+        x = ms.get_model("OI_63/CII_158").copy()
+        ms.add_model("CII_158/XX",x,title="in place")
+        checksum = ms.checksum("CII_158/XX")
+        gradient = model_gradient(x)[0].copy()
+        data = x.data
+        x *= 2.0
+        self.assertIs(x.data,data)
+        self.assertNotEqual(ms.checksum("CII_158/XX"),checksum)
+        self.assertEqual(ms.checksum("CII_158/XX"),data_checksum(x.data))
+        self.assertTrue(np.allclose(model_gradient(x)[0],2*gradient,equal_nan=True))
+
 if __name__ == '__main__':
     unittest.main()
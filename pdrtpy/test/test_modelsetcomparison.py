@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+import astropy.units as u
+from astropy.nddata import StdDevUncertainty
+from pdrtpy.modelset import ModelSet
+from pdrtpy.measurement import Measurement
+from pdrtpy.tool.lineratiofit import LineRatioFit
+from pdrtpy.tool.modelsetcomparison import ModelSetComparison
+import pdrtpy.pdrutils as utils
+
+class TestModelSetComparison(unittest.TestCase):
+    def test_comparison(self):
+        print("ModelSetComparison Unit Test")
+        wk2020 = ModelSet("wk2020",z=1)
+        wk2006 = ModelSet("wk2006",z=1)
+        # a 2x3 map of the wk2020 model intensities at six grid points
+        iy = np.array([[20,25,30],[35,40,45]])
+        ix = np.array([[10,15,20],[25,30,35]])
+        observations = list()
+        for line in ["CII_158","OI_63","CO_10","CI_609"]:
+            m = wk2020.get_model(line)
+            data = np.squeeze(m.data)[iy,ix]
+            observations.append(Measurement(data=data,uncertainty=StdDevUncertainty(0.1*data),
+                                            identifier=line,unit=m.unit))
+        c = ModelSetComparison([wk2006,wk2020],measurements=observations)
+        c.run()
+        self.assertEqual(c.density.data.shape,(2,3))
+        # every pixel is a wk2020 grid point, so wk2020 fits best, at that grid point
+        self.assertTrue(np.all(c.best_modelset.data == 1))
+        self.assertTrue(np.all(c.chisq(min=True).data < 0.2))
+        x,y = np.asarray(wk2020.get_model("CII_158")._world_axis_lin[0]),np.asarray(wk2020.get_model("CII_158")._world_axis_lin[1])
+        self.assertTrue(np.allclose(c.density.data,x[ix]))
+        g0 = (y[iy]*u.Unit("erg s-1 cm-2")).to_value("Habing")
+        self.assertTrue(np.allclose(c.radiation_field.data,g0))
+        self.assertEqual(c.radiation_field.unit,u.Unit("Habing"))
+        # the sweep agrees with the grid search of LineRatioFit
+        p = LineRatioFit(wk2006,measurements=observations)
+        p.run(refine=False)
+        r = c.results[0]
+        self.assertIs(r["modelset"],wk2006)
+        self.assertEqual(sorted(r["ratios"]),sorted(p.observed_ratios))
+        self.assertTrue(np.allclose(r["chisq"].data,p.chisq(min=True).data))
+        self.assertTrue(np.allclose(r["density"].data,p.density.data))
+        self.assertTrue(np.allclose(r["radiation_field"].data,utils.to("Habing",p.radiation_field).data))
+        # masked pixels are not fit
+        observations[0].mask = np.array([[False,True,False],[False,False,False]])
+        c = ModelSetComparison([wk2006,wk2020],measurements=observations)
+        c.run()
+        for image in [c.density,c.chisq(min=True),c.best_modelset,c.results[1]["density"]]:
+            self.assertTrue(np.isnan(image.data[0,1]))
+            self.assertTrue(np.array_equal(image.mask,observations[0].mask))
+        self.assertTrue(np.allclose(c.density.data[1],x[ix][1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""Vectorized searches of model grids for the grid point with the minimum chi-square at many pixels at once, shared by :class:`~pdrtpy.tool.modelsetcomparison.ModelSetComparison` and :class:`~pdrtpy.tool.intensityfit.IntensityFit`"""
+
+from copy import deepcopy
+
+import numpy as np
+from astropy.io.fits.header import Header
+from astropy.nddata import StdDevUncertainty
+
+from .. import pdrutils as utils
+from ..modelset import _linear_axes
+
+# maximum number of (model grid point, pixel) chi-square values held at once
+_SWEEP_SIZE_ = 4000000
+
+def grid_points(models,density_unit=None,radiation_field_unit=None):
+    """The values of models at the grid points where all of them are defined, and the linear density and radiation field of those grid points.
+
+    :param models: models on the same grid, see :func:`~pdrtpy.modelset.align_models`
+    :type models: dict of :class:`~pdrtpy.measurement.Measurement`
+    :param density_unit: the unit of the returned density. Default: None, the unit of the model axis
+    :type density_unit: str or :class:`astropy.units.Unit`
+    :param radiation_field_unit: the unit of the returned radiation field. Default: None, the unit of the model axis
+    :type radiation_field_unit: str or :class:`astropy.units.Unit`
+    :returns: the model values, with shape (models, grid points), and the density and the radiation field of each grid point
+    :rtype: tuple of :class:`numpy.ndarray`
+    """
+    fk = utils.firstkey(models)
+    shape = models[fk].data.shape[-2:]
+    grid = np.array([np.asarray(m.data,dtype=float).reshape(shape).ravel() for m in models.values()])
+    x,y = _linear_axes(models[fk])
+    gx = x.value if density_unit is None else x.to_value(density_unit)
+    gy = y.value if radiation_field_unit is None else y.to_value(radiation_field_unit)
+    gy,gx = np.meshgrid(gy,gx,indexing="ij")
+    # leave out grid points where any model is undefined
+    valid = np.all(np.isfinite(grid),axis=0)
+    return grid[:,valid],gx.ravel()[valid],gy.ravel()[valid]
+
+def observations(measurements,data,error):
+    r"""The observed values and their weights :math:`w = 1/\sigma^2` for :func:`sweep`.  Values that are masked in the measurements, are not finite, or have no finite weight get zero weight.
+
+    :param measurements: the measurements, whose masks are used
+    :type measurements: list of :class:`~pdrtpy.measurement.Measurement`
+    :param data: the values of the measurements, with shape (measurements, pixels)
+    :type data: :class:`numpy.ndarray`
+    :param error: the uncertainties of the values, with the same shape as data
+    :type error: :class:`numpy.ndarray`
+    :returns: the values with invalid ones set to zero, the weights, whether each value is valid, and whether each value is masked, or None if none of the measurements has a mask
+    :rtype: tuple of :class:`numpy.ndarray`
+    """
+    with np.errstate(divide='ignore',invalid='ignore'):
+        weight = 1.0/error**2
+    good = np.isfinite(data) & np.isfinite(weight)
+    masked = None
+    if any(m.mask is not None for m in measurements):
+        masked = np.array([np.zeros(data.shape[1],dtype=bool) if m.mask is None
+                           else np.broadcast_to(np.asarray(m.mask,dtype=bool),np.shape(m.data)).ravel()
+                           for m in measurements])
+        good &= ~masked
+    return np.where(good,data,0.0),np.where(good,weight,0.0),good,masked
+
+def sweep(grid,data,weight,good,scale=False,max_scale=None):
+    r"""Find the model grid point with the minimum :math:`\chi^2` for every pixel.  With :math:`w = 1/\sigma^2`, :math:`\chi^2 = \sum d^2 w - 2\Phi \sum m d w + \Phi^2 \sum m^2 w`, so :math:`\chi^2` at all grid points is two matrix products for each block of pixels.  With `scale=True`, the models are scaled by the factor :math:`\Phi = \sum m d w/\sum m^2 w` that minimizes :math:`\chi^2` at each grid point, e.g., a beam filling factor, otherwise :math:`\Phi = 1`.  The minimum itself is recomputed from the residuals at the chosen grid point to avoid the round off of the expansion.  Pixels with any invalid value are not fit.
+
+    :param grid: the model values at the grid points, see :func:`grid_points`
+    :type grid: :class:`numpy.ndarray`
+    :param data: the observed values, with shape (models, pixels), see :func:`observations`
+    :type data: :class:`numpy.ndarray`
+    :param weight: the weights of the observed values
+    :type weight: :class:`numpy.ndarray`
+    :param good: whether each observed value is valid
+    :type good: :class:`numpy.ndarray`
+    :param scale: whether to fit the scale factor :math:`\Phi`. Default: False
+    :type scale: bool
+    :param max_scale: the upper limit of :math:`\Phi`, which is always at least 0. Default: None, meaning no upper limit
+    :type max_scale: float
+    :returns: the index of the grid point with the minimum :math:`\chi^2`, the scale factor, and the minimum, one per pixel.  The index is -1 and the others NaN for pixels that are not fit.
+    :rtype: tuple of :class:`numpy.ndarray`
+    """
+    npix = data.shape[1]
+    index = np.full(npix,-1)
+    phi = np.full(npix,np.nan)
+    chi = np.full(npix,np.nan)
+    if grid.shape[1] == 0:
+        return index,phi,chi
+    dw = data*weight
+    gridT = grid.T
+    grid2T = (grid**2).T
+    step = max(1,_SWEEP_SIZE_//grid.shape[1])
+    for start in range(0,npix,step):
+        s = slice(start,min(start+step,npix))
+        b = gridT @ dw[:,s]
+        c = grid2T @ weight[:,s]
+        if scale:
+            with np.errstate(divide='ignore',invalid='ignore'):
+                p = np.clip(b/c,0,max_scale)
+            p[~np.isfinite(p)] = 0.0
+            i = np.argmin(p*(p*c - 2.0*b),axis=0)
+            phi[s] = p[i,np.arange(len(i))]
+        else:
+            i = np.argmin(c - 2.0*b,axis=0)
+            phi[s] = 1.0
+        index[s] = i
+        chi[s] = np.sum((data[:,s]-phi[s]*grid[:,i])**2*weight[:,s],axis=0)
+    # pixels missing any value can not be fit
+    fit = np.all(good,axis=0)
+    index[~fit] = -1
+    phi[~fit] = np.nan
+    chi[~fit] = np.nan
+    return index,phi,chi
+
+def at(values,index):
+    """The values at the grid points found by :func:`sweep`, NaN for pixels that were not fit
+
+    :rtype: :class:`numpy.ndarray`
+    """
+    return np.where(index < 0,np.nan,values[index])
+
+def result_image(template,value,unit,identifier,mask=None,history=()):
+    """A Measurement with the shape and header of a template holding the given pixel values, with NaN uncertainties.
+
+    :param template: the measurement whose shape and header to use
+    :type template: :class:`~pdrtpy.measurement.Measurement`
+    :param value: the pixel values
+    :type value: :class:`numpy.ndarray`
+    :param unit: the unit of the values
+    :type unit: :class:`astropy.units.Unit`
+    :param identifier: the identifier of the result
+    :type identifier: str
+    :param mask: the mask of the result, one value per pixel. Default: None, not masked
+    :type mask: :class:`numpy.ndarray`
+    :param history: HISTORY cards to add to the header
+    :type history: list of str
+    :rtype: :class:`~pdrtpy.measurement.Measurement`
+    """
+    image = deepcopy(template)
+    shape = image.data.shape
+    image.data = np.asarray(value,dtype=float).reshape(shape)
+    image.unit = unit
+    image.uncertainty = StdDevUncertainty(np.full(shape,np.nan),unit=unit)
+    image.mask = None if mask is None else np.asarray(mask,dtype=bool).reshape(shape).copy()
+    image.header = Header(image.header)
+    image.header.pop("RATIO",None)
+    image._identifier = identifier
+    for h in history:
+        utils.history(h,image)
+    utils.signature(image)
+    if np.any(np.isfinite(image.data)):
+        utils.dataminmax(image)
+    return image
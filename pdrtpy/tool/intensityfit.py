@@ -0,0 +1,144 @@
+import numpy as np
+import astropy.units as u
+
+from .lineratiofit import LineRatioFit
+from . import gridsearch
+from .. import pdrutils as utils
+from ..modelset import align_models, _linear_axes
+from ..modelsurrogate import upsample_model
+
+class IntensityFit(LineRatioFit):
+    r"""IntensityFit is a tool to fit observations of line and continuum intensities directly to the intensity models of a :class:`~pdrtpy.modelset.ModelSet`, rather than their ratios.  The observed intensities of a pixel are compared to the model intensities scaled by a factor :math:`\Phi`, e.g., the beam filling factor, which is fitted along with the density and radiation field.
+
+For a given density and radiation field, the :math:`\chi^2 = \sum_k (I_k-\Phi M_k)^2/\sigma_k^2` of observed intensities :math:`I_k` and model intensities :math:`M_k` is minimized by
+
+.. math::
+
+    \Phi = {\sum_k I_k M_k/\sigma_k^2 \over \sum_k M_k^2/\sigma_k^2}
+
+so :math:`\Phi` is solved in closed form at every model grid point and the search remains over density and radiation field only.  It is evaluated at every grid point for all pixels at once with two matrix products.  The density, radiation field, and :math:`\Phi` of each pixel are those of the grid point with the minimum :math:`\chi^2`.  Use `oversample` in :meth:`run` to search finer grids.
+
+At least 3 intensities that are covered by the ModelSet are needed.  Since density, radiation field, and :math:`\Phi` are fitted, the degrees of freedom are the number of intensities minus 3, so with only 3 intensities the reduced :math:`\chi^2` is undefined (NaN).
+
+:param modelset: The set of PDR models to use for fitting. Default: None, which means use the Wolfire/Kaufman 2006 models with solar metallicity, `ModelSet("wk2006",z=1)`
+:type modelset: :class:`~pdrtpy.modelset.ModelSet`
+:param measurements: Input measurements to be fit.
+:type measurements: list or dict of :class:`~pdrtpy.measurement.Measurement`. If dict, the keys should be the Measurement *identifiers*.
+:param max_filling_factor: The upper limit of :math:`\Phi`, e.g. 1 for a beam filling factor.  :math:`\Phi` is always at least 0. Default: None, meaning no upper limit
+:type max_filling_factor: float
+    """
+    def __init__(self,modelset=None,measurements=None,max_filling_factor=None):
+        super().__init__(modelset=modelset,measurements=measurements)
+        self._modelintensities = None
+        self._filling_factor = None
+        self._chisq_min = None
+        self._reduced_chisq_min = None
+        self.max_filling_factor = max_filling_factor
+
+    @property
+    def filling_factor(self):
+        r'''The computed scale factor :math:`\Phi` of the model intensities, e.g., the beam filling factor.
+
+        :rtype: :class:`~pdrtpy.measurement.Measurement`
+        '''
+        return self._filling_factor
+
+    @property
+    def intensitycount(self):
+        '''The number of intensities that match models available in the current :class:`~pdrtpy.modelset.ModelSet` given the current set of measurements
+
+        :rtype: int
+        '''
+        return len(self._modelset.model_intensities(self.measurementIDs))
+
+    @property
+    def observed_intensities(self):
+        '''The identifiers of the observed intensities that are fitted.
+
+        :rtype: list of str
+        '''
+        if self._modelintensities is None:
+            return list()
+        return list(self._modelintensities.keys())
+
+    def read_models(self,unit=None):
+        """Get the intensity models that match the measurements, in the order of the measurements.  All model grids are trimmed to their common axes (see :func:`~pdrtpy.modelset.align_models`).
+
+        :raises Exception: if fewer than 3 measurements have intensity models
+        """
+        models = self._modelset.get_models(self.measurementIDs,model_type='intensity')
+        if len(models) < 3:
+            raise Exception(f"Not enough intensities.  You need to provide at least 3 observations that are covered by intensity models in the ModelSet. From your observations, {len(models):d} intensity model(s) {list(models.keys())} are available.")
+        models = {k:models[k] for k in self.measurementIDs if k in models}
+        self._modelintensities = align_models(models)
+        self._modelnaxis = self._modelintensities[utils.firstkey(models)].wcs.naxis
+
+    def run(self,**kwargs):
+        r'''Run the full computation using all the :class:`observations <pdrtpy.measurement.Measurement>` added.  This will check compatibility of input observations (e.g., beam parameters, coordinate types, axes lengths) and raise exceptions if the observations don't match each other.
+
+           :param mask: Indicate how to mask image observations (Measurements) before fitting. See :meth:`~pdrtpy.tool.lineratiofit.LineRatioFit.run`.
+           :type mask:  list or None
+           :param oversample: Search model grids this many times finer along each axis, interpolated in log space (see :meth:`~pdrtpy.modelset.ModelSet.get_upsampled_models`). Default: 1
+           :type oversample: int
+           :raises Exception: if fewer than 3 observations are covered by intensity models, a measurement has no uncertainty, or observations are not compatible.
+        '''
+        kwargs_opts = {'mask': None,
+                       'oversample': 1}
+        kwargs_opts.update(kwargs)
+        self._check_compatibility()
+        self.read_models()
+        self._reset_masks()
+        self._mask_measurements(kwargs_opts['mask'])
+        if not self._check_measurement_shapes():
+            raise Exception("Measurement maps have different dimensions")
+
+        keys = list(self._modelintensities.keys())
+        models = {k:upsample_model(m,kwargs_opts['oversample']) for k,m in self._modelintensities.items()}
+        data = list()
+        error = list()
+        for k in keys:
+            # K km/s to erg s-1 cm-2 sr-1 if needed, then to the unit of the model
+            m = utils.convert_if_necessary(self._measurements[k])
+            if m.uncertainty is None:
+                raise Exception(f"Measurement {k} has no uncertainty, which is needed to compute chi-square")
+            scale = u.Unit(m.unit).to(models[k].unit)
+            data.append(np.asarray(m.data,dtype=float).flatten()*scale)
+            error.append(np.asarray(m.error,dtype=float).flatten()*scale)
+        data,weight,good,masked = gridsearch.observations([self._measurements[k] for k in keys],np.array(data),np.array(error))
+        grid,gx,gy = gridsearch.grid_points(models)
+        # pixels missing or masked in any intensity can not be fit
+        index,phi,chi = gridsearch.sweep(grid,data,weight,good,scale=True,max_scale=self.max_filling_factor)
+        n = gridsearch.at(gx,index)
+        g = gridsearch.at(gy,index)
+        mask = None if masked is None else np.any(masked,axis=0)
+        # density, radiation field, and filling factor are fitted
+        self._dof = len(keys)-3
+        if self._dof > 0:
+            reduced = chi/self._dof
+        else:
+            utils.warn(self,f"{len(keys)} intensities leave no degrees of freedom for 3 fitted parameters, so the reduced chi-square is undefined. Provide at least 4 intensities for it.")
+            reduced = np.full_like(chi,np.nan)
+
+        x,y = _linear_axes(models[keys[0]])
+        self.density_unit = x.unit
+        self.radiation_field_unit = y.unit
+        self._density = self._image(n,self.density_unit,"H2 Volume Density",mask)
+        utils.setkey("BUNIT",self.density_unit.to_string(),self._density)
+        utils.comment("Best-fit H2 volume density",self._density)
+        self._radiation_field = self._image(g,self.radiation_field_unit,"Radiation Field",mask)
+        utils.setkey("BUNIT",self.radiation_field_unit.to_string(),self._radiation_field)
+        utils.comment("Best-fit interstellar radiation field",self._radiation_field)
+        self._filling_factor = self._image(phi,u.dimensionless_unscaled,"Filling Factor",mask)
+        utils.comment("Best-fit scale factor of the model intensities",self._filling_factor)
+        self._chisq_min = self._image(chi,u.dimensionless_unscaled,"Chi-square",mask)
+        utils.setkey("BUNIT","Minimum Chi-squared",self._chisq_min)
+        self._reduced_chisq_min = self._image(reduced,u.dimensionless_unscaled,"Reduced Chi-square",mask)
+        utils.setkey("BUNIT",("Minimum Reduced Chi-squared (DOF=%d)"%self._dof),self._reduced_chisq_min)
+        self._chisq = None
+        self._reduced_chisq = None
+
+    def _image(self,value,unit,identifier,mask=None):
+        """A Measurement with the shape and header of the measurements holding the given pixel values"""
+        return gridsearch.result_image(self._measurements[utils.firstkey(self._modelintensities)],value,unit,identifier,mask=mask,
+                                       history=["Measurements provided: " + str(list(self._measurements.keys())),
+                                                "Intensities used: " + str(list(self._modelintensities.keys()))])
@@ -22,8 +22,10 @@ import io
 from .toolbase import ToolBase
 from .fitmap import FitMap
 from .. import pdrutils as utils
-from ..modelset import ModelSet
-#from ..measurement import Measurement
+from ..modelset import ModelSet, model_gradient, align_models, clip_models, _linear_axes
+from ..modelsurrogate import ModelSurrogate, upsample_model
+from ..modelindex import ModelIndex
+from ..measurement import MeasurementBatch
 
 class LineRatioFit(ToolBase):
     """LineRatioFit is a tool to fit observations of intensity ratios to a set of PDR models. It takes as input a set of observations with errors represented as :class:`~pdrtpy.measurement.Measurement` and  :class:`~pdrtpy.modelset.ModelSet` for the models to which the data will be fitted. The observations should be spectral line or continuum intensities.  They can be spatial maps or single pixel values. They should have the same spatial resolution.
@@ -33,14 +35,17 @@ The models to be fit are stored as intensity ratios. The input observations will
 Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view the results.
 
 
-:param modelset: The set of PDR models to use for fitting.
+:param modelset: The set of PDR models to use for fitting. Default: None, which means use the Wolfire/Kaufman 2006 models with solar metallicity, `ModelSet("wk2006",z=1)`
 :type modelset: :class:`~pdrtpy.modelset.ModelSet`
 
 :param measurements: Input measurements to be fit.
-:type measurements: list or dict of :class:`~pdrtpy.measurement.Measurement`. If dict, the keys should be the Measurement *identifiers*.
+:type measurements: list or dict of :class:`~pdrtpy.measurement.Measurement`. If dict, the keys should be the Measurement *identifiers*.  Catalogs of many sources can be given as a :class:`~pdrtpy.measurement.MeasurementBatch`, which is fit as a vector.
     """
-    def __init__(self,modelset=ModelSet("wk2006",z=1),measurements=None):
+    def __init__(self,modelset=None,measurements=None):
         super().__init__() # needed?
+        if modelset is None:
+            # don't create the default ModelSet at import time.
+            modelset = ModelSet("wk2006",z=1)
         if type(modelset) == str:
             # may need to disable this
             self._initialize_modelTable(modelset)
@@ -49,10 +54,13 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         self._set_measurementnaxis()
         self._modelratios = None
         self._modelnaxis = None
+        self._clip = (None,None)
         self._set_model_files_used()
         self._observedratios = None
         self._chisq = None
         self._reduced_chisq = None
+        self._chisq_min = None
+        self._reduced_chisq_min = None
         self._likelihood = None
         self._radiation_field = None
         self._density = None
@@ -140,10 +148,12 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         :param min: If `True` return the minimum reduced :math:`\chi^2`.  In the case of map inputs this will be a spatial map of mininum :math:`\chi^2`.  If `False` with map inputs the entire :math:`\chi^2` hypercube is returned.  If `True` with single pixel inputs, a single value is returned.  If `False` with single pixel inputs, :math:`\chi^2` as a function of density and radiation field is returned.
 
         :rtype: :class:`~pdrtpy.measurement.Measurement`
+        :raises Exception: if `min` is `False` and the last run did not compute the :math:`\chi^2` hypercube, e.g., with `coarse='index'`
         '''
         if min:
             return self._chisq_min
         else:
+            self._check_chisq_cube()
             return self._chisq
 
     def reduced_chisq(self,min=False):
@@ -153,32 +163,52 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         :param min: If `True` return the minimum reduced :math:`\chi_\nu^2`.  In the case of map inputs this will be a spatial map of mininum :math:`\chi_\nu^2`.  If `False` with map inputs the entire :math:`\chi_\nu^2` hypercube is returned.  If `True` with single pixel inputs, a single value is returned.  If `False` with single pixel inputs, :math:`\chi_\nu^2` as a function of density and radiation field is returned.
 
         :rtype: :class:`~pdrtpy.measurement.Measurement`
+        :raises Exception: if `min` is `False` and the last run did not compute the :math:`\chi_\nu^2` hypercube, e.g., with `coarse='index'`
         '''
         if min:
             return self._reduced_chisq_min
         else:
+            self._check_chisq_cube()
             return self._reduced_chisq
 
+    def _check_chisq_cube(self):
+        """Raise an exception if the last run found the minimum chi-square without computing the chi-square hypercube"""
+        if self._chisq is None and self._chisq_min is not None:
+            raise Exception("The chi-square hypercube was not computed in this run, e.g., because it used coarse='index'. Use min=True for the minimum chi-square at each pixel.")
+
     def _init_measurements(self,m):
         """Initialize the measurements from an input list or dict. If a dict, the dictionary keys must be valid measurement identifiers.
 
         :param m: the input list of Measurements
-        :type m: list, tuple, or dict
+        :type m: list, tuple, dict, or :class:`~pdrtpy.measurement.MeasurementBatch`
         """
         self._masks = dict() # need to save these so they can be reset later
         if m is None:
             self._measurements = None
+        elif isinstance(m,MeasurementBatch):
+            # one vector Measurement per identifier sharing the arrays of the batch
+            self._measurements = m.to_measurements()
+            for key in self._measurements:
+                self._masks[key] = deepcopy(self._measurements[key].mask)
         elif type(m) == list or type(m) == tuple:
             self._measurements = dict()
             for mm in m:
                 self._measurements[mm.id] = mm
                 self._masks[mm.id] = deepcopy(mm.mask)
         elif type(m) == dict:
-            self._measurements = deepcopy(m)
+            # memory-mapped data and uncertainties are never modified, so share
+            # them instead of reading them into memory.
+            memo = dict()
+            for v in m.values():
+                if v.is_memmap():
+                    memo[id(v.data)] = v.data
+                    if v.uncertainty is not None:
+                        memo[id(v.uncertainty.array)] = v.uncertainty.array
+            self._measurements = deepcopy(m,memo)
             for key in m:
                 self._masks[key] = deepcopy(m[key].mask)
         else:
-            raise ValueError("Input measurements must be list, tuple, or dict")
+            raise ValueError("Input measurements must be list, tuple, dict, or MeasurementBatch")
 
     def _set_model_files_used(self):
         self._model_files_used = dict()
@@ -295,9 +325,11 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
                     self.radiation_field_unit = u.Unit(self._modelratios[k].header["CUNIT2"])
                 except KeyError:
                     raise Exception("Keyword CUNIT2 is required in file %s FITS header to describe units of interstellar radiation field"%self._model_files_used[k])
-        if not self._check_model_shapes():
-            warnings.warn("Trimming all model grids to match H2 grid: log(n) = 1-5, log(G0) = 1-5")
-            utils._trim_all_to_H2(self._modelratios)
+        aligned = align_models(self._modelratios)
+        if any(aligned[r] is not self._modelratios[r] for r in aligned):
+            x,y = aligned[k]._world_axis
+            warnings.warn(f"Trimming all model grids to their common axes: {self.density_type} = {x[0]:.2g}-{x[-1]:.2g}, {self.radiation_field_type} = {y[0]:.2g}-{y[-1]:.2g}")
+        self._modelratios = aligned
 
     def _check_compatibility(self):
         """Check that all Measurements are compatible (beams, coordinate systems, shapes) so that the computation make commence.
@@ -360,6 +392,20 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
                 * ’propagate’ : the values returned from userfcn are un-altered
                 * ’omit’ : non-finite values are filtered
            :type nan_policy: str
+           :param jacobian: For method 'leastsq', compute the Jacobian of the residuals from derivative grids of the models (see :func:`~pdrtpy.modelset.model_gradient`) instead of by finite differences.  Pixels whose first guess is at a bound of density or radiation field are fit with finite differences, with a warning. Default: False
+           :type jacobian: bool
+           :param surrogate: In the refine step, evaluate the models with a smooth log-space spline surrogate (see :class:`~pdrtpy.modelsurrogate.ModelSurrogate`), one call for all ratios, instead of interpolating each model linearly. Default: False
+           :type surrogate: bool
+           :param coarse: How to find the first guess of density and radiation field for the refine step. One of:
+                * 'chisq' : the model grid point with the minimum :math:`\chi^2`, found by computing :math:`\chi^2` at every model grid point for every pixel [Default]
+                * 'index' : the nearest model grid point in log ratio space, found for all pixels at once with a KD-tree (see :class:`~pdrtpy.modelindex.ModelIndex`). This is much faster for large maps, but the :math:`\chi^2` hypercube is not computed, so :meth:`chisq` and :meth:`reduced_chisq` only return the minima, with `min=True`.
+           :type coarse: str
+           :param oversample: Find the first guess of density and radiation field on model grids this many times finer along each axis, interpolated in log space (see :meth:`~pdrtpy.modelset.ModelSet.get_upsampled_models`).  The upsampled grids are saved in the user cache directory and reused in later sessions.  With `refine=False` this gives a grid search solution with oversample times the model resolution.  The size of the :math:`\chi^2` hypercube grows as the square of oversample, so use `coarse='index'` with maps. Default: 1
+           :type oversample: int
+           :param nax1_clip: Restrict the fit to this range of density, e.g., [1E3,1E5]*u.Unit("cm-3").  The model grids are reduced to views that cover the range (see :func:`~pdrtpy.modelset.clip_models`), which shrinks the :math:`\chi^2` hypercube, and the refined density is bounded by it.  Values without units are in the units of the model axis. Default: None, meaning the whole model grid
+           :type nax1_clip: array-like, may contain :class:`~astropy.units.Quantity`
+           :param nax2_clip: Restrict the fit to this range of radiation field, e.g., [10,1E4]*utils.habing_unit.  See `nax1_clip`. Default: None, meaning the whole model grid
+           :type nax2_clip: array-like, may contain :class:`~astropy.units.Quantity`
 
            :raises Exception: if no models match the input observations, observations are not compatible,
                               or on unrecognized parameters, or NaN encountered.
@@ -371,6 +417,12 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
                         'method': 'leastsq',
                         'nan_policy': 'raise',
                         'refine':True,
+                        'jacobian':False,
+                        'surrogate':False,
+                        'coarse':'chisq',
+                        'oversample':1,
+                        'nax1_clip':None,
+                        'nax2_clip':None,
                        # for emcee
                         'burn': 0,
                         'steps': 1000,
@@ -388,6 +440,9 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         self._check_compatibility()
         self._ratiocount = None
         self.read_models()
+        self._clip = (kwargs_opts.pop('nax1_clip'),kwargs_opts.pop('nax2_clip'))
+        if self._clip != (None,None):
+            self._modelratios = clip_models(self._modelratios,*self._clip)
         self._reset_masks()
         self._mask_measurements(kwargs_opts['mask'])
         kwargs_opts.pop('mask')
@@ -396,15 +451,40 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
             raise Exception("No models were found that match your data. Check ModelSet.supported_ratios.")
 
 
-        # eventually need to check that the maps overlap in real space.
-        self._compute_residual()
-        self._minimizer= Minimizer(self._residual_single_pixel,
+        coarse = kwargs_opts.pop('coarse')
+        if coarse not in ['chisq','index']:
+            raise ValueError(f"Unrecognized coarse method {coarse}. Must be 'chisq' or 'index'")
+        oversample = kwargs_opts.pop('oversample')
+        # the coarse step uses the upsampled models, the refine step the models themselves.
+        models = self._modelratios
+        if oversample != 1:
+            self._modelratios = {k:upsample_model(m,oversample) for k,m in models.items()}
+        try:
+            # eventually need to check that the maps overlap in real space.
+            if coarse == 'chisq':
+                self._compute_residual()
+                self._compute_chisq()
+                self._coarse_density_radiation_field()
+            else:
+                self._coarse_density_radiation_field_index()
+        finally:
+            self._modelratios = models
+        if kwargs_opts.pop('surrogate'):
+            self._set_up_surrogate()
+            residual = self._residual_surrogate
+            jacobian = self._jacobian_surrogate
+        else:
+            residual = self._residual_single_pixel
+            jacobian = self._jacobian_single_pixel
+        self._minimizer= Minimizer(residual,
                                    params=None, nan_policy=kwargs_opts['nan_policy'])
         #need to pop nan_policy and test so that it does not get passed to Minimzer.minimize()
         kwargs_opts.pop('nan_policy',None)
         kwargs_opts.pop('test',None)
-        self._compute_chisq()
-        self._coarse_density_radiation_field()
+        if kwargs_opts.pop('jacobian') and kwargs_opts['method'] == 'leastsq':
+            if jacobian == self._jacobian_single_pixel:
+                self._set_up_jacobian()
+            kwargs_opts['Dfun'] = jacobian
         if kwargs_opts['refine']:
             kwargs_opts.pop('refine')
             self._refine_density_radiation_field2(**kwargs_opts)
@@ -470,14 +550,14 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
 
         # Note _find_ratio_elements does not handle case of OI+CII/FIR so
         # we have to deal with that separately below.
-        z = self._modelset._find_ratio_elements(self.measurementIDs)
         self._observedratios = dict()
-        for p in z:
+        for p in self._ratio_elements():
             label = p["numerator"]+"/"+p["denominator"]
-            # deepcopy workaround for bug: https://github.com/astropy/astropy/issues/9006
+            # Measurement arithmetic gives the ratio its own header, so the header
+            # of the numerator is not changed below.
             num = utils.convert_if_necessary(self._measurements[p["numerator"]])
             denom = utils.convert_if_necessary(self._measurements[p["denominator"]])
-            self._observedratios[label] = deepcopy(num/denom)
+            self._observedratios[label] = num/denom
             #@TODO create a meaningful header for the ratio map
             self._ratioHeader(p["numerator"],p["denominator"],label)
             self._observedshape = self._observedratios[label].data.shape
@@ -485,6 +565,10 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         self._add_oi_cii_fir()
 
 
+    def _ratio_elements(self):
+        """The numerator,denominator pairs of the observed ratios that match models"""
+        return self._modelset._find_ratio_elements(self.measurementIDs)
+
     def _add_oi_cii_fir(self):
         '''add special case ([O I] 63 micron + [C II] 158 micron)/IFIR to observed ratios'''
         m = self.measurementIDs
@@ -493,19 +577,22 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
                 lab="OI_63+CII_158/FIR"
                 oi = utils.convert_if_necessary(self._measurements["OI_63"])
                 cii = utils.convert_if_necessary(self._measurements["CII_158"])
-                a = deepcopy(oi+cii)
-                b = deepcopy(self._measurements["FIR"])
-                self._observedratios[lab] = a/b
-                self._observedratios[lab].meta = deepcopy(b.header)
+                b = self._measurements["FIR"]
+                # the sum is a new Measurement, so divide it in place
+                a = oi+cii
+                a /= b
+                a.meta = b.header.copy()
+                self._observedratios[lab] = a
                 self._ratioHeader("OI_63+CII_158","FIR",lab)
             if "OI_145" in m:
                 lab="OI_145+CII_158/FIR"
                 oi = utils.convert_if_necessary(self._measurements["OI_145"])
                 cii = utils.convert_if_necessary(self._measurements["CII_158"])
-                aa = deepcopy(oi+cii)
-                bb = deepcopy(self._measurements["FIR"])
-                self._observedratios[lab] = aa/bb
-                self._observedratios[lab].meta = deepcopy(bb.header)
+                bb = self._measurements["FIR"]
+                aa = oi+cii
+                aa /= bb
+                aa.meta = bb.header.copy()
+                self._observedratios[lab] = aa
                 self._ratioHeader("OI_145+CII_158","FIR",lab)
 
     # function to minimize in single-pixel case
@@ -525,6 +612,70 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
             i = i+1
         return  (dvalue - mvalue)/evalue
 
+    def _set_up_jacobian(self):
+        """Stack the derivative grids of all models and the uncertainties of all observed ratios so that the Jacobian of the residuals at a pixel is a single vectorized evaluation."""
+        fk = utils.firstkey(self._modelratios)
+        dx = list()
+        dy = list()
+        for k in self._modelratios:
+            gx,gy = model_gradient(self._modelratios[k])
+            # drop any degenerate leading axes, e.g. NAXIS3=1
+            dx.append(gx.reshape(gx.shape[-2:]))
+            dy.append(gy.reshape(gy.shape[-2:]))
+        # The models are interpolated linearly in the linear world coordinates, while the
+        # derivatives are with respect to the WCS (log) coordinates. Scale them by the
+        # ratio of the cell sizes to get the slope of the interpolation in each cell.
+        w = self._modelratios[fk]._world_axis
+        wlin = self._modelratios[fk]._world_axis_lin
+        self._jac_axes = [np.asarray(a,dtype=float) for a in wlin]
+        sx = np.diff(np.asarray(w[0],dtype=float))/np.diff(self._jac_axes[0])
+        sy = np.diff(np.asarray(w[1],dtype=float))/np.diff(self._jac_axes[1])
+        self._jac_dx = np.array(dx)*sx
+        self._jac_dy = np.array(dy)*sy[:,np.newaxis]
+        self._jac_error = np.array([self._observedratios[k].uncertainty.array.flatten() for k in self._modelratios])
+
+    def _set_up_surrogate(self):
+        """Build the spline surrogate of the models and stack the observed ratios and their uncertainties in the same order."""
+        self._surrogate = ModelSurrogate(self._modelratios)
+        self._obs_data = np.array([self._observedratios[k].data.flatten() for k in self._surrogate.identifiers])
+        self._obs_error = np.array([self._observedratios[k].uncertainty.array.flatten() for k in self._surrogate.identifiers])
+
+    def _residual_surrogate(self,params,index):
+        parvals = params.valuesdict()
+        mvalue = self._surrogate(parvals['density'],parvals['radiation_field'])
+        return (self._obs_data[:,index] - mvalue)/self._obs_error[:,index]
+
+    def _jacobian_surrogate(self,params,index):
+        """Jacobian of :meth:`_residual_surrogate` with respect to density and radiation field, for :class:`lmfit.Minimizer` `Dfun`."""
+        parvals = params.valuesdict()
+        n = parvals['density']
+        g = parvals['radiation_field']
+        v,dn,dg = self._surrogate.derivatives(n,g)
+        # derivatives are with respect to log10 of the parameters
+        jac = np.stack([dn/(n*np.log(10)),dg/(g*np.log(10))],axis=1)
+        return -jac/self._obs_error[:,index][:,np.newaxis]
+
+    def _at_bound(self,params):
+        """True if any parameter value is at its lower or upper bound"""
+        return any(p.value <= p.min or p.value >= p.max for p in params.values())
+
+    def _jacobian_single_pixel(self,params,index):
+        """Jacobian of :meth:`_residual_single_pixel` with respect to density and radiation field, for :class:`lmfit.Minimizer` `Dfun`.  It is the derivative of the bilinear interpolation of the models, taken from the precomputed derivative grids."""
+        parvals = params.valuesdict()
+        x,y = self._jac_axes
+        n = parvals['density']
+        g = parvals['radiation_field']
+        # the grid cell containing (n,g) and the fractional position in it
+        i = min(max(np.searchsorted(x,n)-1,0),len(x)-2)
+        j = min(max(np.searchsorted(y,g)-1,0),len(y)-2)
+        t = (n-x[i])/(x[i+1]-x[i])
+        u = (g-y[j])/(y[j+1]-y[j])
+        jac = np.empty((self._jac_dx.shape[0],2))
+        jac[:,0] = (1-u)*self._jac_dx[:,j,i] + u*self._jac_dx[:,j+1,i]
+        jac[:,1] = (1-t)*self._jac_dy[:,j,i] + t*self._jac_dy[:,j,i+1]
+        # the residual is (data-model)/error
+        return -jac/self._jac_error[:,index][:,np.newaxis]
+
     def _residual_multi_pixel(self,params,index):
         # this is currently slower than the 'dumb' way of residual_single_pixel!
         parvals = params.valuesdict()
@@ -637,6 +788,7 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
             progress = kwargs.pop("progress",True) # progress bar
         else:
             progress = kwargs.get("progress",False) #keep the progress keyword for emcee, get vs pop
+        dfun = kwargs.pop("Dfun",None)
         # First get the range of density n and radiation field FUV from the
         # model space, in order to provide them to the Parameters object.
         # Since the wk2006 H2 models have a smaller model space,
@@ -657,6 +809,14 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         maxn=x[-1]
         minfuv=y[0]
         maxfuv=y[-1]
+        # the clipped grids may extend past the requested ranges to the next grid point
+        xq,yq = _linear_axes(self._modelratios[fk])
+        if self._clip[0] is not None:
+            lo,hi = sorted(u.Quantity(self._clip[0],xq.unit).value)
+            minn,maxn = max(minn,lo),min(maxn,hi)
+        if self._clip[1] is not None:
+            lo,hi = sorted(u.Quantity(self._clip[1],yq.unit).value)
+            minfuv,maxfuv = max(minfuv,lo),min(maxfuv,hi)
         if self._radiation_field is None or self._density is None:
             startn = x[int(len(x)/2)]
             startfuv=y[int(len(y)/2)]
@@ -664,9 +824,6 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
             startn = np.nanmean(self._density.value)
             startfuv = np.nanmean(self._radiation_field.value)
         self._fitparam = Parameters()
-    #@todo let user limit these ranges. either they pass in Parameters or
-    # limits = {'density':[low,hi], 'radiation_field':[low,hi]}
-    # in any unit and convert
         self._fitparam.add('density',min=minn,max=maxn,value=startn)
         self._fitparam.add('radiation_field',min=minfuv,max=maxfuv,value=startfuv)
         #self._fitparam.pretty_print()
@@ -682,6 +839,7 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         fm_mask = np.full(shape=self._observedratios[fk].data.shape,fill_value=False).flatten()
         count = 0
         excount = 0
+        boundcount = 0
         # turn off progress bar for single pixel or emcee prints out multiple bars.
         if self._observedratios[fk].size == 1:
             progress = False
@@ -703,7 +861,14 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
                 else:
                     try:
                         self._minimizer.userargs=(j,)
-                        fmdata[j] = self._minimizer.minimize(params=self._fitparam,**kwargs)
+                        # At a bound, lmfit's parameter transformation zeroes the derivative, so an
+                        # analytic Jacobian cannot move the fit off the bound. Use finite differences there.
+                        if dfun is not None and not self._at_bound(self._fitparam):
+                            fmdata[j] = self._minimizer.minimize(params=self._fitparam,Dfun=dfun,**kwargs)
+                        else:
+                            if dfun is not None:
+                                boundcount = boundcount+1
+                            fmdata[j] = self._minimizer.minimize(params=self._fitparam,**kwargs)
                         #if hasattr(fmdata[j],"success")   ugh.  not guaranteed
                         #if fmdata[j].errorbars:
                         count = count+1
@@ -734,6 +899,8 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         self._fitresult = FitMap(fmdata,wcs=self._observedratios[fk].wcs,mask=fm_mask,name="result")
         print(f"fitted {count} of {self._observedratios[fk].size} pixels")
         print(f'got {excount} exceptions')
+        if boundcount > 0:
+            utils.warn(self,f"{boundcount} pixel(s) started at a bound of density or radiation field and were fit with finite differences instead of the analytic Jacobian")
         if False:
             self._rf2 = deepcopy(self._radiation_field)
             self._rf2.data = rf.reshape(self._rf2.data.shape)
@@ -877,6 +1044,61 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         self._makehistory(self._reduced_chisq_min)
         self._makehistory(self._chisq_min)
 
+    def _coarse_density_radiation_field_index(self):
+        '''Compute the first guess density and radiation field spatial maps
+           from the model grid point nearest to the observed ratios of each spatial pixel
+           in log ratio space.  The distance is weighted by the median fractional error of each ratio.'''
+        if self.ratiocount < 2:
+            msg = f"Not enough ratios.  You need to provide at least 3 observations that can be used to compute 2 ratios that are covered by the ModelSet. From your observations, {self.ratiocount:d} ratio(s)"
+            if self.ratiocount>0:
+                msg += f" {list(self._modelratios.keys())}"
+            msg += " can be computed."
+            raise Exception(msg)
+        if not self._check_ratio_shapes():
+            raise Exception("Observed ratio maps have different dimensions")
+        keys = list(self._observedratios.keys())
+        data = np.array([np.asarray(self._observedratios[r].data,dtype=float).flatten() for r in keys])
+        error = np.array([np.asarray(self._observedratios[r].error,dtype=float).flatten() for r in keys])
+        with np.errstate(divide='ignore',invalid='ignore'):
+            sigma = np.nanmedian(error/np.abs(data),axis=1)/np.log(10)
+        sigma[~np.isfinite(sigma) | (sigma <= 0)] = 1.0
+        index = ModelIndex({r:self._modelratios[r] for r in keys},sigma)
+        iy,ix,distance = index.nearest(data)
+        good = iy >= 0
+        x,y = index.coordinates(iy,ix)
+        models = np.array([np.asarray(self._modelratios[r].data,dtype=float).reshape(self._modelratios[r].shape[-2:])[iy,ix] for r in keys])
+        chi = np.sum(((data-models)/error)**2,axis=0)
+        chi[~good] = np.nan
+        self._chisq = None
+        self._reduced_chisq = None
+        self._dof = len(keys) - 1
+
+        fk2 = utils.firstkey(self._observedratios)
+        shape = self._observedratios[fk2].data.shape
+        nans = np.isnan(self._observedratios[fk2].data)
+        self._radiation_field = deepcopy(self._observedratios[fk2])
+        self._density = deepcopy(self._observedratios[fk2])
+        self._chisq_min = deepcopy(self._observedratios[fk2])
+        self._reduced_chisq_min = deepcopy(self._observedratios[fk2])
+        for image,value in [(self._radiation_field,y),(self._density,x),
+                            (self._chisq_min,chi),(self._reduced_chisq_min,chi/self._dof)]:
+            image.data = value.reshape(shape)
+            image.data[nans] = np.nan
+            image.uncertainty.array = np.full(shape,np.nan)
+        self._radiation_field.unit = self.radiation_field_unit
+        self._radiation_field.uncertainty.unit = self.radiation_field_unit
+        self._density.unit = self.density_unit
+        self._density.uncertainty.unit = self.density_unit
+        self._density_radiation_field_header()
+        for image in [self._chisq_min,self._reduced_chisq_min]:
+            image.unit = u.dimensionless_unscaled
+            image.uncertainty.array = np.zeros(shape)
+            image.uncertainty.unit = u.dimensionless_unscaled
+        utils.setkey("BUNIT","Minimum Chi-squared",self._chisq_min)
+        utils.setkey("BUNIT",("Minimum Reduced Chi-squared (DOF=%d)"%self._dof),self._reduced_chisq_min)
+        self._makehistory(self._reduced_chisq_min)
+        self._makehistory(self._chisq_min)
+
     def _makehistory(self,image):
         '''Add information to HISTORY keyword indicating how the density and radiation field were computed (measurements given, ratios used)
 
@@ -885,7 +1107,7 @@ Once the fit is done, :class:`~pdrtpy.plot.LineRatioPlot` can be used to view th
         '''
         s = "Measurements provided: " + str(list(self._measurements.keys()))
         utils.history(s,image)
-        s = "Ratios used: " + str(list(self._residual.keys()))
+        s = "Ratios used: " + str(list(self._observedratios.keys()))
         utils.history(s,image)
         utils.signature(image)
         utils.dataminmax(image)
@@ -0,0 +1,194 @@
+import numpy as np
+import astropy.units as u
+
+from .lineratiofit import LineRatioFit
+from . import gridsearch
+from .. import pdrutils as utils
+from ..modelset import ModelSet, align_models
+
+class ModelSetComparison(LineRatioFit):
+    r"""ModelSetComparison is a tool to compare how well several :class:`~pdrtpy.modelset.ModelSet` fit observations of intensity ratios.  The observed ratios are computed once for all ModelSets, then :math:`\chi^2` is evaluated at every model grid point for every pixel, one vectorized sweep per ModelSet, sharing the observed ratio and uncertainty arrays.  The result is, for each ModelSet and for the ModelSet that fits best, maps of the density and radiation field of the grid point with the minimum :math:`\chi^2` and of that minimum.
+
+The ModelSets are compared by minimum reduced :math:`\chi^2`, since they may not cover the same ratios.  The density and radiation field are grid point values, as with `LineRatioFit.run(refine=False)`.  To refine the fit for one ModelSet, use :class:`~pdrtpy.tool.lineratiofit.LineRatioFit` with that ModelSet.
+
+:param modelsets: The sets of PDR models to compare.
+:type modelsets: list of :class:`~pdrtpy.modelset.ModelSet`
+:param measurements: Input measurements to be fit.
+:type measurements: list or dict of :class:`~pdrtpy.measurement.Measurement`. If dict, the keys should be the Measurement *identifiers*.
+:param radiation_field_unit: The unit of the radiation field maps, which is common to all ModelSets. Default: "Habing"
+:type radiation_field_unit: str or :class:`astropy.units.Unit`
+:param density_unit: The unit of the density maps. Default: "cm-3"
+:type density_unit: str or :class:`astropy.units.Unit`
+    """
+    def __init__(self,modelsets,measurements=None,radiation_field_unit="Habing",density_unit="cm-3"):
+        if isinstance(modelsets,ModelSet):
+            modelsets = [modelsets]
+        if modelsets is None or len(modelsets) == 0:
+            raise ValueError("At least one ModelSet is required")
+        self._modelsets = list(modelsets)
+        super().__init__(modelset=self._modelsets[0],measurements=measurements)
+        self.radiation_field_unit = u.Unit(radiation_field_unit)
+        self.density_unit = u.Unit(density_unit)
+        self._chisq_min = None
+        self._reduced_chisq_min = None
+        self._best_modelset = None
+        self._results = None
+
+    @property
+    def modelsets(self):
+        """The :class:`ModelSets <pdrtpy.modelset.ModelSet>` being compared
+
+        :rtype: list of :class:`~pdrtpy.modelset.ModelSet`
+        """
+        return self._modelsets
+
+    @property
+    def ratiocount(self):
+        '''The number of ratios that match models available in any of the ModelSets given the current set of measurements
+
+        :rtype: int
+        '''
+        if self._ratiocount is None:
+            self._ratiocount = len(list(self._ratio_elements()))
+        return self._ratiocount
+
+    @property
+    def best_modelset(self):
+        r'''The index in :attr:`modelsets` of the ModelSet with the minimum reduced :math:`\chi^2` at each pixel, NaN where no ModelSet could be fit.
+
+        :rtype: :class:`~pdrtpy.measurement.Measurement`
+        '''
+        return self._best_modelset
+
+    @property
+    def results(self):
+        r'''The results for each ModelSet, in the order of :attr:`modelsets`.  Each is a dict with keys "modelset", "ratios" (the ratios fitted), "density", "radiation_field", "chisq", and "reduced_chisq", the last four being maps of the grid point with the minimum :math:`\chi^2` and of that minimum.  A ModelSet that covers fewer than 2 of the observed ratios has no maps.
+
+        :rtype: list of dict
+        '''
+        return self._results
+
+    def _ratio_elements(self):
+        """The numerator,denominator pairs of the observed ratios that match models of any of the ModelSets, each pair once"""
+        seen = set()
+        for ms in self._modelsets:
+            for p in ms._find_ratio_elements(self.measurementIDs):
+                label = p["numerator"]+"/"+p["denominator"]
+                if label not in seen:
+                    seen.add(label)
+                    yield p
+
+    def read_models(self,unit=u.dimensionless_unscaled):
+        """Read the models of each ModelSet that match the observed ratios.  The models of each ModelSet are trimmed to their common axes (see :func:`~pdrtpy.modelset.align_models`).
+
+        :returns: the models of each ModelSet, keyed by ratio, in the order of :attr:`modelsets`
+        :rtype: list of dict
+        """
+        models = list()
+        for ms in self._modelsets:
+            m = ms.get_models(self.measurementIDs,model_type='ratio')
+            m = {r:m[r] for r in m if r in self._observedratios}
+            models.append(align_models(m) if len(m) > 0 else m)
+        return models
+
+    def run(self,**kwargs):
+        r'''Compute the minimum :math:`\chi^2` of each ModelSet at each pixel and find the ModelSet that fits best.  This will check compatibility of input observations (e.g., beam parameters, coordinate types, axes lengths) and raise exceptions if the observations don't match each other.
+
+           :param mask: Indicate how to mask image observations (Measurements) before fitting. See :meth:`~pdrtpy.tool.lineratiofit.LineRatioFit.run`.
+           :type mask:  list or None
+           :raises Exception: if no models match the input observations or observations are not compatible.
+        '''
+        kwargs_opts = {'mask': None}
+        kwargs_opts.update(kwargs)
+        self._check_compatibility()
+        self._ratiocount = None
+        self._reset_masks()
+        self._mask_measurements(kwargs_opts['mask'])
+        self._compute_valid_ratios()
+        if self.ratiocount == 0:
+            raise Exception("No models were found that match your data. Check ModelSet.supported_ratios.")
+
+        # the observed ratios and their weights, shared by all ModelSets.
+        keys = list(self._observedratios.keys())
+        data = np.array([np.asarray(self._observedratios[r].data,dtype=float).flatten() for r in keys])
+        error = np.array([np.asarray(self._observedratios[r].error,dtype=float).flatten() for r in keys])
+        data,weight,good,masked = gridsearch.observations([self._observedratios[r] for r in keys],data,error)
+
+        self._results = list()
+        rchi = np.full((len(self._modelsets),data.shape[1]),np.inf)
+        values = list()
+        for i,models in enumerate(self.read_models()):
+            result = {"modelset":self._modelsets[i],"ratios":list(models.keys())}
+            self._results.append(result)
+            if len(models) < 2:
+                utils.warn(self,f"ModelSet {self._modelsets[i].name} covers {len(models)} of the observed ratios, at least 2 are needed. Skipping it.")
+                values.append(None)
+                continue
+            rows = [keys.index(r) for r in models]
+            grid,gx,gy = gridsearch.grid_points(models,self.density_unit,self.radiation_field_unit)
+            # pixels missing or masked in any of the ratios can not be fit with this ModelSet
+            index,_,chi = gridsearch.sweep(grid,data[rows],weight[rows],good[rows])
+            n = gridsearch.at(gx,index)
+            g = gridsearch.at(gy,index)
+            mask = None if masked is None else np.any(masked[rows],axis=0)
+            dof = len(models) - 1
+            rchi[i] = np.where(np.isnan(chi),np.inf,chi/dof)
+            values.append((n,g,chi,dof))
+            result.update(self._maps(n,g,chi,dof,models.keys(),self._modelsets[i],mask=mask))
+
+        best = np.argmin(rchi,axis=0)
+        fit = np.isfinite(rchi[best,np.arange(len(best))])
+        n = np.full(len(best),np.nan)
+        g = np.full(len(best),np.nan)
+        chi = np.full(len(best),np.nan)
+        rc = np.full(len(best),np.nan)
+        for i,v in enumerate(values):
+            if v is None:
+                continue
+            use = fit & (best == i)
+            n[use] = v[0][use]
+            g[use] = v[1][use]
+            chi[use] = v[2][use]
+            rc[use] = v[2][use]/v[3]
+        mask = None if masked is None else np.any(masked,axis=0)
+        maps = self._maps(n,g,chi,None,keys,None,reduced=rc,mask=mask)
+        self._density = maps["density"]
+        self._radiation_field = maps["radiation_field"]
+        self._chisq_min = maps["chisq"]
+        self._reduced_chisq_min = maps["reduced_chisq"]
+        self._chisq = None
+        self._reduced_chisq = None
+        self._best_modelset = self._image(np.where(fit,best,np.nan),u.dimensionless_unscaled,"Best ModelSet",mask)
+        utils.comment("Index of the ModelSet with the minimum reduced Chi-squared",self._best_modelset)
+        for i,ms in enumerate(self._modelsets):
+            utils.history(f"ModelSet {i}: {ms.description}",self._best_modelset)
+
+    def _maps(self,n,g,chi,dof,ratios,modelset,reduced=None,mask=None):
+        """Measurements of the density, radiation field, minimum chisq, and minimum reduced chisq"""
+        if reduced is None:
+            reduced = chi/dof
+        maps = {"density":self._image(n,self.density_unit,"H2 Volume Density",mask),
+                "radiation_field":self._image(g,self.radiation_field_unit,"Radiation Field",mask),
+                "chisq":self._image(chi,u.dimensionless_unscaled,"Chi-square",mask),
+                "reduced_chisq":self._image(reduced,u.dimensionless_unscaled,"Reduced Chi-square",mask)}
+        utils.setkey("BUNIT",self.density_unit.to_string(),maps["density"])
+        utils.comment("Best-fit H2 volume density",maps["density"])
+        utils.setkey("BUNIT",self.radiation_field_unit.to_string(),maps["radiation_field"])
+        utils.comment("Best-fit interstellar radiation field",maps["radiation_field"])
+        utils.setkey("BUNIT","Minimum Chi-squared",maps["chisq"])
+        if dof is None:
+            utils.setkey("BUNIT","Minimum Reduced Chi-squared",maps["reduced_chisq"])
+        else:
+            utils.setkey("BUNIT",("Minimum Reduced Chi-squared (DOF=%d)"%dof),maps["reduced_chisq"])
+        for image in maps.values():
+            if modelset is None:
+                utils.history("Best of ModelSets: " + str([ms.description for ms in self._modelsets]),image)
+            else:
+                utils.history("ModelSet: " + modelset.description,image)
+            utils.history("Ratios used: " + str(list(ratios)),image)
+        return maps
+
+    def _image(self,value,unit,identifier,mask=None):
+        """A Measurement with the shape and header of the observed ratios holding the given pixel values"""
+        return gridsearch.result_image(self._observedratios[utils.firstkey(self._observedratios)],value,unit,identifier,mask=mask,
+                                       history=["Measurements provided: " + str(list(self._measurements.keys()))])
@@ -33,6 +33,9 @@ setup(
     long_description = readme(),
     packages = find_packages(exclude=excludelist),
     include_package_data = True,
+    entry_points = {
+        'console_scripts': ['pdrtpy-pack=pdrtpy.packbuilder:main'],
+    },
     install_requires = [
         'astropy>=5.2.1',
         'numpy>=1.22.0',